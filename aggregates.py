@@ -0,0 +1,229 @@
+import argparse
+import json
+import math
+import sys
+
+from sqlalchemy import create_engine, text
+
+# Running per-(question, src) totals over user_location, kept in the
+# location_aggregate table so the admin dashboard reads one row per stimulus
+# instead of scanning every response. save_user_locations adds each
+# submission's totals in its own transaction. Distances are measured from
+# where each stimulus started for that participant: their counterbalanced
+# layout (demographics.layout_id, see counterbalance.py) if they were dealt
+# one, else the current admin layout (the most recent admin_location row for
+# the question and src), which is why save_admin_locations recomputes the
+# question it changed.
+#
+# A NULL question is stored as "" because the (question, src) upsert key
+# can't match NULLs.
+#
+#     python aggregates.py --verify     compare with a full recount
+#     python aggregates.py --rebuild    recount everything from user_location
+
+FIELDS = (
+    "responses",
+    "placed",
+    "sum_x",
+    "sum_y",
+    "sum_x2",
+    "sum_y2",
+    "distance_count",
+    "sum_distance",
+)
+
+UPSERT = text(
+    "INSERT INTO location_aggregate (question, src, {fields}) "
+    "VALUES (:question, :src, {values}) "
+    "ON CONFLICT (question, src) DO UPDATE SET {updates}".format(
+        fields=", ".join(FIELDS),
+        values=", ".join(f":{f}" for f in FIELDS),
+        updates=", ".join(f"{f} = {f} + excluded.{f}" for f in FIELDS),
+    )
+)
+
+LATEST_LAYOUT = (
+    "SELECT src, initial_x, initial_y FROM admin_location WHERE id IN "
+    "(SELECT max(id) FROM admin_location WHERE question IS :q GROUP BY src)"
+)
+
+
+def reference_positions(conn, question):
+    # src -> (initial_x, initial_y) in the admin layout for a question
+    rows = conn.execute(text(LATEST_LAYOUT), {"q": question})
+    return {src: (x, y) for src, x, y in rows if x is not None and y is not None}
+
+
+def start_positions(conn, question, layout_id=None):
+    # src -> (x, y) where a participant's stimuli started: the counterbalanced
+    # layout they were served, or the admin layout if they had none
+    if layout_id is not None:
+        row = conn.execute(
+            text("SELECT locations FROM counterbalance_layout WHERE id = :id"), {"id": layout_id}
+        ).first()
+        if row is not None:
+            return {loc["src"]: (loc["initial_x"], loc["initial_y"]) for loc in json.loads(row[0])}
+    return reference_positions(conn, question)
+
+
+def accumulate(totals, question, locations, reference):
+    # Adds locations (dicts with src, final_x, final_y) to totals, a dict of
+    # (question, src) -> list of FIELDS values
+    key_question = question or ""
+    for loc in locations:
+        row = totals.get((key_question, loc["src"]))
+        if row is None:
+            row = totals[(key_question, loc["src"])] = [0] * len(FIELDS)
+        row[0] += 1
+        x, y = loc.get("final_x"), loc.get("final_y")
+        if x is None or y is None:
+            continue
+        row[1] += 1
+        row[2] += x
+        row[3] += y
+        row[4] += x * x
+        row[5] += y * y
+        start = reference.get(loc["src"])
+        if start is not None:
+            row[6] += 1
+            row[7] += math.hypot(x - start[0], y - start[1])
+    return totals
+
+
+def apply(conn, totals):
+    # conn may be a Connection or an ORM Session; the caller commits
+    if totals:
+        conn.execute(
+            UPSERT,
+            [
+                {"question": question, "src": src, **dict(zip(FIELDS, values))}
+                for (question, src), values in totals.items()
+            ],
+        )
+
+
+def count_question(conn, question, chunk_size=10000):
+    # Start positions by layout_id, None being the admin layout
+    references = {None: reference_positions(conn, question)}
+    totals = {}
+    result = conn.execute(
+        text(
+            "SELECT u.src, u.final_x, u.final_y, d.layout_id FROM user_location u "
+            "LEFT JOIN demographics d ON d.id = u.user_id WHERE u.question IS :q"
+        ),
+        {"q": question},
+    )
+    while True:
+        rows = result.fetchmany(chunk_size)
+        if not rows:
+            break
+        by_layout = {}
+        for src, x, y, layout_id in rows:
+            if src:
+                by_layout.setdefault(layout_id, []).append(
+                    {"src": src, "final_x": x, "final_y": y}
+                )
+        for layout_id, locations in by_layout.items():
+            if layout_id not in references:
+                references[layout_id] = start_positions(conn, question, layout_id)
+            accumulate(totals, question, locations, references[layout_id])
+    return totals
+
+
+def questions(conn):
+    return [row[0] for row in conn.execute(text("SELECT DISTINCT question FROM user_location"))]
+
+
+def refresh_question(conn, question):
+    # Recomputes one question's rows; used when its admin layout changes
+    conn.execute(
+        text("DELETE FROM location_aggregate WHERE question = :q"), {"q": question or ""}
+    )
+    apply(conn, count_question(conn, question))
+
+
+def recount(conn):
+    totals = {}
+    for question in questions(conn):
+        totals.update(count_question(conn, question))
+    return totals
+
+
+def rebuild(conn):
+    conn.execute(text("DELETE FROM location_aggregate"))
+    apply(conn, recount(conn))
+
+
+def stored(conn):
+    rows = conn.execute(
+        text(f"SELECT question, src, {', '.join(FIELDS)} FROM location_aggregate")
+    )
+    return {(row[0], row[1]): list(row[2:]) for row in rows}
+
+
+def verify(conn, rel_tol=1e-9):
+    # Returns a list of (question, src, problem) where the table disagrees
+    # with a full recount; float sums are compared with a relative tolerance
+    # since they were added up in a different order
+    expected = recount(conn)
+    actual = stored(conn)
+    problems = []
+    for key in sorted(set(expected) | set(actual)):
+        if key not in actual:
+            problems.append(key + ("missing",))
+        elif key not in expected:
+            problems.append(key + ("no responses",))
+        else:
+            for name, want, got in zip(FIELDS, expected[key], actual[key]):
+                if not math.isclose(want, got, rel_tol=rel_tol, abs_tol=1e-6):
+                    problems.append(key + (f"{name} is {got}, expected {want}",))
+    return problems
+
+
+def summarize(conn, question=None):
+    # Per-stimulus means and standard deviations, one row per stimulus
+    query = f"SELECT question, src, {', '.join(FIELDS)} FROM location_aggregate"
+    params = {}
+    if question is not None:
+        query += " WHERE question = :q"
+        params["q"] = question
+    summary = []
+    for row in conn.execute(text(query + " ORDER BY question, src"), params):
+        item = dict(zip(("question", "src") + FIELDS, row))
+        n = item["placed"]
+        item["mean_x"] = item["sum_x"] / n if n else None
+        item["mean_y"] = item["sum_y"] / n if n else None
+        item["sd_x"] = _sd(item["sum_x"], item["sum_x2"], n)
+        item["sd_y"] = _sd(item["sum_y"], item["sum_y2"], n)
+        m = item["distance_count"]
+        item["mean_distance"] = item["sum_distance"] / m if m else None
+        summary.append(item)
+    return summary
+
+
+def _sd(total, squares, n):
+    if n < 2:
+        return None
+    return math.sqrt(max(squares - total * total / n, 0.0) / (n - 1))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check or rebuild the location_aggregate table")
+    parser.add_argument("--db", default="sqlite:///instance/app.db")
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument("--verify", action="store_true")
+    group.add_argument("--rebuild", action="store_true")
+    args = parser.parse_args()
+
+    engine = create_engine(args.db)
+    if args.rebuild:
+        with engine.begin() as conn:
+            rebuild(conn)
+    with engine.connect() as conn:
+        problems = verify(conn)
+    for question, src, problem in problems[:50]:
+        print(f"{question!r} {src}: {problem}")
+    if problems:
+        print(f"{len(problems)} mismatches; run with --rebuild to recount")
+        sys.exit(1)
+    print("location_aggregate matches user_location")
@@ -7,12 +7,35 @@ from flask import (
     session,
     jsonify,
     send_from_directory,
+    send_file,
+    Response,
+    abort,
 )
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import insert, text
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import OperationalError
 from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.utils import safe_join, secure_filename
+from sqlite_profile import load_profile, engine_options, apply_profile
+from media_store import store_stream, object_path, versioned_name
+from mp4tools import MP4_EXTENSIONS, MP4Error, faststart, probe
+from metrics import init_metrics
+from compression import init_compression
+from write_behind import SubmissionQueue, Writer
+import aggregates
+import counterbalance
+from trajectories import MAX_BATCH_BYTES, TrajectoryError, compress_batch, parse_batch
 import os
+import json
+import mimetypes
+import hashlib
+import logging
+import threading
+import uuid
 from dotenv import load_dotenv
-from datetime import datetime
+from datetime import datetime, timezone
+from urllib.parse import urlsplit
 
 # Load environment variables from .env file
 load_dotenv()
@@ -25,7 +48,56 @@ app.config["SQLALCHEMY_DATABASE_URI"] = os.getenv(
 app.config["SECRET_KEY"] = os.getenv(
     "SECRET_KEY", "6b8b4567327b23c664c16be0002f55f620fbd554c8f5f8f78c7dfd3e4a73ba65"
 )
+app.config["WAITRESS_THREADS"] = int(os.getenv("WAITRESS_THREADS", "8"))
+# Write-behind: journal submissions and store them from a background thread
+app.config["WRITE_BEHIND"] = os.getenv("WRITE_BEHIND", "0") == "1"
+app.config["WRITE_BEHIND_QUEUE"] = os.getenv(
+    "WRITE_BEHIND_QUEUE", os.path.join(app.instance_path, "submission_queue.db")
+)
+# Journal entries that can't be stored, see write_behind.py
+app.config["WRITE_BEHIND_DEAD_LETTER"] = os.getenv(
+    "WRITE_BEHIND_DEAD_LETTER", os.path.join(app.instance_path, "submission_dead_letter.ndjson")
+)
+# Only one process drains the journal; after_fork clears this in all prefork
+# workers but the first
+app.config["WRITE_BEHIND_OWNER"] = True
+# Replaced whenever an admin layout changes, so every worker process drops
+# its cached layouts, see get_layout
+app.config["LAYOUT_VERSION_FILE"] = os.getenv(
+    "LAYOUT_VERSION_FILE", os.path.join(app.instance_path, "layout.version")
+)
+# Browser cache lifetime for stimulus videos; they are revalidated with their
+# ETag after that, so replacing a file is picked up on the next visit
+app.config["UPLOAD_MAX_AGE"] = int(os.getenv("UPLOAD_MAX_AGE", str(7 * 24 * 3600)))
+# Pages and JSON smaller than this go out uncompressed, see compression.py
+app.config["COMPRESS_MIN_SIZE"] = int(os.getenv("COMPRESS_MIN_SIZE", "1024"))
+# Trajectory batches kept per participant; the page flushes at most every 5
+# seconds while dragging, so the default covers hours of dragging
+app.config["TRAJECTORY_MAX_BATCHES"] = int(os.getenv("TRAJECTORY_MAX_BATCHES", "2000"))
+
+# WAL, busy timeout and cache pragmas for concurrent waitress threads,
+# see sqlite_profile.py
+sqlite_settings = load_profile()
+app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(
+    app.config["SQLALCHEMY_DATABASE_URI"], app.config["WAITRESS_THREADS"], sqlite_settings
+)
 db = SQLAlchemy(app)
+with app.app_context():
+    apply_profile(db.engine, sqlite_settings)
+    # Request latency, SQL time and bytes served, on /metrics
+    if os.getenv("METRICS", "1") != "0":
+        init_metrics(app, db.engine)
+# gzip/Brotli responses, precompressed and content-hashed static files
+if os.getenv("COMPRESS", "1") != "0":
+    init_compression(app, app.config["COMPRESS_MIN_SIZE"])
+
+# Debug logging for submissions; enable with LOG_LEVEL=DEBUG
+logger = logging.getLogger("survey")
+logger.setLevel(os.getenv("LOG_LEVEL", "WARNING").upper())
+if not logger.handlers:
+    _handler = logging.StreamHandler()
+    _handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s %(message)s"))
+    logger.addHandler(_handler)
 
 if not os.path.exists(app.config["UPLOAD_FOLDER"]):
     os.makedirs(app.config["UPLOAD_FOLDER"])
@@ -46,6 +118,16 @@ class Demographics(db.Model):
     education = db.Column(db.String(50))
     handedness = db.Column(db.String(10))
     ethnicity = db.Column(db.String(50))
+    # Identifies the submission so a replayed write-behind entry is stored once
+    submission_id = db.Column(db.String(36), unique=True)
+    submitted_at = db.Column(db.DateTime, default=datetime.utcnow)
+    # The counterbalanced layout the participant started from, see
+    # counterbalance.py; NULL if they got the admin layout
+    layout_id = db.Column(db.Integer, db.ForeignKey("counterbalance_layout.id"))
+    __table_args__ = (
+        db.Index("ix_demographics_participant_id", "participant_id"),
+        db.Index("ix_demographics_submitted_at", "submitted_at"),
+    )
     # One-to-many relationship: A demographic can have multiple user locations
     user_locations = db.relationship("UserLocation", backref="demographic", lazy=True)
 
@@ -57,6 +139,10 @@ class AdminLocation(db.Model):
     src = db.Column(db.String(200))
     question = db.Column(db.String(300))
     admin_id = db.Column(db.Integer, db.ForeignKey("admin.id"))
+    __table_args__ = (
+        db.Index("ix_admin_location_admin_id", "admin_id"),
+        db.Index("ix_admin_location_question_src", "question", "src"),
+    )
 
 
 class UserLocation(db.Model):
@@ -68,6 +154,95 @@ class UserLocation(db.Model):
 
     # ForeignKey references Demographics since a UserLocation belongs to a Demographic
     user_id = db.Column(db.Integer, db.ForeignKey("demographics.id"))
+    __table_args__ = (
+        db.Index("ix_user_location_user_id_src", "user_id", "src"),
+        db.Index("ix_user_location_question_src", "question", "src"),
+    )
+
+
+class LocationAggregate(db.Model):
+    # Running totals per stimulus for the dashboard, kept up to date by
+    # aggregates.py in the same transaction as the responses
+    id = db.Column(db.Integer, primary_key=True)
+    question = db.Column(db.String(300), nullable=False, default="")
+    src = db.Column(db.String(200), nullable=False)
+    responses = db.Column(db.Integer, nullable=False, default=0)
+    placed = db.Column(db.Integer, nullable=False, default=0)
+    sum_x = db.Column(db.Float, nullable=False, default=0)
+    sum_y = db.Column(db.Float, nullable=False, default=0)
+    sum_x2 = db.Column(db.Float, nullable=False, default=0)
+    sum_y2 = db.Column(db.Float, nullable=False, default=0)
+    distance_count = db.Column(db.Integer, nullable=False, default=0)
+    sum_distance = db.Column(db.Float, nullable=False, default=0)
+    __table_args__ = (
+        db.UniqueConstraint("question", "src", name="uq_location_aggregate_question_src"),
+    )
+
+
+class CounterbalanceLayout(db.Model):
+    # A precomputed participant layout; a pool of them is added whenever an
+    # admin layout is saved, see counterbalance.py
+    id = db.Column(db.Integer, primary_key=True)
+    pool = db.Column(db.Integer, nullable=False)
+    slot = db.Column(db.Integer, nullable=False)
+    question = db.Column(db.String(300))
+    # JSON: the locations as served to the page, in stimulus order
+    locations = db.Column(db.Text, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    __table_args__ = (
+        db.UniqueConstraint("pool", "slot", name="uq_counterbalance_layout_pool_slot"),
+    )
+
+
+class CounterbalanceState(db.Model):
+    # Single row (id 1): the pool being handed out, where its ids start and
+    # how many participants it has been dealt to so far
+    id = db.Column(db.Integer, primary_key=True)
+    pool = db.Column(db.Integer, nullable=False)
+    first_id = db.Column(db.Integer, nullable=False)
+    size = db.Column(db.Integer, nullable=False)
+    assigned = db.Column(db.Integer, nullable=False, default=0)
+
+
+class TrajectoryBatch(db.Model):
+    # A batch of drag samples from the participant page, packed and
+    # compressed as described in trajectories.py; linked to the submission
+    # through Demographics.submission_id
+    id = db.Column(db.Integer, primary_key=True)
+    submission_id = db.Column(db.String(36), nullable=False)
+    page = db.Column(db.BigInteger, nullable=False)
+    seq = db.Column(db.Integer, nullable=False)
+    samples = db.Column(db.Integer, nullable=False)
+    data = db.Column(db.LargeBinary, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    __table_args__ = (
+        db.UniqueConstraint(
+            "submission_id", "page", "seq", name="uq_trajectory_batch_submission_page_seq"
+        ),
+    )
+
+
+class MediaFile(db.Model):
+    # Uploaded file name -> content hash; the bytes live in media_store.py's
+    # object store, so a name always refers to the same content
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(255), unique=True, nullable=False)
+    sha256 = db.Column(db.String(64), nullable=False, index=True)
+    size = db.Column(db.Integer)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    # Manifest read from the MP4 at upload time, see mp4tools.py
+    duration = db.Column(db.Float)
+    width = db.Column(db.Integer)
+    height = db.Column(db.Integer)
+
+    def manifest(self):
+        return {
+            "sha256": self.sha256,
+            "size": self.size,
+            "duration": self.duration,
+            "width": self.width,
+            "height": self.height,
+        }
 
 
 # @app.route('/')
@@ -130,11 +305,91 @@ def demographics():
         }
 
         session["demographics_completed"] = True
+        # Known before the locations are saved so trajectory batches sent
+        # during the task can be linked to the submission
+        session["submission_id"] = str(uuid.uuid4())
+        # Next counterbalanced layout, served by /load_admin_locations and
+        # stored with the submission
+        session["layout_id"] = counterbalance.assign(db.session)
+        db.session.commit()
         return redirect(url_for("user"))
 
     return render_template("demographics.html")
 
 
+def upload_root():
+    return os.path.join(app.root_path, app.config["UPLOAD_FOLDER"])
+
+
+# name -> (sha256, object path). A stored name never changes content, so
+# entries stay valid for the life of the process.
+_media_index = {}
+_media_index_lock = threading.Lock()
+
+
+def lookup_media(name):
+    with _media_index_lock:
+        entry = _media_index.get(name)
+    if entry is None:
+        media = MediaFile.query.filter_by(name=name).first()
+        if media is None:
+            return None
+        ext = os.path.splitext(media.name)[1]
+        entry = (media.sha256, object_path(upload_root(), media.sha256, ext))
+        with _media_index_lock:
+            _media_index[name] = entry
+    return entry
+
+
+def optimize_video(path):
+    # Moves the moov box ahead of mdat so browsers can start playing before
+    # the whole file arrives; files we can't parse are stored as uploaded
+    try:
+        return faststart(path)
+    except MP4Error as e:
+        logger.warning("Skipping fast-start for %s: %s", path, e)
+        return False
+
+
+def read_manifest(path):
+    try:
+        return probe(path)
+    except MP4Error as e:
+        logger.warning("Could not read video manifest for %s: %s", path, e)
+        return {}
+
+
+def add_media(filename, stream):
+    # Stores the stream by content and returns the name it was indexed under.
+    # A different file arriving under a taken name gets a versioned name
+    # instead of replacing the original.
+    ext = os.path.splitext(filename)[1]
+    is_video = ext.lower() in MP4_EXTENSIONS
+    digest, size, path, _ = store_stream(
+        stream, upload_root(), ext, process=optimize_video if is_video else None
+    )
+
+    existing = MediaFile.query.filter_by(name=filename).first()
+    if existing is not None and existing.sha256 != digest:
+        filename = versioned_name(filename, digest)
+        existing = MediaFile.query.filter_by(name=filename).first()
+    if existing is None:
+        manifest = read_manifest(path) if is_video else {}
+        db.session.add(
+            MediaFile(
+                name=filename,
+                sha256=digest,
+                size=size,
+                duration=manifest.get("duration"),
+                width=manifest.get("width"),
+                height=manifest.get("height"),
+            )
+        )
+    with _media_index_lock:
+        _media_index[filename] = (digest, path)
+    return filename, digest
+
+
 @app.route("/upload", methods=["POST"])
 def upload():
     if "user_id" not in session:
@@ -145,19 +400,81 @@ def upload():
         return jsonify({"message": "No files uploaded"}), 400
 
     file_names = []
+    hashes = {}
     for file in files:
-        filename = file.filename
-        file_path = os.path.join(app.config["UPLOAD_FOLDER"], filename)
-        file.save(file_path)
+        filename = secure_filename(file.filename)
+        if not filename:
+            continue
+        filename, digest = add_media(filename, file.stream)
         file_names.append(filename)
-
-    print("Uploaded files:", file_names)  # Debugging line
-    return jsonify({"message": "Files uploaded successfully", "files": file_names})
+        hashes[filename] = digest
+    db.session.commit()
+    # Layouts carry the manifest of the videos they use
+    invalidate_layout_cache()
+
+    logger.debug("Uploaded files: %s", file_names)
+    return jsonify(
+        {"message": "Files uploaded successfully", "files": file_names, "hashes": hashes}
+    )
+
+
+# Content-hash ETags for uploads, keyed by (path, mtime, size) so each file is
+# only hashed again after it changes. Unlike werkzeug's mtime-based default
+# they survive copying the uploads folder to another server.
+_media_etags = {}
+_media_etags_lock = threading.Lock()
+
+
+def media_etag(path):
+    stat = os.stat(path)
+    key = (path, stat.st_mtime_ns, stat.st_size)
+    with _media_etags_lock:
+        etag = _media_etags.get(key)
+    if etag is None:
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(chunk)
+        etag = digest.hexdigest()[:32]
+        with _media_etags_lock:
+            _media_etags[key] = etag
+    return etag
 
 
 @app.route("/uploads/<filename>")
 def uploaded_file(filename):
-    return send_from_directory(app.config["UPLOAD_FOLDER"], filename)
+    # conditional=True answers Range requests with 206 and If-None-Match /
+    # If-Modified-Since with 304. The body goes out through the server's
+    # wsgi.file_wrapper, so waitress streams it from the file rather than
+    # through Python in chunks.
+    entry = lookup_media(filename)
+    if entry is not None:
+        # Indexed uploads never change content, so browsers can keep them
+        digest, path = entry
+        response = send_file(
+            path,
+            mimetype=mimetypes.guess_type(filename)[0],
+            download_name=filename,
+            conditional=True,
+            etag=digest,
+            max_age=365 * 24 * 3600,
+        )
+        response.cache_control.immutable = True
+    else:
+        # Files copied into uploads/ by hand, before setup_db.py indexes them
+        path = safe_join(upload_root(), filename)
+        if path is None or not os.path.isfile(path):
+            abort(404)
+        response = send_from_directory(
+            app.config["UPLOAD_FOLDER"],
+            filename,
+            conditional=True,
+            etag=media_etag(path),
+            max_age=app.config["UPLOAD_MAX_AGE"],
+        )
+    response.cache_control.public = True
+    response.headers["Accept-Ranges"] = "bytes"
+    return response
 
 
 @app.route("/save_admin_locations", methods=["POST"])
@@ -166,7 +483,11 @@ def save_admin_locations():
         return redirect(url_for("login"))
 
     data = request.get_json()
-    print("Received data:", data)  # Add this line to check received data
+    logger.debug(
+        "save_admin_locations question=%r locations=%d",
+        data.get("question"),
+        len(data.get("locations", [])),
+    )
     admin_id = session["user_id"]
 
     question = data.get("question")  # Get the question from the root level
@@ -180,10 +501,27 @@ def save_admin_locations():
             admin_id=admin_id,
         )
         db.session.add(location)
+    # Distances in the dashboard are measured from the new layout, and new
+    # participants are dealt layouts from a new pool if its stimuli changed
+    db.session.flush()
+    aggregates.refresh_question(db.session, question)
+    counterbalance.refresh_pool(db.session)
     db.session.commit()
+    invalidate_layout_cache()
     return jsonify({"message": "Admin locations saved successfully"})
 
 
+@app.route("/admin/aggregates")
+def admin_aggregates():
+    if "user_id" not in session or not session.get("is_admin", False):
+        return redirect(url_for("login"))
+
+    # Reads location_aggregate only: one row per stimulus, however many
+    # responses there are
+    question = request.args.get("question")
+    return jsonify({"stimuli": aggregates.summarize(db.session, question)})
+
+
 @app.route("/set_start_time", methods=["POST"])
 def set_start_time():
     if "user_id" not in session:
@@ -228,68 +566,352 @@ def save_end_time():
     return jsonify({"message": "End time recorded for all videos"})
 
 
+def validate_submission(data):
+    # Returns (question, locations) or raises ValueError
+    if not isinstance(data, dict):
+        raise ValueError("expected a JSON object")
+    locations = data.get("locations", [])
+    if not isinstance(locations, list):
+        raise ValueError("locations must be a list")
+    for loc in locations:
+        if not isinstance(loc, dict) or not loc.get("src"):
+            raise ValueError("every location needs a src")
+        for key in ("final_x", "final_y"):
+            value = loc.get(key)
+            if value is not None and not isinstance(value, (int, float)):
+                raise ValueError(f"{key} must be a number")
+    return data.get("question"), locations
+
+
+def store_submission(submission_id, demographics, question, locations, submitted_at=None,
+                     layout_id=None):
+    # Adds one participant's Demographics row and all of their locations to
+    # the current transaction; the caller commits. A submission_id that is
+    # already stored (a repeated Save, or a replayed journal entry) is left
+    # alone and False returned.
+    demographic_id = db.session.execute(
+        sqlite_insert(Demographics).values(
+            participant_id=demographics["participant_id"],
+            age=demographics["age"],
+            gender=demographics["gender"],
+            education=demographics["education"],
+            handedness=demographics["handedness"],
+            ethnicity=demographics["ethnicity"],
+            submission_id=submission_id,
+            submitted_at=submitted_at or datetime.utcnow(),
+            layout_id=layout_id,
+        )
+        .on_conflict_do_nothing(index_elements=["submission_id"])
+        .returning(Demographics.id)
+    ).scalar()
+    if demographic_id is None:
+        return False
+
+    # One executemany instead of one ORM object per location
+    if locations:
+        db.session.execute(
+            insert(UserLocation),
+            [
+                {
+                    "final_x": loc.get("final_x"),
+                    "final_y": loc.get("final_y"),
+                    "src": loc["src"],
+                    "question": question,
+                    "user_id": demographic_id,
+                }
+                for loc in locations
+            ],
+        )
+        # Distances from where this participant's stimuli started
+        totals = aggregates.accumulate(
+            {}, question, locations, aggregates.start_positions(db.session, question, layout_id)
+        )
+        aggregates.apply(db.session, totals)
+    return True
+
+
+def store_submission_batch(payloads):
+    # Write-behind drain: a whole batch in one transaction. Only the first
+    # entry per submission_id is stored; later ones in the batch, and any
+    # stored by an earlier attempt, are skipped by store_submission.
+    with app.app_context():
+        seen = set()
+        for p in payloads:
+            if p["submission_id"] in seen:
+                continue
+            seen.add(p["submission_id"])
+            # Journal entries carry the time the participant submitted
+            submitted_at = p.get("submitted_at")
+            store_submission(
+                p["submission_id"],
+                p["demographics"],
+                p["question"],
+                p["locations"],
+                datetime.fromisoformat(submitted_at) if submitted_at else None,
+                p.get("layout_id"),
+            )
+        db.session.commit()
+
+
+submission_queue = None
+submission_writer = None
+_writer_lock = threading.Lock()
+if app.config["WRITE_BEHIND"]:
+    submission_queue = SubmissionQueue(app.config["WRITE_BEHIND_QUEUE"])
+
+
+def start_write_behind():
+    # Starts the background writer, which first replays anything left in the
+    # journal from a previous run. Called by waitress_run.py at startup and on
+    # the first request otherwise, so scripts importing app don't start it.
+    global submission_writer
+    if submission_queue is None or submission_writer is not None:
+        return
+    with _writer_lock:
+        if submission_writer is None and app.config["WRITE_BEHIND_OWNER"]:
+            # A locked or unavailable database is retried, never dead-lettered
+            submission_writer = Writer(
+                submission_queue,
+                store_submission_batch,
+                dead_letter_path=app.config["WRITE_BEHIND_DEAD_LETTER"],
+                transient=lambda error: isinstance(error, OperationalError),
+            )
+            submission_writer.start()
+
+
+def stop_write_behind():
+    # Stores what is left in the journal and stops the writer; prefork.py
+    # calls this when a worker shuts down
+    global submission_writer
+    with _writer_lock:
+        app.config["WRITE_BEHIND_OWNER"] = False
+        writer, submission_writer = submission_writer, None
+    if writer is not None:
+        writer.stop(drain=True)
+
+
+def after_fork(worker):
+    # Runs in each prefork.py worker before it serves. Pooled connections
+    # opened before the fork belong to the parent, so they are dropped
+    # without being closed and each worker opens its own; the same goes for
+    # the journal's per-thread connection. The other workers only append to
+    # the journal, and the writer in worker 0 picks their entries up within
+    # its polling interval.
+    with app.app_context():
+        db.engine.dispose(close=False)
+    if submission_queue is not None:
+        submission_queue.local = threading.local()
+    app.config["WRITE_BEHIND_OWNER"] = worker == 0
+
+
+@app.before_request
+def ensure_write_behind():
+    if (
+        submission_queue is not None
+        and submission_writer is None
+        and app.config["WRITE_BEHIND_OWNER"]
+    ):
+        start_write_behind()
+
+
 @app.route("/save_user_locations", methods=["POST"])
 def save_user_locations():
-    data = request.get_json()
-    print("Received data:", data)
-
-    question = data.get("question")
+    try:
+        question, locations = validate_submission(request.get_json(silent=True))
+    except ValueError as e:
+        return jsonify({"message": f"Invalid submission: {e}"}), 400
 
     demographics = session.get("demographics")
-    print("found", demographics)
+    logger.debug(
+        "save_user_locations question=%r locations=%d has_demographics=%s",
+        question,
+        len(locations),
+        bool(demographics),
+    )
     if demographics:
-        db.session.add(
-            Demographics(
-                participant_id=demographics["participant_id"],
-                age=demographics["age"],
-                gender=demographics["gender"],
-                education=demographics["education"],
-                handedness=demographics["handedness"],
-                ethnicity=demographics["ethnicity"],
+        submission_id = session.get("submission_id") or str(uuid.uuid4())
+        if submission_queue is not None:
+            submission_queue.enqueue(
+                {
+                    "submission_id": submission_id,
+                    "demographics": demographics,
+                    "question": question,
+                    "locations": locations,
+                    "submitted_at": datetime.utcnow().isoformat(),
+                    "layout_id": session.get("layout_id"),
+                }
             )
-        )
-
-        for loc in data["locations"]:
-            location = UserLocation(
-                final_x=loc.get("final_x"),
-                final_y=loc.get("final_y"),
-                src=loc["src"],
-                question=question,
-                user_id=demographics["participant_id"],
+        else:
+            store_submission(
+                submission_id,
+                demographics,
+                question,
+                locations,
+                layout_id=session.get("layout_id"),
             )
-            db.session.add(location)
-        db.session.commit()
+            db.session.commit()
         session.clear()
     else:
-        print("unable to find local storage demographics data")
-        redirect(url_for("/"))
+        # The session expired or the demographics step was skipped; the page
+        # follows the redirect back to the start
+        logger.warning("unable to find local storage demographics data")
+        return redirect(url_for("demographics"))
     # Redirect to the end.html page after saving the data
     return redirect(url_for("end"))
 
 
+@app.route("/save_trajectory", methods=["POST"])
+def save_trajectory():
+    submission_id = session.get("submission_id")
+    if not submission_id:
+        return jsonify({"message": "No participant session"}), 401
+
+    if (request.content_length or 0) > MAX_BATCH_BYTES:
+        return jsonify({"message": "Trajectory batch too large"}), 413
+    payload = request.get_data(cache=False)
+    try:
+        page, seq, samples, _ = parse_batch(payload)
+    except TrajectoryError as e:
+        return jsonify({"message": f"Invalid trajectory batch: {e}"}), 400
+
+    # Counted on the (submission_id, page, seq) unique index
+    stored = TrajectoryBatch.query.filter_by(submission_id=submission_id).count()
+    if stored >= app.config["TRAJECTORY_MAX_BATCHES"]:
+        return jsonify({"message": "Too many trajectory batches"}), 429
+
+    # A batch the browser sent twice is stored once
+    db.session.execute(
+        insert(TrajectoryBatch)
+        .prefix_with("OR IGNORE")
+        .values(
+            submission_id=submission_id,
+            page=page,
+            seq=seq,
+            samples=samples,
+            data=compress_batch(payload),
+        )
+    )
+    db.session.commit()
+    return "", 204
+
+
 @app.route("/end")
 def end():
     return render_template("end.html")
 
 
-@app.route("/load_admin_locations", methods=["POST"])
+@app.route("/healthz")
+def healthz():
+    # Checked by prefork.py on each worker's private port
+    db.session.execute(text("SELECT 1"))
+    response = jsonify({"status": "ok", "pid": os.getpid()})
+    response.headers["Cache-Control"] = "no-store"
+    return response
+
+
+# Serialized layouts, keyed by (admin_id, question, layout_id); layout_id is
+# a participant's counterbalanced layout. Each entry records the layout
+# version it was built from; save_admin_locations bumps the version so
+# participants never see a stale layout and never hit the database twice.
+# Under prefork.py the save lands in one worker, so the version also includes
+# the identity of LAYOUT_VERSION_FILE, which a save replaces; every worker
+# sees that with one stat() per request.
+_layout_cache = {}
+_layout_version = 0
+_layout_lock = threading.Lock()
+
+
+def _layout_stamp():
+    try:
+        stat = os.stat(app.config["LAYOUT_VERSION_FILE"])
+    except FileNotFoundError:
+        return None
+    return (stat.st_ino, stat.st_mtime_ns)
+
+
+def invalidate_layout_cache():
+    global _layout_version
+    path = app.config["LAYOUT_VERSION_FILE"]
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # A new file (not a rewrite) so the inode changes even on coarse mtimes
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write(uuid.uuid4().hex)
+    os.replace(tmp_path, path)
+    with _layout_lock:
+        _layout_version += 1
+        _layout_cache.clear()
+
+
+def layout_media(loc_data):
+    # Manifest for every uploaded video in the layout, keyed by src, so the
+    # page can size and preload players before the files arrive
+    names = {}
+    for loc in loc_data:
+        if loc["src"]:
+            names[os.path.basename(urlsplit(loc["src"]).path)] = loc["src"]
+    if not names:
+        return {}
+    media = MediaFile.query.filter(MediaFile.name.in_(list(names))).all()
+    return {names[m.name]: m.manifest() for m in media}
+
+
+def get_layout(admin_id=None, question=None, layout_id=None):
+    key = (admin_id, question, layout_id)
+    stamp = _layout_stamp()
+    with _layout_lock:
+        version = (_layout_version, stamp)
+        entry = _layout_cache.get(key)
+    if entry is not None and entry[0] == version:
+        return entry
+
+    # A participant's counterbalanced layout, or the admin layout
+    loc_data = None
+    if layout_id is not None:
+        loc_data = counterbalance.load_locations(db.session, layout_id)
+    if loc_data is None:
+        query = AdminLocation.query
+        if admin_id is not None:
+            query = query.filter_by(admin_id=admin_id)
+        if question is not None:
+            query = query.filter_by(question=question)
+
+        loc_data = [
+            {
+                "initial_x": loc.initial_x,
+                "initial_y": loc.initial_y,
+                "src": loc.src,
+                "question": loc.question,
+            }
+            for loc in query.all()
+        ]
+    body = json.dumps(
+        {"locations": loc_data, "media": layout_media(loc_data)}, separators=(",", ":")
+    ).encode()
+    entry = (version, body, hashlib.sha256(body).hexdigest()[:32])
+
+    with _layout_lock:
+        # Only keep it if no save happened while we were reading
+        if version == (_layout_version, _layout_stamp()):
+            _layout_cache[key] = entry
+    return entry
+
+
+@app.route("/load_admin_locations", methods=["GET", "POST"])
 def load_admin_locations():
-    if session.get("is_admin", False):
-        user_id = session["user_id"]
-        locations = AdminLocation.query.filter_by(admin_id=user_id).all()
-    else:
-        locations = AdminLocation.query.all()
+    admin_id = session["user_id"] if session.get("is_admin", False) else None
+    question = request.args.get("question")
+    # Participants get the layout dealt to them at the demographics step
+    layout_id = session.get("layout_id") if admin_id is None and question is None else None
 
-    loc_data = [
-        {
-            "initial_x": loc.initial_x,
-            "initial_y": loc.initial_y,
-            "src": loc.src,
-            "question": loc.question,
-        }
-        for loc in locations
-    ]
-    return jsonify({"locations": loc_data})
+    _, body, etag = get_layout(admin_id, question, layout_id)
+
+    response = Response(body, mimetype="application/json")
+    response.set_etag(etag)
+    # Clients may keep a copy but must revalidate; GETs with a matching
+    # If-None-Match get a 304 without a body
+    response.headers["Cache-Control"] = "private, no-cache"
+    return response.make_conditional(request)
 
 
 @app.route("/load_user_locations")
@@ -306,5 +928,113 @@ def load_user_locations():
     return jsonify({"locations": loc_data})
 
 
+RESPONSE_COLUMNS = (
+    "id",
+    "question",
+    "src",
+    "final_x",
+    "final_y",
+    "demographics_id",
+    "participant_id",
+    "age",
+    "gender",
+    "education",
+    "handedness",
+    "ethnicity",
+    "submitted_at",
+)
+RESPONSES_PAGE_SIZE = 5000
+
+
+def response_pages(engine, filters, after_id=0, limit=None, page_size=RESPONSES_PAGE_SIZE):
+    # Yields pages of response rows (location joined with demographics) in id
+    # order. Each page is its own short query starting after the last id seen
+    # (keyset pagination), so neither the database nor this process ever
+    # holds more than one page and a read transaction never stays open.
+    conditions = ["u.id > :after_id"]
+    params = {}
+    # With question alone the (question, src) index returns rows in src
+    # order, and every page would sort everything left; the unary + keeps
+    # SQLite walking the primary key instead
+    question_column = "u.question" if filters.get("src") is not None else "+u.question"
+    for column, op, name in (
+        (question_column, "=", "question"),
+        ("u.src", "=", "src"),
+        ("d.submitted_at", ">=", "since"),
+        ("d.submitted_at", "<", "until"),
+    ):
+        if filters.get(name) is not None:
+            conditions.append(f"{column} {op} :{name}")
+            params[name] = filters[name]
+    query = text(
+        "SELECT u.id, u.question, u.src, u.final_x, u.final_y, d.id, d.participant_id, "
+        "d.age, d.gender, d.education, d.handedness, d.ethnicity, d.submitted_at "
+        "FROM user_location u JOIN demographics d ON d.id = u.user_id "
+        f"WHERE {' AND '.join(conditions)} ORDER BY u.id LIMIT :page_size"
+    )
+    remaining = limit
+    while remaining is None or remaining > 0:
+        size = page_size if remaining is None else min(page_size, remaining)
+        with engine.connect() as conn:
+            rows = conn.execute(query, dict(params, after_id=after_id, page_size=size)).all()
+        if not rows:
+            return
+        yield rows
+        after_id = rows[-1][0]
+        if remaining is not None:
+            remaining -= len(rows)
+        if len(rows) < size:
+            return
+
+
+def _parse_time(value):
+    # Raises ValueError for anything that isn't an ISO 8601 time
+    if value is None:
+        return None
+    parsed = datetime.fromisoformat(value)
+    # Times are stored as naive UTC; an offset is converted rather than dropped
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    # Stored the way SQLAlchemy writes DateTime to SQLite, so comparisons
+    # between the strings order correctly
+    return parsed.strftime("%Y-%m-%d %H:%M:%S.%f")
+
+
+@app.route("/admin/responses")
+def admin_responses():
+    if "user_id" not in session or not session.get("is_admin", False):
+        return redirect(url_for("login"))
+
+    # Newline-delimited JSON, one response per line. Resume an interrupted
+    # download with ?after=<id of the last line received>.
+    try:
+        after_id = int(request.args.get("after", 0))
+        limit = request.args.get("limit")
+        limit = None if limit is None else int(limit)
+        if limit is not None and limit < 1:
+            raise ValueError("limit must be at least 1")
+        filters = {
+            "question": request.args.get("question"),
+            "src": request.args.get("src"),
+            "since": _parse_time(request.args.get("since")),
+            "until": _parse_time(request.args.get("until")),
+        }
+    except ValueError as e:
+        return jsonify({"message": f"Invalid parameter: {e}"}), 400
+
+    engine = db.engine
+
+    def generate():
+        for rows in response_pages(engine, filters, after_id, limit):
+            yield "".join(
+                json.dumps(dict(zip(RESPONSE_COLUMNS, row)), default=str) + "\n"
+                for row in rows
+            )
+
+    response = Response(generate(), mimetype="application/x-ndjson")
+    response.headers["Cache-Control"] = "no-store"
+    return response
+
+
 if __name__ == "__main__":
     app.run(debug=True)
@@ -0,0 +1,127 @@
+"""Query latency on user_location before and after the index migration.
+
+Builds a throwaway database with the pre-index schema, fills it with
+participant arrangements, times the lookups the app makes, then runs the
+migrations and times them again.
+
+    python benchmarks/bench_indexes.py [rows] [stimuli per participant]
+"""
+import os
+import random
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+_tmpdir = tempfile.mkdtemp()
+os.environ["SQLALCHEMY_DATABASE_URI"] = "sqlite:///" + os.path.join(_tmpdir, "bench.db")
+
+from sqlalchemy import text  # noqa: E402
+from app import app, db  # noqa: E402
+from migrations import run_migrations  # noqa: E402
+
+QUESTIONS = ["How similar are these faces?", "How similar are these expressions?"]
+
+QUERIES = {
+    # save_end_time
+    "user_id + src": (
+        "SELECT * FROM user_location WHERE user_id = :user_id AND src = :src LIMIT 1"
+    ),
+    # load_user_locations
+    "user_id": "SELECT final_x, final_y, src FROM user_location WHERE user_id = :user_id",
+    "question + src": (
+        "SELECT count(*) FROM user_location WHERE question = :question AND src = :src"
+    ),
+    "participant_id": "SELECT id FROM demographics WHERE participant_id = :participant_id",
+}
+
+
+def populate(conn, rows, stimuli):
+    participants = rows // stimuli
+    conn.execute(
+        text("INSERT INTO demographics (id, participant_id, age) VALUES (:id, :pid, 30)"),
+        [{"id": i, "pid": f"P{i:06d}"} for i in range(1, participants + 1)],
+    )
+    batch = []
+    for user_id in range(1, participants + 1):
+        question = QUESTIONS[user_id % len(QUESTIONS)]
+        for s in range(stimuli):
+            batch.append({
+                "x": random.uniform(50, 550),
+                "y": random.uniform(50, 550),
+                "src": f"/uploads/face_{s:03d}.mp4",
+                "q": question,
+                "u": user_id,
+            })
+        if len(batch) >= 50000:
+            _insert_locations(conn, batch)
+            batch = []
+    if batch:
+        _insert_locations(conn, batch)
+    return participants
+
+
+def _insert_locations(conn, batch):
+    conn.execute(
+        text(
+            "INSERT INTO user_location (final_x, final_y, src, question, user_id) "
+            "VALUES (:x, :y, :src, :q, :u)"
+        ),
+        batch,
+    )
+
+
+def time_queries(conn, participants, stimuli, repeats):
+    results = {}
+    for name, sql in QUERIES.items():
+        params = []
+        for _ in range(repeats):
+            user_id = random.randint(1, participants)
+            params.append({
+                "user_id": user_id,
+                "src": f"/uploads/face_{random.randrange(stimuli):03d}.mp4",
+                "question": random.choice(QUESTIONS),
+                "participant_id": f"P{user_id:06d}",
+            })
+        start = time.perf_counter()
+        for p in params:
+            conn.execute(text(sql), p).fetchall()
+        results[name] = (time.perf_counter() - start) / repeats * 1000
+    return results
+
+
+if __name__ == "__main__":
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    stimuli = int(sys.argv[2]) if len(sys.argv) > 2 else 40
+    random.seed(0)
+
+    with app.app_context():
+        # Start from the schema as it was before the index migration
+        for table in db.metadata.sorted_tables:
+            table.create(db.engine)
+        with db.engine.begin() as conn:
+            for table in db.metadata.sorted_tables:
+                for index in table.indexes:
+                    conn.exec_driver_sql(f"DROP INDEX {index.name}")
+            conn.exec_driver_sql("PRAGMA user_version = 1")
+
+        start = time.perf_counter()
+        with db.engine.begin() as conn:
+            participants = populate(conn, rows, stimuli)
+        print(f"loaded {participants * stimuli} rows in {time.perf_counter() - start:.1f}s")
+
+        with db.engine.connect() as conn:
+            before = time_queries(conn, participants, stimuli, repeats=20)
+
+        start = time.perf_counter()
+        run_migrations(db.engine, backup=False)
+        print(f"migration took {time.perf_counter() - start:.1f}s")
+
+        with db.engine.connect() as conn:
+            after = time_queries(conn, participants, stimuli, repeats=200)
+
+    print(f"{'query':<16}{'before ms':>12}{'after ms':>12}{'speedup':>10}")
+    for name in QUERIES:
+        print(f"{name:<16}{before[name]:>12.3f}{after[name]:>12.3f}{before[name] / after[name]:>9.0f}x")
@@ -0,0 +1,87 @@
+"""Rows per second for storing a submission: old per-object ORM loop vs
+store_submission, which /save_user_locations and the write-behind writer call
+(demographics insert, executemany of the locations and the location_aggregate
+update).
+
+    python benchmarks/bench_save_user_locations.py [submissions] [locations]
+"""
+import os
+import sys
+import tempfile
+import time
+import uuid
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+_tmpdir = tempfile.mkdtemp()
+os.environ["SQLALCHEMY_DATABASE_URI"] = "sqlite:///" + os.path.join(_tmpdir, "bench.db")
+
+from app import app, db, Demographics, LocationAggregate, UserLocation, store_submission  # noqa: E402
+
+DEMOGRAPHICS = {
+    "participant_id": "bench",
+    "age": 30,
+    "gender": "other",
+    "education": "none",
+    "handedness": "right",
+    "ethnicity": "none",
+}
+
+
+def make_locations(n):
+    return [
+        {"final_x": 100.0 + i, "final_y": 200.0 + i, "src": f"/uploads/clip_{i}.mp4"}
+        for i in range(n)
+    ]
+
+
+def orm_loop(locations, question):
+    demographic = Demographics(**DEMOGRAPHICS)
+    db.session.add(demographic)
+    db.session.flush()
+    for loc in locations:
+        db.session.add(
+            UserLocation(
+                final_x=loc.get("final_x"),
+                final_y=loc.get("final_y"),
+                src=loc["src"],
+                question=question,
+                user_id=demographic.id,
+            )
+        )
+    db.session.commit()
+
+
+def current(locations, question):
+    store_submission(uuid.uuid4().hex, DEMOGRAPHICS, question, locations)
+    db.session.commit()
+
+
+def run(fn, submissions, locations):
+    start = time.perf_counter()
+    for _ in range(submissions):
+        fn(locations, "bench question")
+    elapsed = time.perf_counter() - start
+    return submissions * len(locations) / elapsed, elapsed
+
+
+if __name__ == "__main__":
+    submissions = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    n_locations = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    locations = make_locations(n_locations)
+
+    with app.app_context():
+        db.create_all()
+        results = {}
+        for name, fn in (("orm loop", orm_loop), ("store", current)):
+            db.session.execute(UserLocation.__table__.delete())
+            db.session.execute(Demographics.__table__.delete())
+            db.session.execute(LocationAggregate.__table__.delete())
+            db.session.commit()
+            results[name] = run(fn, submissions, locations)
+
+    print(f"{submissions} submissions x {n_locations} locations")
+    for name, (rate, elapsed) in results.items():
+        print(f"{name:>10}: {rate:10.0f} rows/s  ({elapsed:.2f}s)")
+    print(f"speedup: {results['store'][0] / results['orm loop'][0]:.1f}x")
@@ -0,0 +1,351 @@
+"""Load test for the participant flow against a local waitress server.
+
+Each simulated participant goes through the same requests as the browser:
+
+    POST /  ->  GET /user  ->  GET /load_admin_locations  ->  POST /save_user_locations
+
+The server runs in a subprocess on a throwaway SQLite database seeded with an
+admin layout and a pool of counterbalanced layouts built from it, so every
+participant is dealt a layout and saves the stimuli it was served. Results
+are printed per endpoint (p50/p95/p99 latency, error rate) and can be written
+as JSON and checked against a stored baseline:
+
+    python benchmarks/loadtest.py --participants 500 --concurrency 50
+    python benchmarks/loadtest.py --output results.json --baseline benchmarks/baseline.json
+    python benchmarks/loadtest.py --save-baseline benchmarks/baseline.json
+    python benchmarks/loadtest.py --workers 4    # prefork mode, see prefork.py
+
+Exits with status 1 when a result regresses past --tolerance.
+"""
+import argparse
+import http.cookiejar
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+ENDPOINTS = [
+    "POST /",
+    "GET /user",
+    "GET /load_admin_locations",
+    "POST /save_user_locations",
+]
+
+SERVER_CODE = """
+import sys
+from app import app
+from waitress import serve
+serve(app, host="127.0.0.1", port=int(sys.argv[1]), threads=app.config["WAITRESS_THREADS"])
+"""
+
+
+class NoRedirect(urllib.request.HTTPRedirectHandler):
+    # Time every request on its own instead of following the 302s
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        return None
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def seed_database(db_uri, stimuli):
+    os.environ["SQLALCHEMY_DATABASE_URI"] = db_uri
+    sys.path.insert(0, ROOT)
+    from app import app, db, Admin, AdminLocation, generate_password_hash
+    import counterbalance
+
+    with app.app_context():
+        db.create_all()
+        admin = Admin(username="admin", password=generate_password_hash("admin"))
+        db.session.add(admin)
+        db.session.flush()
+        for i in range(stimuli):
+            db.session.add(
+                AdminLocation(
+                    initial_x=60.0 + (i * 37) % 480,
+                    initial_y=60.0 + (i * 53) % 480,
+                    src=f"/uploads/face_{i:03d}.mp4",
+                    question="How similar are these faces?",
+                    admin_id=admin.id,
+                )
+            )
+        db.session.flush()
+        # As save_admin_locations does
+        counterbalance.refresh_pool(db.session, seed=0)
+        db.session.commit()
+
+
+def start_server(command, port, env, log_path):
+    # Server output goes to a file so a chatty server can't fill a pipe and stall
+    with open(log_path, "wb") as log:
+        process = subprocess.Popen(
+            command + [str(port)], cwd=ROOT, env=env, stdout=log, stderr=subprocess.STDOUT
+        )
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        if process.poll() is not None:
+            with open(log_path) as log:
+                raise RuntimeError("server exited: " + log.read())
+        # Ready once a worker answers, not just once the socket is bound
+        try:
+            with urllib.request.urlopen(f"http://127.0.0.1:{port}/healthz", timeout=0.5):
+                return process
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError("server did not start listening")
+
+
+class Recorder:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {name: [] for name in ENDPOINTS}
+        self.errors = {name: 0 for name in ENDPOINTS}
+
+    def record(self, name, seconds, ok):
+        with self.lock:
+            self.latencies[name].append(seconds)
+            if not ok:
+                self.errors[name] += 1
+
+    def fail(self, name):
+        # A response that came back but couldn't be used
+        with self.lock:
+            self.errors[name] += 1
+
+
+def request(opener, recorder, name, url, data=None, headers=None):
+    req = urllib.request.Request(url, data=data, headers=headers or {})
+    start = time.perf_counter()
+    ok = True
+    body = None
+    try:
+        with opener.open(req, timeout=60) as response:
+            body = response.read()
+    except urllib.error.HTTPError as e:
+        e.read()
+        # Redirects are the expected answer for the form posts
+        ok = 300 <= e.code < 400
+    except Exception:
+        ok = False
+    recorder.record(name, time.perf_counter() - start, ok)
+    return ok, body
+
+
+def participant(base_url, recorder, n):
+    opener = urllib.request.build_opener(
+        NoRedirect, urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar())
+    )
+    form = urllib.parse.urlencode({
+        "participant_id": f"load-{n}",
+        "age": "30",
+        "gender": "other",
+        "education": "none",
+        "handedness": "right",
+        "ethnicity": "none",
+    }).encode()
+    if not request(opener, recorder, "POST /", base_url + "/", form)[0]:
+        return
+    request(opener, recorder, "GET /user", base_url + "/user")
+    ok, layout = request(
+        opener, recorder, "GET /load_admin_locations", base_url + "/load_admin_locations"
+    )
+    if not ok:
+        return
+    # Save what the page would: the served stimuli, under the served question
+    try:
+        served = json.loads(layout)["locations"]
+        question = served[0]["question"]
+    except (ValueError, TypeError, KeyError, IndexError):
+        recorder.fail("GET /load_admin_locations")
+        return
+    locations = [
+        {"final_x": 100.0 + i, "final_y": 300.0 - i, "src": loc["src"]}
+        for i, loc in enumerate(served)
+    ]
+    body = json.dumps({"question": question, "locations": locations})
+    request(
+        opener,
+        recorder,
+        "POST /save_user_locations",
+        base_url + "/save_user_locations",
+        body.encode(),
+        {"Content-Type": "application/json"},
+    )
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(q * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+
+def summarize(recorder, elapsed, config):
+    endpoints = {}
+    total_requests = 0
+    for name in ENDPOINTS:
+        values = sorted(recorder.latencies[name])
+        count = len(values)
+        total_requests += count
+        endpoints[name] = {
+            "count": count,
+            "errors": recorder.errors[name],
+            "error_rate": recorder.errors[name] / count if count else 0.0,
+            "mean_ms": sum(values) / count * 1000 if count else 0.0,
+            "p50_ms": percentile(values, 0.50) * 1000,
+            "p95_ms": percentile(values, 0.95) * 1000,
+            "p99_ms": percentile(values, 0.99) * 1000,
+        }
+    completed = len(recorder.latencies["POST /save_user_locations"])
+    return {
+        "config": config,
+        "host": {"python": platform.python_version(), "cpus": os.cpu_count()},
+        "duration_s": elapsed,
+        "throughput": {
+            "participants_per_s": completed / elapsed,
+            "requests_per_s": total_requests / elapsed,
+        },
+        "endpoints": endpoints,
+    }
+
+
+def print_results(results):
+    print(
+        f"{results['config']['participants']} participants, "
+        f"{results['config']['concurrency']} concurrent, "
+        f"{results['config'].get('workers', 1)} workers, {results['duration_s']:.1f}s: "
+        f"{results['throughput']['participants_per_s']:.1f} participants/s, "
+        f"{results['throughput']['requests_per_s']:.1f} requests/s"
+    )
+    print(f"{'endpoint':<30}{'count':>7}{'err%':>7}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}")
+    for name, e in results["endpoints"].items():
+        print(
+            f"{name:<30}{e['count']:>7}{e['error_rate'] * 100:>7.1f}"
+            f"{e['p50_ms']:>9.1f}{e['p95_ms']:>9.1f}{e['p99_ms']:>9.1f}"
+        )
+
+
+def compare(results, baseline, tolerance):
+    # Returns a list of human-readable regressions
+    regressions = []
+    base_rate = baseline["throughput"]["participants_per_s"]
+    rate = results["throughput"]["participants_per_s"]
+    if rate < base_rate * (1 - tolerance):
+        regressions.append(f"throughput {rate:.1f}/s < baseline {base_rate:.1f}/s")
+    for name, e in results["endpoints"].items():
+        base = baseline["endpoints"].get(name)
+        if base is None:
+            continue
+        if e["p95_ms"] > base["p95_ms"] * (1 + tolerance):
+            regressions.append(f"{name} p95 {e['p95_ms']:.1f}ms > baseline {base['p95_ms']:.1f}ms")
+        if e["error_rate"] > base["error_rate"] + 0.01:
+            regressions.append(
+                f"{name} error rate {e['error_rate']:.1%} > baseline {base['error_rate']:.1%}"
+            )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--participants", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--stimuli", type=int, default=20, help="videos in the layout")
+    parser.add_argument("--threads", type=int, default=8, help="waitress threads")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="server processes; more than one runs waitress_run.py in prefork mode")
+    parser.add_argument("--output", help="write results as JSON to this file")
+    parser.add_argument("--baseline", help="compare against this results file")
+    parser.add_argument("--save-baseline", help="write results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="allowed relative slowdown before failing (default 0.25)")
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+    db_uri = "sqlite:///" + os.path.join(tmpdir, "loadtest.db")
+    seed_database(db_uri, args.stimuli)
+
+    env = dict(
+        os.environ,
+        SQLALCHEMY_DATABASE_URI=db_uri,
+        WAITRESS_THREADS=str(args.threads),
+        PYTHONPATH=ROOT,
+    )
+    if args.workers > 1:
+        command = [
+            sys.executable, os.path.join(ROOT, "waitress_run.py"),
+            "--host", "127.0.0.1", "--workers", str(args.workers), "--port",
+        ]
+    else:
+        command = [sys.executable, "-c", SERVER_CODE]
+    port = free_port()
+    server = start_server(command, port, env, os.path.join(tmpdir, "server.log"))
+    base_url = f"http://127.0.0.1:{port}"
+
+    recorder = Recorder()
+    failures = []
+    try:
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            futures = [
+                pool.submit(participant, base_url, recorder, n) for n in range(args.participants)
+            ]
+            # Anything a participant raised outside a request would otherwise
+            # vanish with its future
+            for future in futures:
+                try:
+                    future.result()
+                except Exception as e:
+                    failures.append(e)
+        elapsed = time.perf_counter() - start
+    finally:
+        server.terminate()
+        server.wait()
+
+    config = {
+        "participants": args.participants,
+        "concurrency": args.concurrency,
+        "stimuli": args.stimuli,
+        "threads": args.threads,
+        "workers": args.workers,
+    }
+    results = summarize(recorder, elapsed, config)
+    print_results(results)
+
+    for path in (args.output, args.save_baseline):
+        if path:
+            with open(path, "w") as f:
+                json.dump(results, f, indent=2)
+
+    if failures:
+        print(f"{len(failures)} participants failed outside a request, first: {failures[0]!r}")
+        sys.exit(1)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print("Regressions against", args.baseline)
+            for line in regressions:
+                print("  " + line)
+            sys.exit(1)
+        print("No regressions against", args.baseline)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+"""Concurrent /save_user_locations submissions against a throwaway SQLite file.
+
+Runs the same load once per SQLite profile (see sqlite_profile.py) and once
+more in write-behind mode, each in a fresh process because the settings are
+applied when app.py is imported, and reports write throughput, submission
+latency and "database is locked" failures.
+
+    python benchmarks/stress_concurrent_submissions.py [submitters] [submissions each]
+"""
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STIMULI = 40
+
+
+def worker(app, submissions, results, lock):
+    client = app.test_client()
+    locations = [
+        {"final_x": 100.0 + i, "final_y": 100.0 + i, "src": f"/uploads/face_{i:03d}.mp4"}
+        for i in range(STIMULI)
+    ]
+    ok = locked = other = 0
+    latencies = []
+    for n in range(submissions):
+        client.post("/", data={
+            "participant_id": f"stress-{threading.get_ident()}-{n}",
+            "age": "30",
+            "gender": "other",
+            "education": "none",
+            "handedness": "right",
+            "ethnicity": "none",
+        })
+        start = time.perf_counter()
+        try:
+            response = client.post(
+                "/save_user_locations", json={"question": "stress", "locations": locations}
+            )
+            if response.status_code < 400:
+                ok += 1
+            else:
+                other += 1
+        except Exception as e:
+            if "database is locked" in str(e):
+                locked += 1
+            else:
+                other += 1
+        latencies.append(time.perf_counter() - start)
+    with lock:
+        results["ok"] += ok
+        results["locked"] += locked
+        results["other"] += other
+        results["latencies"].extend(latencies)
+
+
+def run_profile(submitters, submissions):
+    sys.path.insert(0, ROOT)
+    from app import app, db
+    import app as app_module
+
+    app.config["PROPAGATE_EXCEPTIONS"] = True
+    with app.app_context():
+        db.create_all()
+
+    results = {"ok": 0, "locked": 0, "other": 0, "latencies": []}
+    lock = threading.Lock()
+    threads = [
+        threading.Thread(target=worker, args=(app, submissions, results, lock))
+        for _ in range(submitters)
+    ]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    if app_module.submission_writer is not None:
+        # Count write-behind submissions once they are in the database
+        app_module.submission_writer.stop(drain=True)
+    elapsed = time.perf_counter() - start
+
+    latencies = sorted(results.pop("latencies"))
+    results["seconds"] = elapsed
+    results["submissions_per_s"] = results["ok"] / elapsed
+    results["rows_per_s"] = results["ok"] * STIMULI / elapsed
+    results["p95_ms"] = latencies[int(len(latencies) * 0.95)] * 1000 if latencies else 0
+    print(json.dumps(results))
+
+
+if __name__ == "__main__":
+    submitters = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    submissions = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+
+    if os.getenv("STRESS_CHILD"):
+        run_profile(submitters, submissions)
+        sys.exit(0)
+
+    print(f"{submitters} submitters x {submissions} submissions, {STIMULI} locations each")
+    modes = (
+        ("default", {"SQLITE_PROFILE": "default"}),
+        ("performance", {"SQLITE_PROFILE": "performance"}),
+        ("write-behind", {"SQLITE_PROFILE": "performance", "WRITE_BEHIND": "1"}),
+    )
+    for label, settings in modes:
+        tmpdir = tempfile.mkdtemp()
+        env = dict(
+            os.environ,
+            STRESS_CHILD="1",
+            WAITRESS_THREADS=str(submitters),
+            SQLALCHEMY_DATABASE_URI="sqlite:///" + os.path.join(tmpdir, "stress.db"),
+            WRITE_BEHIND_QUEUE=os.path.join(tmpdir, "queue.db"),
+            **settings,
+        )
+        out = subprocess.run(
+            [sys.executable, __file__, str(submitters), str(submissions)],
+            env=env, capture_output=True, text=True, check=True,
+        ).stdout
+        r = json.loads(out.strip().splitlines()[-1])
+        print(
+            f"{label:>12}: {r['submissions_per_s']:7.1f} submissions/s "
+            f"{r['rows_per_s']:9.0f} rows/s  p95 {r['p95_ms']:7.1f} ms  "
+            f"ok {r['ok']}  locked {r['locked']}  other errors {r['other']}"
+        )
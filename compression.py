@@ -0,0 +1,206 @@
+import gzip
+import hashlib
+import mimetypes
+import os
+import sys
+import threading
+
+from flask import abort, request, send_from_directory
+from werkzeug.utils import safe_join
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Response compression and static asset caching for the Flask app.
+#
+# Dynamic responses (pages, layout JSON) above a size threshold are
+# compressed per request with Brotli or gzip, whichever the client prefers.
+# Static files are never compressed per request: `python compression.py`
+# writes .gz (and, with the brotli package, .br) siblings next to them once
+# at deploy time, and the static route sends the best one the client accepts.
+#
+# url_for('static', ...) puts a hash of the file's content into the name
+# (js/scripts.3f2a9c1b.js), and a hashed URL is served as immutable for a
+# year, so repeat visits don't ask for it again until the file changes.
+
+COMPRESSIBLE_TYPES = (
+    "text/",
+    "application/json",
+    "application/javascript",
+    "application/x-ndjson",
+    "image/svg+xml",
+)
+PRECOMPRESS_EXTENSIONS = (".js", ".css", ".html", ".json", ".svg", ".txt")
+HASH_LENGTH = 8
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+
+
+def _encodings():
+    # Preferred first
+    available = [("gzip", ".gz")]
+    if brotli is not None:
+        available.insert(0, ("br", ".br"))
+    return available
+
+
+def compress(data, encoding, level):
+    if encoding == "br":
+        return brotli.compress(data, quality=min(level, 11))
+    return gzip.compress(data, compresslevel=level, mtime=0)
+
+
+def _accepted(encodings):
+    accept = request.accept_encodings
+    return [enc for enc in encodings if accept[enc[0]] > 0]
+
+
+class StaticManifest:
+    # Content hashes of static files, recomputed when a file changes
+    def __init__(self, folder):
+        self.folder = folder
+        self.lock = threading.Lock()
+        self.hashes = {}
+
+    def digest(self, filename):
+        path = os.path.join(self.folder, filename)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        key = (stat.st_mtime_ns, stat.st_size)
+        with self.lock:
+            entry = self.hashes.get(filename)
+        if entry is None or entry[0] != key:
+            with open(path, "rb") as f:
+                digest = hashlib.sha256(f.read()).hexdigest()[:HASH_LENGTH]
+            entry = (key, digest)
+            with self.lock:
+                self.hashes[filename] = entry
+        return entry[1]
+
+    def hashed_name(self, filename):
+        digest = self.digest(filename)
+        if digest is None:
+            return filename
+        stem, ext = os.path.splitext(filename)
+        return f"{stem}.{digest}{ext}"
+
+    def resolve(self, filename):
+        # Returns (real filename, hash matched) for a requested name
+        stem, ext = os.path.splitext(filename)
+        base, _, digest = stem.rpartition(".")
+        if base and len(digest) == HASH_LENGTH and not os.path.isfile(
+            os.path.join(self.folder, filename)
+        ):
+            original = base + ext
+            return original, self.digest(original) == digest
+        return filename, False
+
+
+def init_compression(app, min_size=1024, level=6):
+    manifest = StaticManifest(app.static_folder)
+    app.extensions["static_manifest"] = manifest
+
+    @app.url_defaults
+    def hashed_static_url(endpoint, values):
+        if endpoint == "static" and "filename" in values:
+            values["filename"] = manifest.hashed_name(values["filename"])
+
+    def static_file(filename):
+        real_name, immutable = manifest.resolve(filename)
+        # A stale hash (a page cached from before a deploy) still gets the
+        # current file, just not marked immutable
+        max_age = IMMUTABLE_MAX_AGE if immutable else None
+        path = safe_join(app.static_folder, real_name)
+        if path is None:
+            abort(404)
+        response = None
+        if os.path.isfile(path):
+            mtime = os.path.getmtime(path)
+            for encoding, ext in _accepted(_encodings()):
+                sibling = path + ext
+                if os.path.isfile(sibling) and os.path.getmtime(sibling) >= mtime:
+                    response = send_from_directory(
+                        app.static_folder,
+                        real_name + ext,
+                        mimetype=mimetypes.guess_type(real_name)[0],
+                        max_age=max_age,
+                    )
+                    response.headers["Content-Encoding"] = encoding
+                    break
+        if response is None:
+            response = send_from_directory(app.static_folder, real_name, max_age=max_age)
+        if immutable:
+            response.cache_control.public = True
+            response.cache_control.immutable = True
+        response.vary.add("Accept-Encoding")
+        return response
+
+    app.view_functions["static"] = static_file
+
+    @app.after_request
+    def compress_response(response):
+        if (
+            response.status_code != 200
+            or response.direct_passthrough
+            or response.is_streamed
+            or "Content-Encoding" in response.headers
+            or not (response.mimetype or "").startswith(COMPRESSIBLE_TYPES)
+        ):
+            return response
+        data = response.get_data()
+        if len(data) < min_size:
+            return response
+        response.vary.add("Accept-Encoding")
+        accepted = _accepted(_encodings())
+        if not accepted:
+            return response
+
+        encoding = accepted[0][0]
+        response.set_data(compress(data, encoding, level))
+        response.headers["Content-Encoding"] = encoding
+        # The encoded bytes differ, so a strong validator must not be shared
+        # with the identity response; a weak one still allows 304s
+        etag, weak = response.get_etag()
+        if etag and not weak:
+            response.set_etag(etag, weak=True)
+        return response
+
+
+def precompress(folder, level=9):
+    # Writes .gz/.br siblings for text assets that are missing or older than
+    # their source; returns the number of files written
+    written = 0
+    for root, _, filenames in os.walk(folder):
+        for filename in filenames:
+            if not filename.endswith(PRECOMPRESS_EXTENSIONS):
+                continue
+            path = os.path.join(root, filename)
+            with open(path, "rb") as f:
+                data = f.read()
+            mtime = os.path.getmtime(path)
+            for encoding, ext in _encodings():
+                target = path + ext
+                if os.path.exists(target) and os.path.getmtime(target) >= mtime:
+                    continue
+                encoded = compress(data, encoding, level if encoding == "gzip" else 11)
+                if len(encoded) >= len(data):
+                    continue
+                tmp_path = target + ".tmp"
+                with open(tmp_path, "wb") as f:
+                    f.write(encoded)
+                os.replace(tmp_path, target)
+                written += 1
+    return written
+
+
+if __name__ == "__main__":
+    folder = sys.argv[1] if len(sys.argv) > 1 else os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), "static"
+    )
+    count = precompress(folder)
+    print(f"Precompressed {count} files in {folder}")
+    if brotli is None:
+        print("brotli is not installed; wrote .gz files only")
@@ -0,0 +1,263 @@
+import argparse
+import csv
+import json
+import math
+import random
+import sys
+
+from sqlalchemy import create_engine, text
+
+from aggregates import reference_positions
+
+# Counterbalanced starting layouts for participants. The participant page
+# asks one question, the one of the first admin_location row, and saves every
+# stimulus on it under that question. A pool of participant layouts is
+# precomputed from that question's current admin layout (the most recent
+# admin_location per src, as in aggregates.py):
+#
+#   stimulus order   a row of a Williams Latin square over the stimuli; the
+#                    k-th stimulus starts in the k-th of n evenly spaced
+#                    slots on a ring inside the answer circle
+#   rotation         the ring of slots is turned by a random angle per layout
+#
+# Across a full pool every stimulus starts in every slot, and follows every
+# other stimulus, equally often; the pool size is a multiple of the square's
+# row count for that.
+#
+# Participants are dealt layouts in turn at the demographics step: one
+# UPDATE ... RETURNING on the single counterbalance_state row advances the
+# counter and yields the layout id, so assignment is atomic across prefork
+# workers and never scans anything. The id is stored in
+# demographics.layout_id. Only the question and its stimuli go into a pool,
+# not where the admin put them, so an admin save starts a new pool only when
+# it changes the question or adds or drops a stimulus; moving stimuli keeps
+# dealing the pool in progress, and its balance. Pools are only ever added,
+# never rewritten, so the starting position of every stimulus a participant
+# saw can be recovered:
+#
+#     python counterbalance.py --csv layouts.csv    one row per layout and src
+#     python counterbalance.py --status
+#     python counterbalance.py --rebuild [--seed N]
+
+# Centre and radius of the answer circle on the participant page
+# (areClipsWithinCircle in static/js/scripts.js); stimuli start on a smaller
+# ring so the whole player is inside it
+CENTER_X = 300.0
+CENTER_Y = 300.0
+RING_RADIUS = 200.0
+# At least this many layouts per pool, so rotations vary between
+# participants who get the same orders; at most MAX_POOL, beyond which the
+# balance is only approximate
+MIN_POOL = 256
+MAX_POOL = 4096
+
+ASSIGN = text(
+    # RETURNING sees the updated row, so assigned - 1 is this participant's number
+    "UPDATE counterbalance_state SET assigned = assigned + 1 WHERE id = 1 "
+    "RETURNING first_id + (assigned - 1) % size"
+)
+
+
+def williams_square(n):
+    # Rows of a balanced Latin square: each item appears once in every
+    # position and, over all rows, directly after every other item equally
+    # often. Odd n needs the mirrored rows as well.
+    if n == 0:
+        return [[]]
+    first = [0]
+    low, high = 1, n - 1
+    while len(first) < n:
+        first.append(low)
+        low += 1
+        if len(first) < n:
+            first.append(high)
+            high -= 1
+    rows = [[(item + shift) % n for item in first] for shift in range(n)]
+    if n % 2:
+        rows += [row[::-1] for row in rows]
+    return rows
+
+
+def pool_size(rows, min_pool=MIN_POOL, max_pool=MAX_POOL):
+    if rows > max_pool:
+        return max_pool
+    return rows * max(1, math.ceil(min_pool / rows))
+
+
+def current_layout(conn):
+    # (question, sorted srcs) of the question the participant page asks, or
+    # None before any admin layout was saved
+    row = conn.execute(text("SELECT question FROM admin_location ORDER BY id LIMIT 1")).first()
+    if row is None:
+        return None
+    srcs = sorted(reference_positions(conn, row[0]))
+    return (row[0], srcs) if srcs else None
+
+
+def build_pool(question, srcs, rng, size=None):
+    # Returns one list of locations per layout, as served by
+    # /load_admin_locations, in the order the participant gets them
+    square = williams_square(len(srcs))
+    if size is None:
+        size = pool_size(len(square))
+
+    pool = []
+    for slot in range(size):
+        row = square[slot % len(square)]
+        rotation = rng.uniform(0, 2 * math.pi)
+        locations = []
+        for position, index in enumerate(row):
+            angle = rotation + 2 * math.pi * position / len(row)
+            locations.append({
+                "initial_x": round(CENTER_X + RING_RADIUS * math.cos(angle), 1),
+                "initial_y": round(CENTER_Y + RING_RADIUS * math.sin(angle), 1),
+                "src": srcs[index],
+                "question": question,
+            })
+        pool.append(locations)
+    return pool
+
+
+def rebuild_pool(conn, seed=None, size=None):
+    # Adds a new pool from the current admin layout and starts handing it
+    # out; conn may be a Connection or an ORM Session, the caller commits.
+    # Returns (pool, size), or None when there is no admin layout yet.
+    layout = current_layout(conn)
+    if layout is None:
+        conn.execute(text("DELETE FROM counterbalance_state"))
+        return None
+    question, srcs = layout
+    pool = conn.execute(
+        text("SELECT coalesce(max(pool), 0) + 1 FROM counterbalance_layout")
+    ).scalar()
+    built = build_pool(question, srcs, random.Random(seed), size)
+    conn.execute(
+        text(
+            "INSERT INTO counterbalance_layout (pool, slot, question, locations) "
+            "VALUES (:pool, :slot, :question, :locations)"
+        ),
+        [
+            {
+                "pool": pool,
+                "slot": slot,
+                "question": question,
+                "locations": json.dumps(locations, separators=(",", ":")),
+            }
+            for slot, locations in enumerate(built)
+        ],
+    )
+    # The pool was inserted in one write transaction, so its ids are
+    # consecutive in slot order, which ASSIGN relies on
+    first_id = conn.execute(
+        text("SELECT min(id) FROM counterbalance_layout WHERE pool = :pool"), {"pool": pool}
+    ).scalar()
+    conn.execute(
+        text(
+            "INSERT INTO counterbalance_state (id, pool, first_id, size, assigned) "
+            "VALUES (1, :pool, :first_id, :size, 0) "
+            "ON CONFLICT (id) DO UPDATE SET pool = excluded.pool, "
+            "first_id = excluded.first_id, size = excluded.size, assigned = 0"
+        ),
+        {"pool": pool, "first_id": first_id, "size": len(built)},
+    )
+    return pool, len(built)
+
+
+def pool_layout(conn):
+    # (question, sorted srcs) of the pool being handed out, or None
+    row = conn.execute(
+        text(
+            "SELECT l.question, l.locations FROM counterbalance_state s "
+            "JOIN counterbalance_layout l ON l.id = s.first_id WHERE s.id = 1"
+        )
+    ).first()
+    if row is None:
+        return None
+    return row[0], sorted(loc["src"] for loc in json.loads(row[1]))
+
+
+def refresh_pool(conn, seed=None):
+    # rebuild_pool, but only if the question or its stimuli changed since
+    # the pool being handed out was built; returns None when it was kept
+    layout = current_layout(conn)
+    if layout is not None and layout == pool_layout(conn):
+        return None
+    return rebuild_pool(conn, seed)
+
+
+def assign(conn):
+    # The next participant's layout id, or None before any admin layout was
+    # saved; the caller commits
+    return conn.execute(ASSIGN).scalar()
+
+
+def load_locations(conn, layout_id):
+    row = conn.execute(
+        text("SELECT locations FROM counterbalance_layout WHERE id = :id"), {"id": layout_id}
+    ).first()
+    return json.loads(row[0]) if row else None
+
+
+def status(conn):
+    row = conn.execute(
+        text("SELECT pool, first_id, size, assigned FROM counterbalance_state WHERE id = 1")
+    ).first()
+    return dict(row._mapping) if row else None
+
+
+def write_csv(conn, path):
+    # One row per layout and stimulus; join demographics.layout_id on
+    # layout_id to get each participant's starting positions
+    columns = ("layout_id", "pool", "slot", "question", "src", "position",
+               "initial_x", "initial_y")
+    count = 0
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(columns)
+        rows = conn.execute(
+            text("SELECT id, pool, slot, question, locations "
+                 "FROM counterbalance_layout ORDER BY id")
+        )
+        for layout_id, pool, slot, question, locations in rows:
+            for position, loc in enumerate(json.loads(locations)):
+                writer.writerow((
+                    layout_id, pool, slot, question, loc["src"], position,
+                    loc["initial_x"], loc["initial_y"],
+                ))
+            count += 1
+    return count
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Counterbalanced participant layouts")
+    parser.add_argument("--db", default="sqlite:///instance/app.db")
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument("--csv", help="write every layout, one row per stimulus, here")
+    group.add_argument("--status", action="store_true")
+    group.add_argument("--rebuild", action="store_true",
+                       help="start a new pool from the current admin layout")
+    parser.add_argument("--seed", type=int, help="with --rebuild, seed the rotations")
+    args = parser.parse_args()
+
+    engine = create_engine(args.db)
+    if args.rebuild:
+        with engine.begin() as conn:
+            built = rebuild_pool(conn, args.seed)
+        if built is None:
+            print("No admin layout saved yet")
+            sys.exit(1)
+        print(f"Pool {built[0]}: {built[1]} layouts")
+    elif args.status:
+        with engine.connect() as conn:
+            state = status(conn)
+        if state is None:
+            print("No pool yet")
+            sys.exit(1)
+        print(
+            f"Pool {state['pool']}: {state['size']} layouts (ids {state['first_id']}-"
+            f"{state['first_id'] + state['size'] - 1}), {state['assigned']} participants assigned"
+        )
+    else:
+        with engine.connect() as conn:
+            count = write_csv(conn, args.csv)
+        print(f"{count} layouts saved to {args.csv}")
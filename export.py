@@ -1,30 +1,567 @@
 import os
-import pandas as pd
-from sqlalchemy import create_engine, inspect
+import csv
+import json
+import hashlib
+import argparse
+from sqlalchemy import bindparam, create_engine, inspect, text
+import xlsxwriter
 import sys
 
-def save_db_to_excel(db_uri, output_filename):
-    # Create an SQLAlchemy engine
-    engine = create_engine(db_uri)
-    
-    # Reflect the database tables
-    inspector = inspect(engine)
-    table_names = inspector.get_table_names()
-
-    # Ensure the export directory exists
-    export_folder = 'instance\export'
-    os.makedirs(export_folder, exist_ok=True)
-    
-    # Construct the full output path
-    output_path = os.path.join(export_folder, output_filename)
-
-    # Export each table to a separate sheet in the Excel file
-    with pd.ExcelWriter(output_path, engine='xlsxwriter') as writer:
+from snapshots import analysis_db
+
+EXPORT_FOLDER = os.path.join('instance', 'export')
+CHUNK_SIZE = 5000
+
+# Excel allows 1,048,576 rows per sheet; one of them is the header row
+EXCEL_MAX_ROWS = 1048576 - 1
+EXCEL_MAX_SHEET_NAME = 31
+
+FORMATS = ('xlsx', 'csv', 'ndjson', 'parquet')
+
+# Left out unless asked for by name: trajectory_batch holds compressed binary
+# drag paths, which spreadsheets and text formats can't carry; export those
+# with trajectories.py instead
+SKIPPED_TABLES = ('trajectory_batch',)
+
+# Tables exported incrementally, tracked by their autoincrement id
+INCREMENTAL_TABLES = ('demographics', 'user_location')
+# One state file per format, since csv, ndjson and parquet output can share
+# a folder and each has its own position
+STATE_FILENAME = '.watermarks.{fmt}.json'
+
+
+def stream_table(engine, table_name, chunk_size=CHUNK_SIZE, after_id=None):
+    # Yields (columns, rows) once per chunk; stream_results asks the driver for
+    # a server-side cursor so only chunk_size rows are ever buffered.
+    query = f'SELECT * FROM "{table_name}"'
+    params = {}
+    if after_id is not None:
+        query += ' WHERE id > :after_id ORDER BY id'
+        params['after_id'] = after_id
+    with engine.connect() as conn:
+        result = conn.execution_options(stream_results=True).execute(
+            text(query), params
+        )
+        columns = list(result.keys())
+        emitted = False
+        for partition in result.partitions(chunk_size):
+            emitted = True
+            yield columns, partition
+        if not emitted:
+            yield columns, []
+
+
+def _sheet_name(table_name, part):
+    if part == 1:
+        return table_name[:EXCEL_MAX_SHEET_NAME]
+    suffix = f'_{part}'
+    return table_name[:EXCEL_MAX_SHEET_NAME - len(suffix)] + suffix
+
+
+def write_excel(engine, table_names, output_path, chunk_size=CHUNK_SIZE):
+    # constant_memory flushes each row to disk as soon as the next one starts,
+    # so rows have to be written strictly in order, which is what we do.
+    workbook = xlsxwriter.Workbook(output_path, {
+        'constant_memory': True,
+        'default_date_format': 'yyyy-mm-dd hh:mm:ss',
+    })
+    try:
         for table_name in table_names:
-            query = f"SELECT * FROM {table_name}"
-            df = pd.read_sql(query, engine)
-            df.to_excel(writer, sheet_name=table_name, index=False)
+            part = 0
+            sheet = None
+            row_index = EXCEL_MAX_ROWS
+            for columns, rows in stream_table(engine, table_name, chunk_size):
+                if sheet is None:
+                    part += 1
+                    sheet = workbook.add_worksheet(_sheet_name(table_name, part))
+                    sheet.write_row(0, 0, columns)
+                    row_index = 0
+                for row in rows:
+                    if row_index == EXCEL_MAX_ROWS:
+                        # Table is bigger than one sheet, roll over to the next
+                        part += 1
+                        sheet = workbook.add_worksheet(_sheet_name(table_name, part))
+                        sheet.write_row(0, 0, columns)
+                        row_index = 0
+                    row_index += 1
+                    sheet.write_row(row_index, 0, row)
+    finally:
+        workbook.close()
+    return output_path
+
+
+def write_csv(engine, table_names, output_dir, chunk_size=CHUNK_SIZE):
+    os.makedirs(output_dir, exist_ok=True)
+    paths = []
+    for table_name in table_names:
+        path = os.path.join(output_dir, f'{table_name}.csv')
+        with open(path, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.writer(f)
+            header_written = False
+            for columns, rows in stream_table(engine, table_name, chunk_size):
+                if not header_written:
+                    writer.writerow(columns)
+                    header_written = True
+                writer.writerows(rows)
+        paths.append(path)
+    return paths
+
+
+def write_ndjson(engine, table_names, output_dir, chunk_size=CHUNK_SIZE):
+    os.makedirs(output_dir, exist_ok=True)
+    paths = []
+    for table_name in table_names:
+        path = os.path.join(output_dir, f'{table_name}.ndjson')
+        with open(path, 'w', encoding='utf-8') as f:
+            for columns, rows in stream_table(engine, table_name, chunk_size):
+                for row in rows:
+                    f.write(json.dumps(dict(zip(columns, row)), default=str))
+                    f.write('\n')
+        paths.append(path)
+    return paths
+
+
+def export_db(db_uri, output_filename, fmt=None, chunk_size=CHUNK_SIZE, tables=None):
+    # Streaming export: each table is read in chunk_size batches and written
+    # out incrementally, so peak memory does not grow with the table size.
+    stem, ext = os.path.splitext(output_filename)
+    fmt = fmt or ext.lstrip('.').lower() or 'xlsx'
+    if fmt not in FORMATS:
+        raise ValueError(f'Unsupported export format: {fmt}')
+
+    engine = create_engine(db_uri)
+    table_names = tables or [
+        name for name in inspect(engine).get_table_names() if name not in SKIPPED_TABLES
+    ]
+
+    os.makedirs(EXPORT_FOLDER, exist_ok=True)
+
+    if fmt == 'parquet':
+        output_path, _ = export_parquet(db_uri, output_filename, chunk_size, full=True)
+    elif fmt == 'xlsx':
+        output_path = os.path.join(EXPORT_FOLDER, stem + '.xlsx')
+        write_excel(engine, table_names, output_path, chunk_size)
+    else:
+        # CSV and NDJSON are one file per table, grouped in a folder
+        output_path = os.path.join(EXPORT_FOLDER, stem)
+        writer = write_csv if fmt == 'csv' else write_ndjson
+        writer(engine, table_names, output_path, chunk_size)
+
+    engine.dispose()
+    return output_path
+
+
+def load_watermarks(state_path):
+    if not os.path.exists(state_path):
+        return {}
+    with open(state_path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_watermarks(state_path, watermarks):
+    # Write to a temp file first so a crash never leaves a half-written state
+    tmp_path = state_path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(watermarks, f, indent=2)
+    os.replace(tmp_path, state_path)
+
+
+def _append_rows(path, fmt, columns, rows):
+    if fmt == 'csv':
+        new_file = not os.path.exists(path) or os.path.getsize(path) == 0
+        if not new_file:
+            # Appending under a different header would shift every column
+            with open(path, newline='', encoding='utf-8') as f:
+                header = next(csv.reader(f), [])
+            if header != list(columns):
+                raise ValueError(
+                    f'{path} has columns {header} but the table now has {list(columns)}; '
+                    'export again with --full'
+                )
+        with open(path, 'a', newline='', encoding='utf-8') as f:
+            writer = csv.writer(f)
+            if new_file:
+                writer.writerow(columns)
+            writer.writerows(rows)
+    else:
+        with open(path, 'a', encoding='utf-8') as f:
+            for row in rows:
+                f.write(json.dumps(dict(zip(columns, row)), default=str))
+                f.write('\n')
+
+
+def export_incremental(db_uri, output_filename, fmt=None, chunk_size=CHUNK_SIZE,
+                       tables=INCREMENTAL_TABLES, full=False):
+    # Appends only rows whose id is above the last exported id for each table.
+    # The high-water marks live next to the output files, so every output
+    # folder keeps its own position per format. full=True starts the folder
+    # from scratch.
+    stem, ext = os.path.splitext(output_filename)
+    fmt = fmt or ext.lstrip('.').lower() or 'ndjson'
+    if fmt not in ('csv', 'ndjson'):
+        raise ValueError(f'Incremental export needs csv or ndjson, not {fmt}')
+
+    output_dir = os.path.join(EXPORT_FOLDER, stem)
+    os.makedirs(output_dir, exist_ok=True)
+    state_path = os.path.join(output_dir, STATE_FILENAME.format(fmt=fmt))
+    watermarks = {} if full else load_watermarks(state_path)
+
+    engine = create_engine(db_uri)
+    counts = {}
+    for table_name in tables:
+        path = os.path.join(output_dir, f'{table_name}.{fmt}')
+        if full and os.path.exists(path):
+            os.remove(path)
+
+        after_id = watermarks.get(table_name, 0)
+        count = 0
+        for columns, rows in stream_table(engine, table_name, chunk_size, after_id):
+            if not rows:
+                continue
+            _append_rows(path, fmt, columns, rows)
+            count += len(rows)
+            # Rows come back ordered by id, so the last one is the new mark
+            watermarks[table_name] = rows[-1][columns.index('id')]
+            save_watermarks(state_path, watermarks)
+        counts[table_name] = count
+
+    save_watermarks(state_path, watermarks)
+    engine.dispose()
+    return output_dir, counts
+
+
+# Parquet archive for analysis: one folder per table, one sub-folder per
+# question (named by a hash, since questions are free text) and one file per
+# export run holding that run's new rows. Columns are typed, repeated strings
+# are dictionary encoded and files are zstd compressed. pyarrow is only needed
+# for this format.
+PARQUET_QUERIES = {
+    'user_location': (
+        'SELECT id, question, src, final_x, final_y, user_id FROM user_location '
+        'WHERE id > :after_id ORDER BY id'
+    ),
+    # A demographics row is one submission, and a submission's locations all
+    # belong to one question, which partitions the row too. A participant
+    # who answered several questions has a row, and so a file, per question.
+    'demographics': (
+        'SELECT d.id, (SELECT question FROM user_location u WHERE u.user_id = d.id '
+        'ORDER BY u.id LIMIT 1) AS question, d.participant_id, d.age, d.gender, '
+        'd.education, d.handedness, d.ethnicity, d.submission_id, d.submitted_at '
+        'FROM demographics d WHERE d.id > :after_id ORDER BY d.id'
+    ),
+}
+
+
+def _parquet_schemas(pa):
+    categories = pa.dictionary(pa.int32(), pa.string())
+    return {
+        'user_location': pa.schema([
+            ('id', pa.int64()),
+            ('question', categories),
+            ('src', categories),
+            ('final_x', pa.float64()),
+            ('final_y', pa.float64()),
+            ('user_id', pa.int64()),
+        ]),
+        'demographics': pa.schema([
+            ('id', pa.int64()),
+            ('question', categories),
+            ('participant_id', pa.string()),
+            ('age', pa.int32()),
+            ('gender', categories),
+            ('education', categories),
+            ('handedness', categories),
+            ('ethnicity', categories),
+            ('submission_id', pa.string()),
+            ('submitted_at', pa.timestamp('us')),
+        ]),
+    }
 
+
+def partition_name(question):
+    if question is None:
+        return 'question_none'
+    return 'question_' + hashlib.sha256(question.encode()).hexdigest()[:16]
+
+
+def _arrow_column(pa, values, field):
+    if pa.types.is_dictionary(field.type):
+        return pa.array(values, pa.string()).dictionary_encode()
+    if pa.types.is_timestamp(field.type):
+        # SQLite hands DateTime columns back as text
+        return pa.array(values, pa.string()).cast(field.type)
+    try:
+        return pa.array(values, field.type)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        # SQLite keeps whatever was inserted, e.g. an age typed as words
+        return pa.array([v if isinstance(v, (int, float)) else None for v in values],
+                        field.type)
+
+
+def _arrow_batch(pa, schema, rows):
+    columns = list(zip(*rows))
+    return pa.RecordBatch.from_arrays(
+        [_arrow_column(pa, list(values), field) for values, field in zip(columns, schema)],
+        schema=schema,
+    )
+
+
+def _part_start(filename):
+    return int(filename[len('part-'):].split('.')[0])
+
+
+def export_parquet(db_uri, output_filename, chunk_size=CHUNK_SIZE,
+                   tables=INCREMENTAL_TABLES, full=False):
+    # Appends a part file per question with the rows added since the last
+    # run. Parts are written under temporary names and renamed once the whole
+    # run has succeeded; parts starting above the saved watermark come from a
+    # run that died before saving it and are removed before re-exporting.
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    stem = os.path.splitext(output_filename)[0]
+    output_dir = os.path.join(EXPORT_FOLDER, stem)
+    os.makedirs(output_dir, exist_ok=True)
+    state_path = os.path.join(output_dir, STATE_FILENAME.format(fmt='parquet'))
+    watermarks = {} if full else load_watermarks(state_path)
+    schemas = _parquet_schemas(pa)
+
+    engine = create_engine(db_uri)
+    counts = {}
+    for table_name in tables:
+        table_dir = os.path.join(output_dir, table_name)
+        after_id = watermarks.get(table_name, 0)
+        for root, _, filenames in os.walk(table_dir):
+            for filename in filenames:
+                if full or filename.endswith('.tmp') or _part_start(filename) > after_id:
+                    os.remove(os.path.join(root, filename))
+
+        schema = schemas[table_name]
+        part = f'part-{after_id + 1:012d}.parquet'
+        writers = {}
+        last_id = None
+        count = 0
+        try:
+            with engine.connect() as conn:
+                result = conn.execution_options(stream_results=True).execute(
+                    text(PARQUET_QUERIES[table_name]), {'after_id': after_id}
+                )
+                for rows in result.partitions(chunk_size):
+                    by_question = {}
+                    for row in rows:
+                        by_question.setdefault(row[1], []).append(row)
+                    for question, group in by_question.items():
+                        name = partition_name(question)
+                        if name not in writers:
+                            os.makedirs(os.path.join(table_dir, name), exist_ok=True)
+                            path = os.path.join(table_dir, name, part)
+                            writers[name] = (path, pq.ParquetWriter(
+                                path + '.tmp', schema, compression='zstd'
+                            ))
+                        writers[name][1].write_batch(_arrow_batch(pa, schema, group))
+                    count += len(rows)
+                    last_id = rows[-1][0]
+        finally:
+            for _, writer in writers.values():
+                writer.close()
+        for path, _ in writers.values():
+            os.replace(path + '.tmp', path)
+        if last_id is not None:
+            watermarks[table_name] = last_id
+            save_watermarks(state_path, watermarks)
+        counts[table_name] = count
+
+    save_watermarks(state_path, watermarks)
+    engine.dispose()
+    return output_dir, counts
+
+
+def load_parquet(output_dir, table_name, question=None, columns=None):
+    # Reads a table from a Parquet archive as a pyarrow Table, one question
+    # after another (in id order within each), or just the given question.
+    # Files are memory-mapped rather than read into buffers; call .to_pandas()
+    # for a DataFrame with categorical string columns.
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    table_dir = os.path.join(output_dir, table_name)
+    if question is not None:
+        folders = [partition_name(question)]
+    elif os.path.isdir(table_dir):
+        folders = sorted(name for name in os.listdir(table_dir) if name.startswith('question_'))
+    else:
+        folders = []
+
+    tables = []
+    for folder in folders:
+        folder_path = os.path.join(table_dir, folder)
+        if not os.path.isdir(folder_path):
+            continue
+        for filename in sorted(os.listdir(folder_path)):
+            if filename.endswith('.parquet'):
+                tables.append(pq.read_table(
+                    os.path.join(folder_path, filename), columns=columns, memory_map=True
+                ))
+    if not tables:
+        empty = _parquet_schemas(pa)[table_name].empty_table()
+        return empty.select(columns) if columns else empty
+    return pa.concat_tables(tables)
+
+
+# Wide export for analysis: one row per participant, with a <src>_x and a
+# <src>_y column for every stimulus of the question (sorted by src) and,
+# optionally, the participant's demographics. Each question gets its own file,
+# named as in the Parquet archive. Participants are pivoted a chunk at a time,
+# as many as fit in the memory budget, by scattering the chunk's rows into a
+# preallocated block through their participant and src codes; a stimulus
+# placed twice keeps its last position. pandas is only needed for this target.
+WIDE_MEMORY = 64 * 1024 * 1024
+# Measured peak cost of one participant-stimulus pair: the long row as read
+# through SQLAlchemy and pandas, plus its two cells in the block
+WIDE_PAIR_BYTES = 640
+WIDE_DEMOGRAPHICS = ('participant_id', 'age', 'gender', 'education', 'handedness',
+                     'ethnicity', 'submitted_at')
+
+
+def _wide_chunks(conn, question, users_per_chunk):
+    # Walking the user_id index already yields them in order; going through
+    # the question index instead needs a temporary b-tree and is ten times slower
+    users = [row[0] for row in conn.execute(
+        text('SELECT DISTINCT user_id FROM user_location '
+             'WHERE +question = :q AND user_id IS NOT NULL ORDER BY user_id'),
+        {'q': question},
+    )]
+    for start in range(0, len(users), users_per_chunk):
+        yield users[start:start + users_per_chunk]
+
+
+def _wide_block(np, pd, frame, users, stimuli):
+    user_codes = pd.Index(users).get_indexer(frame['user_id'])
+    src_codes = stimuli.get_indexer(frame['src'])
+    # Rows come in id order, so keeping the last of each pair keeps the
+    # latest placement
+    pair = user_codes.astype(np.int64) * len(stimuli) + src_codes
+    last = ~pd.Series(pair).duplicated(keep='last').to_numpy()
+    rows = user_codes[last]
+    columns = 2 * src_codes[last]
+    block = np.full((len(users), 2 * len(stimuli)), np.nan)
+    block[rows, columns] = frame['final_x'].to_numpy(float)[last]
+    block[rows, columns + 1] = frame['final_y'].to_numpy(float)[last]
+    return block
+
+
+def _wide_demographics(pd, conn, users, present):
+    # present: the WIDE_DEMOGRAPHICS columns this database has; older ones
+    # predate submitted_at
+    query = text(
+        f'SELECT id, {", ".join(present)} FROM demographics WHERE id IN :ids'
+    ).bindparams(bindparam('ids', expanding=True))
+    frame = pd.DataFrame(conn.execute(query, {'ids': users}).fetchall(),
+                         columns=['id'] + present)
+    frame = frame.astype(object).set_index('id').reindex(index=users, columns=WIDE_DEMOGRAPHICS)
+    # None rather than NaN for participants without a demographics row
+    return frame.astype(object).where(frame.notna(), None)
+
+
+def _wide_schema(pa, stimuli, demographics):
+    known = _parquet_schemas(pa)['demographics']
+    fields = [('user_id', pa.int64()), ('question', pa.dictionary(pa.int32(), pa.string()))]
+    if demographics:
+        fields += [(name, known.field(name).type) for name in WIDE_DEMOGRAPHICS]
+    for src in stimuli:
+        fields += [(f'{src}_x', pa.float64()), (f'{src}_y', pa.float64())]
+    return pa.schema(fields)
+
+
+def export_wide(db_uri, output_filename, fmt=None, questions=None, demographics=False,
+                memory=WIDE_MEMORY):
+    import numpy as np
+    import pandas as pd
+
+    stem, ext = os.path.splitext(output_filename)
+    fmt = fmt or ext.lstrip('.').lower() or 'csv'
+    if fmt not in ('csv', 'parquet'):
+        raise ValueError(f'Wide export needs csv or parquet, not {fmt}')
+    if fmt == 'parquet':
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+    output_dir = os.path.join(EXPORT_FOLDER, stem)
+    os.makedirs(output_dir, exist_ok=True)
+    rows_query = text(
+        'SELECT user_id, src, final_x, final_y FROM user_location '
+        'WHERE user_id >= :first AND user_id <= :last AND +question = :q '
+        'AND src IS NOT NULL ORDER BY id'
+    )
+
+    engine = create_engine(db_uri)
+    if demographics:
+        names = {column['name'] for column in inspect(engine).get_columns('demographics')}
+        present = [name for name in WIDE_DEMOGRAPHICS if name in names]
+    counts = {}
+    with engine.connect() as conn:
+        if questions is None:
+            questions = [row[0] for row in conn.execute(text(
+                'SELECT DISTINCT question FROM user_location '
+                'WHERE question IS NOT NULL ORDER BY question'
+            ))]
+        for question in questions:
+            stimuli = pd.Index([row[0] for row in conn.execute(
+                text('SELECT DISTINCT src FROM user_location '
+                     'WHERE question = :q AND src IS NOT NULL ORDER BY src'),
+                {'q': question},
+            )])
+            users_per_chunk = max(1, memory // (max(len(stimuli), 1) * WIDE_PAIR_BYTES))
+            coordinates = [f'{src}_{axis}' for src in stimuli for axis in 'xy']
+            path = os.path.join(output_dir, f'{partition_name(question)}.{fmt}')
+            if fmt == 'parquet':
+                schema = _wide_schema(pa, stimuli, demographics)
+                writer = pq.ParquetWriter(path + '.tmp', schema, compression='zstd')
+            else:
+                writer = open(path + '.tmp', 'w', newline='', encoding='utf-8')
+                header = ['user_id', 'question']
+                header += list(WIDE_DEMOGRAPHICS) if demographics else []
+                csv.writer(writer).writerow(header + coordinates)
+            count = 0
+            try:
+                for users in _wide_chunks(conn, question, users_per_chunk):
+                    frame = pd.read_sql(rows_query, conn, params={
+                        'first': users[0], 'last': users[-1], 'q': question,
+                    })
+                    block = _wide_block(np, pd, frame, users, stimuli)
+                    chunk = {'user_id': users, 'question': [question] * len(users)}
+                    if demographics:
+                        details = _wide_demographics(pd, conn, users, present)
+                        for name in WIDE_DEMOGRAPHICS:
+                            chunk[name] = details[name].tolist()
+                    if fmt == 'parquet':
+                        arrays = [_arrow_column(pa, values, field)
+                                  for values, field in zip(chunk.values(), schema)]
+                        arrays += [pa.array(block[:, j], pa.float64(), from_pandas=True)
+                                   for j in range(block.shape[1])]
+                        writer.write_batch(pa.RecordBatch.from_arrays(arrays, schema=schema))
+                    else:
+                        # object keeps ages as ints and missing details blank
+                        leading = pd.DataFrame(chunk, dtype=object)
+                        positions = pd.DataFrame(block, columns=coordinates)
+                        pd.concat([leading, positions], axis=1).to_csv(
+                            writer, header=False, index=False
+                        )
+                    count += len(users)
+            except BaseException:
+                writer.close()
+                os.remove(path + '.tmp')
+                raise
+            writer.close()
+            os.replace(path + '.tmp', path)
+            counts[question] = count
+
+    engine.dispose()
+    return output_dir, counts
+
+
+def save_db_to_excel(db_uri, output_filename):
+    output_path = export_db(db_uri, output_filename, fmt='xlsx')
     print(f"Database saved to {output_path}")
 
 # Commented out JSON export function for now
@@ -38,19 +575,63 @@ def save_db_to_excel(db_uri, output_filename):
 #         query = f"SELECT * FROM {table_name}"
 #         df = pd.read_sql(query, engine)
 #         db_data[table_name] = df.to_dict(orient='records')
-    
+
 #     with open(output_filename, 'w') as f:
 #         json.dump(db_data, f, indent=4)
 
 if __name__ == "__main__":
-    # Default database URI
-    db_uri = 'sqlite:///instance/app.db'
+    parser = argparse.ArgumentParser(
+        usage="python export.py <output_filename>.xlsx|.csv|.ndjson|.parquet [--format FORMAT] "
+              "[--incremental [--full] | --wide [--demographics] [--question Q]]"
+    )
+    parser.add_argument('output_filename')
+    parser.add_argument('--db',
+                        help='database URI (default: the newest snapshot of instance/app.db, '
+                             'see snapshots.py)')
+    parser.add_argument('--format', choices=FORMATS,
+                        help='output format, inferred from the file extension if omitted')
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE,
+                        help='rows read from the database per batch')
+    parser.add_argument('--incremental', action='store_true',
+                        help='append only rows added since the last incremental run')
+    parser.add_argument('--full', action='store_true',
+                        help='with --incremental, discard previous output and re-export everything')
+    parser.add_argument('--wide', action='store_true',
+                        help='one row per participant with x/y columns per stimulus, '
+                             'one csv or parquet file per question')
+    parser.add_argument('--demographics', action='store_true',
+                        help='with --wide, add the demographics columns')
+    parser.add_argument('--question', action='append',
+                        help='with --wide, only this question (repeatable)')
+    parser.add_argument('--memory-mb', type=int, default=WIDE_MEMORY // (1024 * 1024),
+                        help='with --wide, memory budget for each chunk of participants')
+    args = parser.parse_args()
+    db_uri = args.db or analysis_db()
 
-    # Get output filename from command-line arguments
-    if len(sys.argv) != 2:
-        print("Usage: python export.py <output_filename>.xlsx")
+    try:
+        if args.wide:
+            output_path, counts = export_wide(
+                db_uri, args.output_filename, args.format, args.question,
+                args.demographics, args.memory_mb * 1024 * 1024
+            )
+            for question, count in counts.items():
+                print(f"{question!r}: {count} participants")
+        elif args.incremental:
+            stem, ext = os.path.splitext(args.output_filename)
+            if (args.format or ext.lstrip('.').lower()) == 'parquet':
+                output_path, counts = export_parquet(
+                    db_uri, args.output_filename, args.chunk_size, full=args.full
+                )
+            else:
+                output_path, counts = export_incremental(
+                    db_uri, args.output_filename, args.format, args.chunk_size, full=args.full
+                )
+            for table_name, count in counts.items():
+                print(f"{table_name}: {count} new rows")
+        else:
+            output_path = export_db(db_uri, args.output_filename, args.format, args.chunk_size)
+    except ValueError as e:
+        print(e)
         sys.exit(1)
-    
-    output_filename = sys.argv[1]
 
-    save_db_to_excel(db_uri, output_filename)
+    print(f"Database saved to {output_path}")
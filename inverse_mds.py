@@ -0,0 +1,211 @@
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import create_engine, text
+
+from rdm import condensed_index, group_mean_rdm, participant_rdms, squareform
+from snapshots import analysis_db
+
+# Merges each participant's arrangements (one per question, possibly over
+# different subsets of the stimuli) into a single dissimilarity estimate with
+# the iterative inverse-MDS procedure of Kriegeskorte & Mur (2012):
+#
+#   1. every arrangement gives distances for the pairs it contains;
+#   2. each arrangement is scaled to best match the current estimate over its
+#      own pairs (least squares);
+#   3. the estimate becomes the evidence-weighted mean of the scaled
+#      arrangements, a pair's weight in an arrangement being its squared
+#      on-screen distance (small distances are the least reliable), and is
+#      rescaled to unit RMS;
+#   4. repeat until the estimate stops changing.
+#
+# Participants are split into chunks that run on a process pool; within a
+# chunk every step is vectorized over participants and pairs.
+
+OUTPUT_FOLDER = os.path.join("instance", "analysis")
+
+
+def load_trials(engine):
+    # Returns participants, questions, stimuli and a
+    # (participants, questions, stimuli, 2) array of positions, NaN where a
+    # stimulus wasn't in that participant's arrangement for the question.
+    # user_location.user_id is one submission, so arrangements are grouped by
+    # the participant_id entered at the demographics step; a submission
+    # without one stands for a participant of its own. The latest position
+    # of a stimulus wins when a participant placed it more than once.
+    frame = pd.read_sql(
+        text(
+            "SELECT u.id, coalesce(d.participant_id, 'submission ' || u.user_id) AS participant, "
+            "u.question, u.src, u.final_x, u.final_y "
+            "FROM user_location u LEFT JOIN demographics d ON d.id = u.user_id "
+            "WHERE u.user_id IS NOT NULL AND u.question IS NOT NULL AND u.src IS NOT NULL "
+            "ORDER BY u.id"
+        ),
+        engine,
+    )
+    frame = frame.drop_duplicates(["participant", "question", "src"], keep="last")
+
+    participant_codes, participants = pd.factorize(frame["participant"])
+    question_codes, questions = pd.factorize(frame["question"], sort=True)
+    stimulus_codes, stimuli = pd.factorize(frame["src"], sort=True)
+
+    coords = np.full((len(participants), len(questions), len(stimuli), 2), np.nan)
+    coords[participant_codes, question_codes, stimulus_codes, 0] = frame["final_x"].to_numpy(float)
+    coords[participant_codes, question_codes, stimulus_codes, 1] = frame["final_y"].to_numpy(float)
+    return np.asarray(participants), np.asarray(questions), np.asarray(stimuli), coords
+
+
+def _rms(values, axis):
+    with np.errstate(invalid="ignore"):
+        return np.sqrt(np.nanmean(values ** 2, axis=axis, keepdims=True))
+
+
+def estimate_chunk(coords, max_iter=100, tol=1e-6):
+    # coords: (participants, trials, stimuli, 2). Returns (estimates,
+    # iterations, converged, final change), the estimates being condensed
+    # RDMs with unit RMS and NaN for pairs never arranged together.
+    n_participants, n_trials, n_stimuli, _ = coords.shape
+    d = participant_rdms(coords.reshape(-1, n_stimuli, 2)).reshape(n_participants, n_trials, -1)
+    observed = ~np.isnan(d)
+    d0 = np.where(observed, d, 0.0)
+
+    # Evidence weights; the floor keeps a pair that was always stacked on
+    # top of itself from dropping out entirely
+    weights = np.where(observed, np.maximum(d0 ** 2, 1e-12), 0.0)
+    weight_sum = weights.sum(axis=1)
+    has_evidence = weight_sum > 0
+
+    def weighted_estimate(scaled):
+        with np.errstate(invalid="ignore", divide="ignore"):
+            estimate = (weights * scaled).sum(axis=1) / weight_sum
+        estimate = np.where(has_evidence, estimate, np.nan)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return estimate / _rms(estimate, axis=1)
+
+    # Start from every arrangement scaled to unit RMS
+    with np.errstate(invalid="ignore", divide="ignore"):
+        scaled = np.nan_to_num(d0 / _rms(d, axis=2))
+    estimate = weighted_estimate(scaled)
+
+    iterations = np.zeros(n_participants, dtype=int)
+    converged = np.zeros(n_participants, dtype=bool)
+    change = np.full(n_participants, np.inf)
+    for _ in range(max_iter):
+        active = ~converged
+        if not active.any():
+            break
+        target = np.where(observed, np.nan_to_num(estimate)[:, None, :], 0.0)
+        # Least-squares scale of each arrangement onto the current estimate
+        with np.errstate(invalid="ignore", divide="ignore"):
+            scale = (target * d0).sum(axis=2, keepdims=True) / (d0 ** 2).sum(axis=2, keepdims=True)
+        scaled = np.nan_to_num(d0 * scale)
+        new_estimate = weighted_estimate(scaled)
+
+        with np.errstate(invalid="ignore"):
+            delta = np.nanmax(np.abs(new_estimate - estimate), axis=1, initial=0.0)
+        estimate = np.where(active[:, None], new_estimate, estimate)
+        change = np.where(active, delta, change)
+        iterations += active
+        converged |= delta < tol
+    return estimate, iterations, converged, change
+
+
+def _run_chunk(args):
+    coords, max_iter, tol = args
+    start = time.perf_counter()
+    result = estimate_chunk(coords, max_iter, tol)
+    return result + (time.perf_counter() - start,)
+
+
+def estimate_cohort(coords, workers=None, chunk_size=64, max_iter=100, tol=1e-6):
+    # Runs estimate_chunk over participant chunks on a process pool and
+    # returns (estimates, stats)
+    start = time.perf_counter()
+    chunks = [
+        (coords[i:i + chunk_size], max_iter, tol) for i in range(0, len(coords), chunk_size)
+    ]
+    if workers == 1 or len(chunks) <= 1:
+        results = [_run_chunk(chunk) for chunk in chunks]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(_run_chunk, chunks))
+
+    estimates = np.concatenate([r[0] for r in results])
+    iterations = np.concatenate([r[1] for r in results])
+    converged = np.concatenate([r[2] for r in results])
+    change = np.concatenate([r[3] for r in results])
+    stats = {
+        "participants": len(estimates),
+        "converged": int(converged.sum()),
+        "mean_iterations": float(iterations.mean()) if len(iterations) else 0.0,
+        "max_iterations": int(iterations.max()) if len(iterations) else 0,
+        "max_final_change": float(np.max(change)) if len(change) else 0.0,
+        "chunks": len(chunks),
+        "cpu_seconds": float(sum(r[4] for r in results)),
+        "wall_seconds": time.perf_counter() - start,
+    }
+    return estimates, iterations, converged, stats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Estimate per-participant RDMs from all of their arrangements"
+    )
+    parser.add_argument("--db", help="database URI (default: the newest snapshot, see snapshots.py)")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="worker processes (default: one per core)")
+    parser.add_argument("--chunk-size", type=int, default=64,
+                        help="participants per worker task")
+    parser.add_argument("--max-iter", type=int, default=100)
+    parser.add_argument("--tol", type=float, default=1e-6)
+    parser.add_argument("--output", default=os.path.join(OUTPUT_FOLDER, "inverse_mds.npz"))
+    parser.add_argument("--csv", help="also write the group RDM as CSV")
+    args = parser.parse_args()
+
+    engine = create_engine(args.db or analysis_db())
+    load_start = time.perf_counter()
+    participants, questions, stimuli, coords = load_trials(engine)
+    if not len(participants):
+        print("No arrangements found")
+        sys.exit(1)
+    load_seconds = time.perf_counter() - load_start
+
+    estimates, iterations, converged, stats = estimate_cohort(
+        coords, args.workers, args.chunk_size, args.max_iter, args.tol
+    )
+    group = group_mean_rdm(estimates)
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    np.savez(
+        args.output,
+        participants=participants,
+        questions=questions,
+        stimuli=stimuli,
+        rdms=estimates,
+        group=group,
+        iterations=iterations,
+        converged=converged,
+    )
+    if args.csv:
+        names = [str(s) for s in stimuli]
+        pd.DataFrame(squareform(group, len(names)), index=names, columns=names).to_csv(args.csv)
+
+    print(
+        f"{stats['participants']} participants, {len(questions)} questions, "
+        f"{len(stimuli)} stimuli ({condensed_index(len(stimuli))[0].size} pairs)"
+    )
+    print(
+        f"converged {stats['converged']}/{stats['participants']}, "
+        f"iterations mean {stats['mean_iterations']:.1f} max {stats['max_iterations']}, "
+        f"largest final change {stats['max_final_change']:.2g}"
+    )
+    print(
+        f"load {load_seconds:.2f}s, estimate {stats['wall_seconds']:.2f}s wall / "
+        f"{stats['cpu_seconds']:.2f}s CPU over {stats['chunks']} chunks"
+    )
+    print(f"Saved to {args.output}")
@@ -0,0 +1,63 @@
+import hashlib
+import os
+import tempfile
+
+# Content-addressed storage for uploaded stimuli. Files are kept once under
+# uploads/objects/<first two hex digits>/<sha256><ext>; the mapping from the
+# name participants see to the hash lives in the MediaFile table (app.py).
+
+CHUNK_SIZE = 1024 * 1024
+OBJECTS_DIR = "objects"
+
+
+def object_path(upload_folder, digest, ext):
+    return os.path.join(upload_folder, OBJECTS_DIR, digest[:2], digest + ext.lower())
+
+
+def hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def store_stream(stream, upload_folder, ext, process=None):
+    # Copies the stream to a temp file in chunks while hashing it, then moves
+    # it into place unless an identical object already exists. process(path)
+    # may rewrite the temp file first and returns True if it did, in which
+    # case the object is keyed by the rewritten content. Returns
+    # (digest, size, path, created).
+    objects_dir = os.path.join(upload_folder, OBJECTS_DIR)
+    os.makedirs(objects_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=objects_dir, suffix=".part")
+    try:
+        digest = hashlib.sha256()
+        size = 0
+        with os.fdopen(fd, "wb") as out:
+            for chunk in iter(lambda: stream.read(CHUNK_SIZE), b""):
+                digest.update(chunk)
+                out.write(chunk)
+                size += len(chunk)
+        digest = digest.hexdigest()
+        if process is not None and process(tmp_path):
+            digest = hash_file(tmp_path)
+            size = os.path.getsize(tmp_path)
+
+        path = object_path(upload_folder, digest, ext)
+        if os.path.exists(path):
+            os.remove(tmp_path)
+            return digest, size, path, False
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(tmp_path, path)
+        return digest, size, path, True
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def versioned_name(filename, digest):
+    # Name for a different file uploaded under a name that is already taken
+    stem, ext = os.path.splitext(filename)
+    return f"{stem}-{digest[:8]}{ext}"
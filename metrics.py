@@ -0,0 +1,187 @@
+import logging
+import os
+import threading
+import time
+from bisect import bisect_left
+
+from flask import Response, g, has_request_context, request
+from sqlalchemy import event
+
+# Per-request timing for the Flask app, exposed in Prometheus text format on
+# /metrics. Recording is a few dict lookups under one lock per request, so it
+# is cheap enough to leave on. Counters are per process.
+#
+# Requests slower than SLOW_REQUEST_MS (off unless set) are logged together
+# with the SQL statements they ran and how long each took.
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+logger = logging.getLogger("survey.metrics")
+
+
+class Histogram:
+    __slots__ = ("counts", "total", "count")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(BUCKETS, value)] += 1
+        self.total += value
+        self.count += 1
+
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latency = {}
+        self.db_time = {}
+        self.requests = {}
+        self.in_flight = 0
+        self.upload_bytes = 0
+
+    def start(self):
+        with self.lock:
+            self.in_flight += 1
+
+    def finish(self, endpoint, method, status, seconds, db_seconds, upload_bytes):
+        with self.lock:
+            self.in_flight -= 1
+            key = (endpoint, method)
+            if key not in self.latency:
+                self.latency[key] = Histogram()
+                self.db_time[key] = Histogram()
+            self.latency[key].observe(seconds)
+            self.db_time[key].observe(db_seconds)
+            status_key = (endpoint, method, status)
+            self.requests[status_key] = self.requests.get(status_key, 0) + 1
+            self.upload_bytes += upload_bytes
+
+    def render(self):
+        with self.lock:
+            lines = [
+                "# HELP http_requests_in_flight Requests currently being handled.",
+                "# TYPE http_requests_in_flight gauge",
+                f"http_requests_in_flight {self.in_flight}",
+                "# HELP uploads_bytes_served_total Bytes of stimulus files sent from /uploads.",
+                "# TYPE uploads_bytes_served_total counter",
+                f"uploads_bytes_served_total {self.upload_bytes}",
+                "# HELP http_requests_total Requests by endpoint, method and status.",
+                "# TYPE http_requests_total counter",
+            ]
+            for (endpoint, method, status), count in sorted(self.requests.items()):
+                lines.append(
+                    f'http_requests_total{{endpoint="{endpoint}",method="{method}",'
+                    f'status="{status}"}} {count}'
+                )
+            lines += _render_histograms(
+                "http_request_duration_seconds", "Request latency.", self.latency
+            )
+            lines += _render_histograms(
+                "http_request_db_seconds", "Time spent in SQL per request.", self.db_time
+            )
+        return "\n".join(lines) + "\n"
+
+
+def _render_histograms(name, help_text, histograms):
+    lines = [f"# HELP {name} {help_text}", f"# TYPE {name} histogram"]
+    for (endpoint, method), h in sorted(histograms.items()):
+        labels = f'endpoint="{endpoint}",method="{method}"'
+        cumulative = 0
+        for bound, count in zip(BUCKETS, h.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {h.count}')
+        lines.append(f"{name}_sum{{{labels}}} {h.total}")
+        lines.append(f"{name}_count{{{labels}}} {h.count}")
+    return lines
+
+
+class RequestTimer:
+    __slots__ = ("start", "db_seconds", "statements", "status", "upload_bytes")
+
+    def __init__(self, keep_statements):
+        self.start = time.perf_counter()
+        self.db_seconds = 0.0
+        self.statements = [] if keep_statements else None
+        self.status = 500
+        self.upload_bytes = 0
+
+
+def init_metrics(app, engine, uploads_endpoint="uploaded_file"):
+    metrics = Metrics()
+    slow_ms = float(os.getenv("SLOW_REQUEST_MS", "0"))
+    app.extensions["metrics"] = metrics
+
+    # Everything per request hangs off one object on g; every access through
+    # the g and request proxies costs more than the bookkeeping itself
+    @app.before_request
+    def start_timer():
+        g._metrics_timer = RequestTimer(bool(slow_ms))
+        metrics.start()
+
+    @app.after_request
+    def record_status(response):
+        timer = g._metrics_timer
+        timer.status = response.status_code
+        # Only bodies that were actually sent: a 206 carries just its range,
+        # while 304s and error pages carry no file at all
+        if request.endpoint == uploads_endpoint:
+            if response.status_code == 200 and response.content_length:
+                timer.upload_bytes = response.content_length
+            elif response.status_code == 206 and response.content_range:
+                content_range = response.content_range
+                timer.upload_bytes = content_range.stop - content_range.start
+        return response
+
+    @app.teardown_request
+    def stop_timer(exc):
+        timer = g.pop("_metrics_timer", None)
+        if timer is None:
+            return
+        elapsed = time.perf_counter() - timer.start
+        req = request._get_current_object()
+        endpoint = req.url_rule.rule if req.url_rule else "unmatched"
+        metrics.finish(
+            endpoint, req.method, timer.status, elapsed, timer.db_seconds, timer.upload_bytes
+        )
+        if slow_ms and elapsed * 1000 >= slow_ms:
+            logger.warning(
+                "slow request %s %s status=%s total=%.1fms sql=%.1fms statements=%d",
+                req.method,
+                req.path,
+                timer.status,
+                elapsed * 1000,
+                timer.db_seconds * 1000,
+                len(timer.statements),
+            )
+            for statement, seconds in timer.statements:
+                logger.warning("  %.1fms %s", seconds * 1000, statement)
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("metrics_start", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info["metrics_start"].pop()
+        timer = g.get("_metrics_timer") if has_request_context() else None
+        if timer is not None:
+            timer.db_seconds += elapsed
+            if timer.statements is not None:
+                timer.statements.append((" ".join(statement.split())[:300], elapsed))
+
+    @event.listens_for(engine, "handle_error")
+    def handle_error(exception_context):
+        conn = exception_context.connection
+        starts = conn.info.get("metrics_start") if conn is not None else None
+        if starts:
+            starts.pop()
+
+    @app.route("/metrics")
+    def prometheus_metrics():
+        return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+    return metrics
@@ -0,0 +1,280 @@
+import math
+import sqlite3
+from datetime import datetime
+from sqlalchemy import inspect
+
+# Schema migrations for the survey database. The applied version is kept in
+# SQLite's PRAGMA user_version, so no bookkeeping table shows up in exports.
+# Each migration gets a connection with an open transaction; add new ones to
+# the end of MIGRATIONS and never reorder or edit them. A migration spells
+# out the DDL and SQL of its own version instead of reading the models or
+# calling the app's modules, so what a version number means never changes.
+# Tables a migration touches may not exist yet in a database from before
+# they were added; setup_db.py's create_all makes them afterwards, in their
+# current form.
+
+
+def _tables(conn):
+    return set(inspect(conn).get_table_names())
+
+
+def _columns(conn, table):
+    return {c["name"] for c in inspect(conn).get_columns(table)}
+
+
+def _foreign_tables(conn, table):
+    return {fk["referred_table"] for fk in inspect(conn).get_foreign_keys(table)}
+
+
+def _add_columns(conn, table, columns):
+    # columns: (name, type and constraints) pairs; returns the names added
+    if table not in _tables(conn):
+        return []
+    live = _columns(conn, table)
+    added = []
+    for name, ddl in columns:
+        if name not in live:
+            conn.exec_driver_sql(f'ALTER TABLE "{table}" ADD COLUMN "{name}" {ddl}')
+            added.append(name)
+    return added
+
+
+def _create_indexes(conn, indexes):
+    # indexes: (name, table, columns, unique) tuples
+    tables = _tables(conn)
+    for name, table, columns, unique in indexes:
+        if table in tables:
+            conn.exec_driver_sql(
+                f'CREATE {"UNIQUE " if unique else ""}INDEX IF NOT EXISTS "{name}" '
+                f'ON "{table}" ({", ".join(columns)})'
+            )
+
+
+def _rebuild_table(conn, table, ddl):
+    # SQLite can't drop columns that take part in a foreign key or change a
+    # foreign key's target, so recreate the table and copy the shared columns
+    # across (https://www.sqlite.org/lang_altertable.html#otheralter). ddl
+    # creates the table under the name "_new_<table>".
+    new_name = f"_new_{table}"
+    conn.exec_driver_sql(ddl)
+    columns = ", ".join(f'"{c}"' for c in _columns(conn, new_name) & _columns(conn, table))
+    conn.exec_driver_sql(f'INSERT INTO "{new_name}" ({columns}) SELECT {columns} FROM "{table}"')
+    conn.exec_driver_sql(f'DROP TABLE "{table}"')
+    conn.exec_driver_sql(f'ALTER TABLE "{new_name}" RENAME TO "{table}"')
+
+
+# Version 1 tables that older databases may have in another shape
+V1_ADMIN = (
+    "CREATE TABLE admin (id INTEGER NOT NULL, username VARCHAR(80) NOT NULL, "
+    "password VARCHAR(120) NOT NULL, PRIMARY KEY (id), UNIQUE (username))"
+)
+V1_TABLES = {
+    "demographics": (
+        'CREATE TABLE "_new_demographics" (id INTEGER NOT NULL, participant_id VARCHAR(120), '
+        "age INTEGER, gender VARCHAR(10), education VARCHAR(50), handedness VARCHAR(10), "
+        "ethnicity VARCHAR(50), PRIMARY KEY (id))",
+        set(),
+    ),
+    "admin_location": (
+        'CREATE TABLE "_new_admin_location" (id INTEGER NOT NULL, initial_x FLOAT, '
+        "initial_y FLOAT, src VARCHAR(200), question VARCHAR(300), admin_id INTEGER, "
+        "PRIMARY KEY (id), FOREIGN KEY(admin_id) REFERENCES admin (id))",
+        {"admin"},
+    ),
+    "user_location": (
+        'CREATE TABLE "_new_user_location" (id INTEGER NOT NULL, final_x FLOAT, '
+        "final_y FLOAT, src VARCHAR(200), question VARCHAR(300), user_id INTEGER, "
+        "PRIMARY KEY (id), FOREIGN KEY(user_id) REFERENCES demographics (id))",
+        {"demographics"},
+    ),
+}
+
+
+def reconcile_legacy_tables(conn):
+    # Accounts used to live in a "user" table with an is_admin flag, which the
+    # other tables referenced, and demographics had a user_id column. Carry
+    # the admins over to the admin table, drop "user" and rebuild the tables
+    # that still point at it.
+    tables = _tables(conn)
+    if "user" in tables:
+        if "admin" not in tables:
+            conn.exec_driver_sql(V1_ADMIN)
+        conn.exec_driver_sql(
+            'INSERT INTO admin (username, password) '
+            'SELECT username, password FROM "user" '
+            'WHERE is_admin AND username NOT IN (SELECT username FROM admin)'
+        )
+        conn.exec_driver_sql('DROP TABLE "user"')
+
+    for table, (ddl, foreign_tables) in V1_TABLES.items():
+        if table not in tables:
+            continue
+        legacy_columns = table == "demographics" and "user_id" in _columns(conn, table)
+        if legacy_columns or _foreign_tables(conn, table) != foreign_tables:
+            _rebuild_table(conn, table, ddl)
+
+
+def add_lookup_indexes(conn):
+    _create_indexes(conn, [
+        ("ix_demographics_participant_id", "demographics", ["participant_id"], False),
+        ("ix_admin_location_admin_id", "admin_location", ["admin_id"], False),
+        ("ix_admin_location_question_src", "admin_location", ["question", "src"], False),
+        ("ix_user_location_user_id_src", "user_location", ["user_id", "src"], False),
+        ("ix_user_location_question_src", "user_location", ["question", "src"], False),
+    ])
+
+
+def add_media_manifest(conn):
+    _add_columns(conn, "media_file", [
+        ("duration", "FLOAT"),
+        ("width", "INTEGER"),
+        ("height", "INTEGER"),
+    ])
+
+
+def add_submission_id(conn):
+    # ADD COLUMN can't carry UNIQUE, so a unique index stands in for it
+    if _add_columns(conn, "demographics", [("submission_id", "VARCHAR(36)")]):
+        _create_indexes(conn, [
+            ("uq_demographics_submission_id", "demographics", ["submission_id"], True),
+        ])
+
+
+V5_LOCATION_AGGREGATE = (
+    "CREATE TABLE IF NOT EXISTS location_aggregate (id INTEGER NOT NULL, "
+    "question VARCHAR(300) NOT NULL, src VARCHAR(200) NOT NULL, "
+    "responses INTEGER NOT NULL, placed INTEGER NOT NULL, sum_x FLOAT NOT NULL, "
+    "sum_y FLOAT NOT NULL, sum_x2 FLOAT NOT NULL, sum_y2 FLOAT NOT NULL, "
+    "distance_count INTEGER NOT NULL, sum_distance FLOAT NOT NULL, PRIMARY KEY (id), "
+    "CONSTRAINT uq_location_aggregate_question_src UNIQUE (question, src))"
+)
+
+# Totals per (question, src) over the responses collected so far, distances
+# measured from the most recent admin_location of the question and src
+V5_FILL_AGGREGATES = """
+WITH reference AS (
+    SELECT question, src, initial_x AS x, initial_y AS y FROM admin_location
+    WHERE id IN (SELECT max(id) FROM admin_location GROUP BY question, src)
+      AND initial_x IS NOT NULL AND initial_y IS NOT NULL
+), response AS (
+    SELECT question, src, final_x AS x, final_y AS y,
+           final_x IS NOT NULL AND final_y IS NOT NULL AS placed
+    FROM user_location WHERE src IS NOT NULL AND src != ''
+)
+INSERT INTO location_aggregate (question, src, responses, placed, sum_x, sum_y,
+                                sum_x2, sum_y2, distance_count, sum_distance)
+SELECT coalesce(r.question, ''), r.src, count(*), sum(r.placed),
+       total(CASE WHEN r.placed THEN r.x END), total(CASE WHEN r.placed THEN r.y END),
+       total(CASE WHEN r.placed THEN r.x * r.x END), total(CASE WHEN r.placed THEN r.y * r.y END),
+       sum(r.placed AND a.src IS NOT NULL),
+       total(CASE WHEN r.placed AND a.src IS NOT NULL THEN migration_hypot(r.x - a.x, r.y - a.y) END)
+FROM response r LEFT JOIN reference a ON a.question IS r.question AND a.src = r.src
+GROUP BY coalesce(r.question, ''), r.src
+"""
+
+
+def add_location_aggregate(conn):
+    # New table, filled from the responses already collected
+    conn.exec_driver_sql(V5_LOCATION_AGGREGATE)
+    conn.exec_driver_sql("DELETE FROM location_aggregate")
+    if {"user_location", "admin_location"} <= _tables(conn):
+        # Not every SQLite build has the math functions
+        conn.connection.driver_connection.create_function(
+            "migration_hypot", 2, math.hypot, deterministic=True
+        )
+        conn.exec_driver_sql(V5_FILL_AGGREGATES)
+
+
+def add_submitted_at(conn):
+    _add_columns(conn, "demographics", [("submitted_at", "DATETIME")])
+    _create_indexes(conn, [
+        ("ix_demographics_submitted_at", "demographics", ["submitted_at"], False),
+    ])
+
+
+V7_COUNTERBALANCE = (
+    "CREATE TABLE IF NOT EXISTS counterbalance_layout (id INTEGER NOT NULL, "
+    "pool INTEGER NOT NULL, slot INTEGER NOT NULL, question VARCHAR(300), "
+    "locations TEXT NOT NULL, created_at DATETIME, PRIMARY KEY (id), "
+    "CONSTRAINT uq_counterbalance_layout_pool_slot UNIQUE (pool, slot))",
+    "CREATE TABLE IF NOT EXISTS counterbalance_state (id INTEGER NOT NULL, "
+    "pool INTEGER NOT NULL, first_id INTEGER NOT NULL, size INTEGER NOT NULL, "
+    "assigned INTEGER NOT NULL, PRIMARY KEY (id))",
+)
+
+
+def add_counterbalance(conn):
+    # The first pool is built by setup_db.py once the schema is current
+    for ddl in V7_COUNTERBALANCE:
+        conn.exec_driver_sql(ddl)
+    _add_columns(conn, "demographics", [
+        ("layout_id", "INTEGER REFERENCES counterbalance_layout (id)"),
+    ])
+
+
+MIGRATIONS = [
+    (1, "reconcile legacy tables", reconcile_legacy_tables),
+    (2, "add lookup indexes", add_lookup_indexes),
+    (3, "add media manifest columns", add_media_manifest),
+    (4, "add demographics.submission_id", add_submission_id),
+    (5, "add location_aggregate", add_location_aggregate),
+    (6, "add demographics.submitted_at", add_submitted_at),
+    (7, "add counterbalanced layouts", add_counterbalance),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def current_version(conn):
+    return conn.exec_driver_sql("PRAGMA user_version").scalar()
+
+
+def backup_database(engine, suffix):
+    # Copy the file with SQLite's backup API so a failed migration is
+    # recoverable; returns the backup path, or None for in-memory databases
+    path = engine.url.database
+    if not path or path == ":memory:":
+        return None
+    backup_path = f"{path}.{suffix}.bak"
+    raw = engine.raw_connection()
+    try:
+        dest = sqlite3.connect(backup_path)
+        try:
+            raw.driver_connection.backup(dest)
+        finally:
+            dest.close()
+    finally:
+        raw.close()
+    return backup_path
+
+
+def run_migrations(engine, backup=True):
+    # Applies every migration above the database's user_version, each in its
+    # own transaction together with the version bump. A new, empty database
+    # is just marked current; create_all makes its tables.
+    with engine.connect() as conn:
+        conn = conn.execution_options(isolation_level="AUTOCOMMIT")
+        version = current_version(conn)
+        pending = [m for m in MIGRATIONS if m[0] > version]
+        if not pending:
+            return []
+        if not inspect(conn).get_table_names():
+            conn.exec_driver_sql(f"PRAGMA user_version = {LATEST_VERSION}")
+            return []
+
+        if backup:
+            stamp = datetime.now().strftime("%Y%m%d%H%M%S")
+            backup_database(engine, f"pre-v{pending[-1][0]}-{stamp}")
+
+        applied = []
+        for number, description, migrate in pending:
+            conn.exec_driver_sql("BEGIN")
+            try:
+                migrate(conn)
+                conn.exec_driver_sql(f"PRAGMA user_version = {number}")
+            except Exception:
+                conn.exec_driver_sql("ROLLBACK")
+                raise
+            conn.exec_driver_sql("COMMIT")
+            applied.append((number, description))
+    return applied
@@ -0,0 +1,189 @@
+import os
+import struct
+import tempfile
+
+# Minimal ISO base media (MP4/MOV) box handling: enough to move the moov box
+# in front of mdat ("fast start") and to read duration and frame size,
+# without depending on ffmpeg.
+
+MP4_EXTENSIONS = {".mp4", ".m4v", ".mov"}
+
+# Boxes on the path from moov down to the chunk offset tables
+CONTAINER_BOXES = {b"moov", b"trak", b"mdia", b"minf", b"stbl"}
+
+COPY_CHUNK_SIZE = 1024 * 1024
+
+
+class MP4Error(ValueError):
+    pass
+
+
+def _unpack(fmt, data, offset, end=None):
+    # struct.unpack_from that stays inside data[:end] and reports a short read
+    # as a malformed file rather than a struct.error
+    end = len(data) if end is None else min(end, len(data))
+    if offset < 0 or offset + struct.calcsize(fmt) > end:
+        raise MP4Error(f"truncated box data at offset {offset}")
+    return struct.unpack_from(fmt, data, offset)
+
+
+def _box_header(size, box_type, offset, header_size, end):
+    if size == 0:
+        size = end - offset
+    if size < header_size or offset + size > end:
+        raise MP4Error(f"invalid {box_type!r} box at offset {offset}")
+    return size
+
+
+def read_top_level_boxes(f):
+    # (type, offset, size) for every top-level box, without reading payloads
+    f.seek(0, os.SEEK_END)
+    file_size = f.tell()
+    boxes = []
+    offset = 0
+    while offset < file_size:
+        f.seek(offset)
+        header = f.read(8)
+        if len(header) < 8:
+            raise MP4Error(f"truncated box header at offset {offset}")
+        size, box_type = struct.unpack(">I4s", header)
+        header_size = 8
+        if size == 1:
+            size = _unpack(">Q", f.read(8), 0)[0]
+            header_size = 16
+        size = _box_header(size, box_type, offset, header_size, file_size)
+        boxes.append((box_type, offset, size))
+        offset += size
+    return boxes
+
+
+def iter_child_boxes(data, start, end):
+    # Yields (type, offset, header_size, size) for boxes inside data[start:end]
+    offset = start
+    while offset + 8 <= end:
+        size, box_type = _unpack(">I4s", data, offset, end)
+        header_size = 8
+        if size == 1:
+            size = _unpack(">Q", data, offset + 8, end)[0]
+            header_size = 16
+        size = _box_header(size, box_type, offset, header_size, end)
+        yield box_type, offset, header_size, size
+        offset += size
+
+
+def walk_boxes(data, start=0, end=None):
+    # Depth-first over the container boxes we know how to descend into
+    end = len(data) if end is None else end
+    for box_type, offset, header_size, size in iter_child_boxes(data, start, end):
+        yield box_type, offset, header_size, size
+        if box_type in CONTAINER_BOXES:
+            yield from walk_boxes(data, offset + header_size, offset + size)
+
+
+def shift_chunk_offsets(moov, delta):
+    # Adds delta to every entry of the stco/co64 tables in a moov bytearray
+    for box_type, offset, header_size, size in walk_boxes(moov):
+        if box_type == b"cmov":
+            raise MP4Error("compressed moov boxes are not supported")
+        if box_type not in (b"stco", b"co64"):
+            continue
+        # Full box: 1 byte version, 3 bytes flags, then the entry count
+        body = offset + header_size + 4
+        count = _unpack(">I", moov, body, offset + size)[0]
+        fmt = ">%d%s" % (count, "I" if box_type == b"stco" else "Q")
+        if body + 4 + struct.calcsize(fmt) > offset + size:
+            raise MP4Error(f"{box_type!r} table runs past its box")
+        entries = [e + delta for e in struct.unpack_from(fmt, moov, body + 4)]
+        if box_type == b"stco" and entries and max(entries) > 0xFFFFFFFF:
+            raise MP4Error("chunk offsets no longer fit in stco")
+        struct.pack_into(fmt, moov, body + 4, *entries)
+
+
+def needs_faststart(path):
+    with open(path, "rb") as f:
+        types = [box_type for box_type, _, _ in read_top_level_boxes(f)]
+    if b"moov" not in types or b"mdat" not in types:
+        return False
+    return types.index(b"moov") > types.index(b"mdat")
+
+
+def faststart(path):
+    # Rewrites the file in place with moov ahead of the media data so playback
+    # can start before the whole file has downloaded. Returns True if the file
+    # changed, False if it was already fast-start (or has no moov/mdat).
+    with open(path, "rb") as f:
+        boxes = read_top_level_boxes(f)
+        types = [box[0] for box in boxes]
+        if b"moov" not in types or b"mdat" not in types:
+            return False
+        moov_index = types.index(b"moov")
+        first_mdat = types.index(b"mdat")
+        if moov_index < first_mdat:
+            return False
+        if b"mdat" in types[moov_index + 1:]:
+            # Media on both sides of moov; the offsets would shift unevenly
+            raise MP4Error("mdat boxes after moov are not supported")
+
+        _, moov_offset, moov_size = boxes[moov_index]
+        f.seek(moov_offset)
+        moov = bytearray(f.read(moov_size))
+        # Everything from the first mdat up to the old moov position moves
+        # down by the size of moov
+        shift_chunk_offsets(moov, moov_size)
+
+        order = boxes[:first_mdat] + [boxes[moov_index]] + [
+            box for i, box in enumerate(boxes[first_mdat:], first_mdat) if i != moov_index
+        ]
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", suffix=".faststart")
+        try:
+            with os.fdopen(fd, "wb") as out:
+                for box_type, offset, size in order:
+                    if box_type == b"moov":
+                        out.write(moov)
+                        continue
+                    f.seek(offset)
+                    remaining = size
+                    while remaining:
+                        chunk = f.read(min(COPY_CHUNK_SIZE, remaining))
+                        if not chunk:
+                            raise MP4Error("file ended inside a box")
+                        out.write(chunk)
+                        remaining -= len(chunk)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+    os.replace(tmp_path, path)
+    return True
+
+
+def probe(path):
+    # Duration in seconds and the first video track's display size
+    with open(path, "rb") as f:
+        boxes = read_top_level_boxes(f)
+        moov = next((box for box in boxes if box[0] == b"moov"), None)
+        if moov is None:
+            raise MP4Error("no moov box")
+        f.seek(moov[1])
+        data = f.read(moov[2])
+
+    info = {"duration": None, "width": None, "height": None, "size": os.path.getsize(path)}
+    for box_type, offset, header_size, size in walk_boxes(data):
+        body = offset + header_size
+        end = offset + size
+        if box_type == b"mvhd":
+            version = _unpack(">B", data, body, end)[0]
+            if version == 1:
+                timescale, duration = _unpack(">IQ", data, body + 20, end)
+            else:
+                timescale, duration = _unpack(">II", data, body + 12, end)
+            if timescale:
+                info["duration"] = duration / timescale
+        elif box_type == b"tkhd" and info["width"] is None:
+            # Width and height are the last 8 bytes, as 16.16 fixed point
+            if end - 8 < body:
+                raise MP4Error(f"truncated tkhd box at offset {offset}")
+            width, height = _unpack(">II", data, end - 8, end)
+            if width and height:
+                info["width"] = width >> 16
+                info["height"] = height >> 16
+    return info
@@ -0,0 +1,359 @@
+import http.client
+import logging
+import os
+import signal
+import socket
+import time
+
+from waitress.channel import HTTPChannel
+from waitress.server import BaseWSGIServer, create_server
+from waitress import wasyncore
+
+# Prefork mode for waitress_run.py: the master process binds the listening
+# socket and forks worker processes that all accept on it, each running its
+# own waitress thread pool. A participant burst then spreads over every core
+# instead of queueing behind one interpreter's GIL.
+#
+# Each worker also listens on a private 127.0.0.1 port, which the master uses
+# to GET /healthz every few seconds; a worker that stops answering is killed
+# and replaced, as is one that dies.
+#
+#     kill -HUP <master>    rolling restart: each worker in turn is replaced,
+#                           the old one only stopped once the new one is healthy
+#     kill -TERM <master>   graceful stop (Ctrl-C too)
+#
+# A worker asked to stop closes its listeners, finishes the requests it has
+# in flight (up to graceful_timeout) and then exits. load_worker runs after
+# the fork, so unless the app was imported in the master beforehand
+# (waitress_run.py --preload) a rolling restart also picks up new code.
+
+logger = logging.getLogger("survey.prefork")
+
+HEALTH_PATH = "/healthz"
+
+
+class Worker:
+    def __init__(self, index, pid, pipe):
+        self.index = index
+        self.pid = pid
+        self.pipe = pipe
+        self.port = None
+        self.started = time.monotonic()
+        self.healthy = False
+        self.failures = 0
+        self.next_check = 0.0
+        # Set once the worker was asked to stop: SIGKILL after this time
+        self.kill_at = None
+
+
+class Master:
+    def __init__(self, load_worker, host="0.0.0.0", port=80, workers=2, worker_exit=None,
+                 graceful_timeout=30, health_interval=5, health_timeout=2, max_failures=3,
+                 boot_timeout=60, backlog=1024):
+        # load_worker(index) runs in the worker and returns (wsgi_app, threads);
+        # worker_exit() runs there after the last request
+        self.load_worker = load_worker
+        self.worker_exit = worker_exit
+        self.host = host
+        self.port = port
+        self.workers = workers
+        self.graceful_timeout = graceful_timeout
+        self.health_interval = health_interval
+        self.health_timeout = health_timeout
+        self.max_failures = max_failures
+        self.boot_timeout = boot_timeout
+        self.backlog = backlog
+        self.listener = None
+        self.children = {}
+        self.retiring = {}
+        self.respawn_at = {}
+        self.backoff = {}
+        self.stopping = False
+        self.reloading = False
+
+    def bind(self):
+        family = socket.AF_INET6 if ":" in self.host else socket.AF_INET
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((self.host, self.port))
+        sock.listen(self.backlog)
+        sock.set_inheritable(True)
+        self.listener = sock
+        return sock
+
+    def run(self):
+        if not hasattr(os, "fork"):
+            raise RuntimeError("prefork mode needs os.fork(); run one process on this platform")
+        if self.listener is None:
+            self.bind()
+        signal.signal(signal.SIGTERM, self._on_stop)
+        signal.signal(signal.SIGINT, self._on_stop)
+        signal.signal(signal.SIGHUP, self._on_reload)
+        host, port = self.listener.getsockname()[:2]
+        logger.info("master %d serving on http://%s:%d with %d workers",
+                    os.getpid(), host, port, self.workers)
+
+        for index in range(self.workers):
+            self.spawn(index)
+        try:
+            while not self.stopping:
+                if self.reloading:
+                    self.reloading = False
+                    self.rolling_restart()
+                self.tick()
+                time.sleep(0.2)
+        finally:
+            self.stop()
+
+    def _on_stop(self, signum, frame):
+        self.stopping = True
+
+    def _on_reload(self, signum, frame):
+        self.reloading = True
+
+    # Master side
+
+    def spawn(self, index):
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read_fd)
+            code = 1
+            try:
+                code = self._worker_main(index, write_fd)
+            except BaseException:
+                logger.exception("worker %d failed", index)
+            finally:
+                logging.shutdown()
+                os._exit(code)
+        os.close(write_fd)
+        os.set_blocking(read_fd, False)
+        worker = Worker(index, pid, read_fd)
+        self.children[pid] = worker
+        logger.info("worker %d started (pid %d)", index, pid)
+        return worker
+
+    def tick(self):
+        now = time.monotonic()
+        self.reap()
+        for worker in list(self.children.values()):
+            self._read_port(worker)
+            if worker.port is None:
+                if now - worker.started > self.boot_timeout:
+                    logger.error("worker %d (pid %d) did not start in %ds",
+                                 worker.index, worker.pid, self.boot_timeout)
+                    self.kill(worker)
+            elif now >= worker.next_check:
+                self.check(worker)
+        for pid, worker in list(self.retiring.items()):
+            if now >= worker.kill_at:
+                logger.warning("worker %d (pid %d) still busy, killing it", worker.index, pid)
+                _signal(pid, signal.SIGKILL)
+                worker.kill_at = float("inf")
+        running = {w.index for w in self.children.values()}
+        for index in range(self.workers):
+            if index not in running and now >= self.respawn_at.get(index, 0):
+                self.spawn(index)
+
+    def reap(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            worker = self.children.pop(pid, None) or self.retiring.pop(pid, None)
+            if worker is None:
+                continue
+            os.close(worker.pipe)
+            if worker.kill_at is not None:
+                logger.info("worker %d (pid %d) stopped", worker.index, pid)
+                continue
+            logger.error("worker %d (pid %d) exited with status %d",
+                         worker.index, pid, os.waitstatus_to_exitcode(status))
+            # Back off when a worker keeps dying right after it starts
+            if time.monotonic() - worker.started < 10:
+                delay = min(self.backoff.get(worker.index, 0.5) * 2, 30)
+            else:
+                delay = 0
+            self.backoff[worker.index] = delay or 0.5
+            self.respawn_at[worker.index] = time.monotonic() + delay
+
+    def _read_port(self, worker):
+        if worker.port is not None:
+            return
+        try:
+            data = os.read(worker.pipe, 16)
+        except BlockingIOError:
+            return
+        if data:
+            worker.port = int(data)
+
+    def check(self, worker):
+        worker.next_check = time.monotonic() + self.health_interval
+        conn = http.client.HTTPConnection("127.0.0.1", worker.port, timeout=self.health_timeout)
+        try:
+            conn.request("GET", HEALTH_PATH)
+            response = conn.getresponse()
+            response.read()
+            ok = response.status == 200
+        except OSError:
+            ok = False
+        finally:
+            conn.close()
+        if ok:
+            if not worker.healthy:
+                logger.info("worker %d (pid %d) is healthy on port %d",
+                            worker.index, worker.pid, worker.port)
+            worker.healthy = True
+            worker.failures = 0
+            return True
+        worker.failures += 1
+        logger.warning("worker %d (pid %d) failed health check %d/%d",
+                       worker.index, worker.pid, worker.failures, self.max_failures)
+        if worker.failures >= self.max_failures:
+            self.kill(worker)
+        return False
+
+    def kill(self, worker):
+        # An unresponsive worker gets no grace period; tick() replaces it
+        self.children.pop(worker.pid, None)
+        worker.kill_at = float("inf")
+        self.retiring[worker.pid] = worker
+        _signal(worker.pid, signal.SIGKILL)
+
+    def retire(self, worker):
+        self.children.pop(worker.pid, None)
+        worker.kill_at = time.monotonic() + self.graceful_timeout
+        self.retiring[worker.pid] = worker
+        _signal(worker.pid, signal.SIGTERM)
+
+    def rolling_restart(self):
+        logger.info("rolling restart of %d workers", len(self.children))
+        for old in sorted(self.children.values(), key=lambda w: w.index):
+            if self.stopping:
+                return
+            new = self.spawn(old.index)
+            # The replacement gets the old worker's slot once it is healthy;
+            # until then both serve
+            del self.children[new.pid]
+            self.retiring[new.pid] = new
+            new.kill_at = float("inf")
+            if not self._wait_healthy(new):
+                logger.error("replacement for worker %d never became healthy; "
+                             "keeping the old one", old.index)
+                self.kill_retiring(new)
+                continue
+            del self.retiring[new.pid]
+            new.kill_at = None
+            self.children[new.pid] = new
+            if old.pid in self.children:
+                self.retire(old)
+
+    def _wait_healthy(self, worker):
+        deadline = time.monotonic() + self.boot_timeout
+        while time.monotonic() < deadline and not self.stopping:
+            self.reap()
+            if worker.pid not in self.retiring:
+                return False
+            self._read_port(worker)
+            if worker.port is not None and self.check(worker):
+                return True
+            time.sleep(0.2)
+        return False
+
+    def kill_retiring(self, worker):
+        if worker.pid in self.retiring:
+            _signal(worker.pid, signal.SIGKILL)
+
+    def stop(self):
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        for worker in list(self.children.values()):
+            self.retire(worker)
+        deadline = time.monotonic() + self.graceful_timeout
+        while self.retiring and time.monotonic() < deadline:
+            self.reap()
+            time.sleep(0.1)
+        for pid in list(self.retiring):
+            _signal(pid, signal.SIGKILL)
+        while self.retiring:
+            try:
+                pid, _ = os.waitpid(-1, 0)
+            except ChildProcessError:
+                break
+            self.retiring.pop(pid, None)
+        if self.listener is not None:
+            self.listener.close()
+        logger.info("master %d stopped", os.getpid())
+
+    # Worker side
+
+    def _worker_main(self, index, pipe):
+        state = {"stopping": False, "deadline": None}
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        for worker in self.children.values():
+            os.close(worker.pipe)
+        self.children = {}
+        self.retiring = {}
+
+        app, threads = self.load_worker(index)
+        health = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        health.bind(("127.0.0.1", 0))
+        health.listen(16)
+        server = create_server(app, sockets=[self.listener, health], threads=threads)
+
+        def stop(signum, frame):
+            # Handled between polls: closing a socket select() is waiting on
+            # from here would make it fail with EBADF
+            if state["deadline"] is None:
+                state["deadline"] = time.monotonic() + self.graceful_timeout
+
+        signal.signal(signal.SIGTERM, stop)
+        os.write(pipe, str(health.getsockname()[1]).encode())
+        os.close(pipe)
+
+        while server.map:
+            if state["deadline"] is not None:
+                if not state["stopping"]:
+                    state["stopping"] = True
+                    # Stop accepting; the other workers keep the shared socket open
+                    for obj in list(server.map.values()):
+                        if isinstance(obj, BaseWSGIServer):
+                            obj.close()
+                if not _busy(server) or time.monotonic() > state["deadline"]:
+                    break
+            try:
+                wasyncore.loop(
+                    timeout=server.adj.asyncore_loop_timeout,
+                    map=server.map,
+                    use_poll=server.adj.asyncore_use_poll,
+                    count=1,
+                )
+            except InterruptedError:
+                pass
+        server.close()
+        if self.worker_exit is not None:
+            self.worker_exit()
+        return 0
+
+
+def _busy(server):
+    # Requests queued or running, or responses not yet sent. Idle keep-alive
+    # connections don't count; they are closed on exit.
+    dispatcher = server.task_dispatcher
+    if dispatcher.queue or dispatcher.active_count:
+        return True
+    return any(
+        isinstance(obj, HTTPChannel) and (obj.requests or obj.total_outbufs_len)
+        for obj in list(server.map.values())
+    )
+
+
+def _signal(pid, signum):
+    try:
+        os.kill(pid, signum)
+    except ProcessLookupError:
+        pass
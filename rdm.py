@@ -0,0 +1,176 @@
+import argparse
+import hashlib
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import create_engine, text
+
+from snapshots import analysis_db
+
+# Representational dissimilarity matrices (RDMs) from participants'
+# arrangements. For each question, every participant's final (x, y) positions
+# become one row of a (participants, stimuli, 2) array and all pairwise
+# distances are computed in one vectorized step, in condensed form: only the
+# upper triangle, in np.triu_indices order, like scipy's pdist.
+#
+# Results are cached as .npz files keyed by the user_location high-water mark
+# (max id and row count for the question), so re-running after new
+# submissions recomputes and otherwise loads instantly.
+
+CACHE_FOLDER = os.path.join("instance", "analysis")
+
+
+class Arrangements:
+    def __init__(self, question, participants, stimuli, coords):
+        self.question = question
+        # participants: user_id per row; stimuli: src per column
+        self.participants = participants
+        self.stimuli = stimuli
+        # (participants, stimuli, 2); NaN where a participant didn't place a stimulus
+        self.coords = coords
+
+
+def list_questions(engine):
+    with engine.connect() as conn:
+        rows = conn.execute(
+            text("SELECT DISTINCT question FROM user_location WHERE question IS NOT NULL")
+        )
+        return sorted(row[0] for row in rows)
+
+
+def watermark(engine, question):
+    with engine.connect() as conn:
+        max_id, count = conn.execute(
+            text("SELECT max(id), count(*) FROM user_location WHERE question = :q"),
+            {"q": question},
+        ).one()
+    return (max_id or 0, count)
+
+
+def load_arrangements(engine, question):
+    frame = pd.read_sql(
+        text(
+            "SELECT id, user_id, src, final_x, final_y FROM user_location "
+            "WHERE question = :q AND user_id IS NOT NULL AND src IS NOT NULL ORDER BY id"
+        ),
+        engine,
+        params={"q": question},
+    )
+    # A stimulus placed twice by the same participant keeps its last position
+    frame = frame.drop_duplicates(["user_id", "src"], keep="last")
+
+    participant_codes, participants = pd.factorize(frame["user_id"])
+    stimulus_codes, stimuli = pd.factorize(frame["src"], sort=True)
+
+    coords = np.full((len(participants), len(stimuli), 2), np.nan)
+    coords[participant_codes, stimulus_codes, 0] = frame["final_x"].to_numpy(float)
+    coords[participant_codes, stimulus_codes, 1] = frame["final_y"].to_numpy(float)
+    return Arrangements(question, np.asarray(participants), np.asarray(stimuli), coords)
+
+
+def condensed_index(n_stimuli):
+    return np.triu_indices(n_stimuli, k=1)
+
+
+def participant_rdms(coords, normalize=False, chunk_size=4096):
+    # (participants, pairs) Euclidean distances, NaN for pairs involving a
+    # stimulus the participant didn't place. With normalize=True each row is
+    # divided by its RMS distance, removing differences in how spread out
+    # participants made their arrangements.
+    n_participants, n_stimuli, _ = coords.shape
+    i, j = condensed_index(n_stimuli)
+    out = np.empty((n_participants, len(i)))
+    for start in range(0, n_participants, chunk_size):
+        block = coords[start:start + chunk_size]
+        diff = block[:, i, :] - block[:, j, :]
+        out[start:start + chunk_size] = np.hypot(diff[..., 0], diff[..., 1])
+    if normalize:
+        with np.errstate(invalid="ignore", divide="ignore"):
+            rms = np.sqrt(np.nanmean(out ** 2, axis=1, keepdims=True))
+            out /= rms
+    return out
+
+
+def group_mean_rdm(rdms):
+    # Mean over participants, ignoring pairs a participant didn't place
+    with np.errstate(invalid="ignore"):
+        counts = np.sum(~np.isnan(rdms), axis=0)
+        sums = np.nansum(rdms, axis=0)
+        return np.where(counts > 0, sums / np.maximum(counts, 1), np.nan)
+
+
+def squareform(condensed, n_stimuli):
+    matrix = np.zeros(condensed.shape[:-1] + (n_stimuli, n_stimuli))
+    i, j = condensed_index(n_stimuli)
+    matrix[..., i, j] = condensed
+    matrix[..., j, i] = condensed
+    return matrix
+
+
+def _cache_path(cache_folder, question, mark, normalize):
+    key = hashlib.sha256(question.encode()).hexdigest()[:16]
+    suffix = "_norm" if normalize else ""
+    return os.path.join(cache_folder, f"rdm_{key}_{mark[0]}_{mark[1]}{suffix}.npz")
+
+
+def compute_rdms(engine, question, normalize=False, cache_folder=CACHE_FOLDER):
+    # Returns a dict with participants, stimuli, rdms (condensed, one row per
+    # participant) and mean (condensed group RDM), from cache when up to date
+    mark = watermark(engine, question)
+    path = _cache_path(cache_folder, question, mark, normalize) if cache_folder else None
+    if path and os.path.exists(path):
+        with np.load(path, allow_pickle=True) as cached:
+            return {key: cached[key] for key in cached.files}
+
+    arrangements = load_arrangements(engine, question)
+    rdms = participant_rdms(arrangements.coords, normalize=normalize)
+    result = {
+        "question": np.array(question),
+        "participants": arrangements.participants,
+        "stimuli": arrangements.stimuli,
+        "rdms": rdms,
+        "mean": group_mean_rdm(rdms),
+    }
+    if path:
+        os.makedirs(cache_folder, exist_ok=True)
+        tmp_path = path + ".tmp.npz"
+        np.savez(tmp_path, **result)
+        os.replace(tmp_path, path)
+    return result
+
+
+def write_mean_csv(result, path):
+    stimuli = [str(s) for s in result["stimuli"]]
+    matrix = squareform(result["mean"], len(stimuli))
+    pd.DataFrame(matrix, index=stimuli, columns=stimuli).to_csv(path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compute RDMs from participant arrangements")
+    parser.add_argument("--db", help="database URI (default: the newest snapshot, see snapshots.py)")
+    parser.add_argument("--question", help="only this question (default: all)")
+    parser.add_argument("--normalize", action="store_true",
+                        help="scale each participant's distances to unit RMS")
+    parser.add_argument("--csv-dir", help="write each group-mean RDM as CSV here")
+    parser.add_argument("--no-cache", action="store_true")
+    args = parser.parse_args()
+
+    engine = create_engine(args.db or analysis_db())
+    questions = [args.question] if args.question else list_questions(engine)
+    if not questions:
+        print("No arrangements found")
+        sys.exit(1)
+
+    for n, question in enumerate(questions):
+        result = compute_rdms(
+            engine, question, args.normalize, None if args.no_cache else CACHE_FOLDER
+        )
+        print(
+            f"{question!r}: {len(result['participants'])} participants, "
+            f"{len(result['stimuli'])} stimuli"
+        )
+        if args.csv_dir:
+            os.makedirs(args.csv_dir, exist_ok=True)
+            write_mean_csv(result, os.path.join(args.csv_dir, f"mean_rdm_{n + 1}.csv"))
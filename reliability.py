@@ -0,0 +1,254 @@
+import argparse
+import hashlib
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from statistics import NormalDist
+
+import numpy as np
+from sqlalchemy import create_engine
+
+from rdm import CACHE_FOLDER, compute_rdms, list_questions, watermark
+from snapshots import analysis_db
+
+# How reliable is the group RDM for a question? Reports
+#
+#   split_half: correlation between the group RDMs of two random halves of
+#     the participants, Spearman-Brown corrected to the full sample size;
+#   noise ceiling (Nili et al. 2014): the mean correlation of each
+#     participant's RDM with the group mean including them (upper bound) and
+#     excluding them (lower bound);
+#
+# each with a bootstrap interval over participants.
+#
+# The (participants, pairs) matrix is written once to a .npy file that every
+# worker memory-maps, and a bootstrap sample is represented by how often each
+# participant was drawn rather than by copying rows, so memory stays at the
+# size of that matrix however many iterations run. Iterations are grouped in
+# blocks, each with its own RNG stream spawned from one seed, which makes the
+# results independent of the number of workers.
+
+_matrix = None
+
+
+def matrix_path(engine, question, normalize, cache_folder=CACHE_FOLDER):
+    # Builds (or reuses) the participant matrix for a question as float32 .npy
+    mark = watermark(engine, question)
+    key = hashlib.sha256(question.encode()).hexdigest()[:16]
+    suffix = "_norm" if normalize else ""
+    path = os.path.join(cache_folder, f"matrix_{key}_{mark[0]}_{mark[1]}{suffix}.npy")
+    if not os.path.exists(path):
+        rdms = compute_rdms(engine, question, normalize, cache_folder)["rdms"]
+        os.makedirs(cache_folder, exist_ok=True)
+        tmp_path = path + ".tmp.npy"
+        np.save(tmp_path, rdms.astype(np.float32))
+        os.replace(tmp_path, path)
+    return path
+
+
+def row_correlations(rows, target):
+    # Pearson correlation of each row with target (one row or one per row),
+    # over the pairs present in both. Built from sums of moments so that a
+    # shared target costs matrix-vector products rather than row-sized
+    # temporaries.
+    present = ~np.isnan(rows)
+    x = np.where(present, rows, 0.0)
+    if target.ndim == 1:
+        both = (~np.isnan(target)).astype(float)
+        y = np.where(both > 0, target, 0.0)
+        n, sx, sxx = present @ both, x @ both, (x * x) @ both
+        sy, syy, sxy = present @ y, present @ (y * y), x @ y
+    else:
+        both = present & ~np.isnan(target)
+        x = np.where(both, x, 0.0)
+        y = np.where(both, target, 0.0)
+        n, sx, sy = both.sum(axis=1), x.sum(axis=1), y.sum(axis=1)
+        sxx = np.einsum("ij,ij->i", x, x)
+        syy = np.einsum("ij,ij->i", y, y)
+        sxy = np.einsum("ij,ij->i", x, y)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        cov = sxy - sx * sy / n
+        return cov / np.sqrt((sxx - sx * sx / n) * (syy - sy * sy / n))
+
+
+def weighted_sums(matrix, weights, chunk_size):
+    # Sums and counts of the non-NaN values per pair, each row counted
+    # weights[n][row] times, for every weight vector at once
+    weights = np.asarray(weights)
+    sums = np.zeros((len(weights), matrix.shape[1]))
+    counts = np.zeros((len(weights), matrix.shape[1]))
+    for start in range(0, matrix.shape[0], chunk_size):
+        block = np.asarray(matrix[start:start + chunk_size], dtype=np.float64)
+        present = ~np.isnan(block)
+        w = weights[:, start:start + chunk_size]
+        sums += w @ np.where(present, block, 0.0)
+        counts += w @ present
+    return sums, counts
+
+
+def _mean(sums, counts):
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(counts > 0, sums / counts, np.nan)
+
+
+def sample_stats(matrix, weights, half_a, half_b, chunk_size=1024):
+    # Split-half and noise-ceiling statistics for one (re)sample, given as
+    # the number of times each participant is in it and in each half
+    (total, sum_a, sum_b), (count, count_a, count_b) = weighted_sums(
+        matrix, (weights, half_a, half_b), chunk_size
+    )
+    r_half = row_correlations(_mean(sum_a, count_a)[None], _mean(sum_b, count_b))[0]
+    split_half = 2 * r_half / (1 + r_half)
+
+    group = _mean(total, count)
+    upper = lower = 0.0
+    drawn = 0
+    for start in range(0, matrix.shape[0], chunk_size):
+        w = weights[start:start + chunk_size]
+        if not w.any():
+            continue
+        block = np.asarray(matrix[start:start + chunk_size], dtype=np.float64)[w > 0]
+        w = w[w > 0]
+        present = ~np.isnan(block)
+        # Leave out every copy of the participant drawn into the sample
+        others = _mean(
+            total - w[:, None] * np.where(present, block, 0.0), count - w[:, None] * present
+        )
+        r_upper = row_correlations(block, group)
+        r_lower = row_correlations(block, others)
+        ok = ~np.isnan(r_upper) & ~np.isnan(r_lower)
+        upper += w[ok] @ r_upper[ok]
+        lower += w[ok] @ r_lower[ok]
+        drawn += w[ok].sum()
+    if not drawn:
+        return split_half, np.nan, np.nan
+    return split_half, lower / drawn, upper / drawn
+
+
+def _split(rng, members, n_participants):
+    # Random halves of a sample, keeping every copy of a participant drawn
+    # more than once in the same half so it can't correlate with itself
+    drawn = np.bincount(members, minlength=n_participants)
+    order = rng.permutation(np.flatnonzero(drawn))
+    in_a = order[np.cumsum(drawn[order]) <= len(members) // 2]
+    half_a = np.zeros(n_participants)
+    half_a[in_a] = drawn[in_a]
+    return half_a, drawn - half_a
+
+
+def _init_worker(path):
+    global _matrix
+    _matrix = np.load(path, mmap_mode="r")
+
+
+def _run_block(args):
+    seed, iterations, bootstrap, chunk_size = args
+    rng = np.random.default_rng(seed)
+    n_participants = _matrix.shape[0]
+    everyone = np.arange(n_participants)
+    out = np.empty((iterations, 3))
+    for n in range(iterations):
+        members = rng.integers(n_participants, size=n_participants) if bootstrap else everyone
+        weights = np.bincount(members, minlength=n_participants).astype(float)
+        half_a, half_b = _split(rng, members, n_participants)
+        out[n] = sample_stats(_matrix, weights, half_a, half_b, chunk_size)
+    return out
+
+
+def estimate_reliability(path, iterations=1000, splits=100, workers=None, seed=0,
+                         block_size=25, confidence=0.95, chunk_size=1024):
+    start = time.perf_counter()
+    seeds = np.random.SeedSequence(seed)
+    split_seeds, boot_seeds = seeds.spawn(2)
+    jobs = []
+    for bootstrap, total, parent in ((False, splits, split_seeds), (True, iterations, boot_seeds)):
+        sizes = [min(block_size, total - i) for i in range(0, total, block_size)]
+        jobs += [
+            (child, size, bootstrap, chunk_size)
+            for child, size in zip(parent.spawn(len(sizes)), sizes)
+        ]
+    n_splits = -(-splits // block_size) if splits else 0
+
+    if workers == 1:
+        _init_worker(path)
+        results = [_run_block(job) for job in jobs]
+    else:
+        with ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(path,)) as pool:
+            results = list(pool.map(_run_block, jobs))
+    split_runs = np.concatenate(results[:n_splits]) if n_splits else np.empty((0, 3))
+    boot_runs = np.concatenate(results[n_splits:]) if iterations else np.empty((0, 3))
+
+    matrix = np.load(path, mmap_mode="r")
+    everyone = np.ones(matrix.shape[0])
+    _, lower, upper = sample_stats(matrix, everyone, everyone, everyone, chunk_size)
+    point = {
+        "split_half": float(np.nanmean(split_runs[:, 0])) if len(split_runs) else np.nan,
+        "noise_ceiling_lower": lower,
+        "noise_ceiling_upper": upper,
+    }
+
+    # Resamples hold fewer distinct participants than the data, which biases
+    # these statistics, so intervals are the estimate +- z bootstrap standard
+    # errors rather than bootstrap percentiles; the bias is reported alongside
+    z = NormalDist().inv_cdf(0.5 + confidence / 2)
+    result = {"participants": int(matrix.shape[0]), "pairs": int(matrix.shape[1])}
+    for column, name in enumerate(point):
+        values = boot_runs[:, column]
+        values = values[~np.isnan(values)]
+        se = float(np.std(values, ddof=1)) if len(values) > 1 else np.nan
+        bias = float(np.mean(values) - point[name]) if len(values) else np.nan
+        estimate = float(point[name])
+        result[name] = {
+            "estimate": estimate,
+            "se": se,
+            "bias": bias,
+            "ci": [estimate - z * se, estimate + z * se],
+        }
+    result["iterations"] = iterations
+    result["splits"] = splits
+    result["seconds"] = time.perf_counter() - start
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Split-half reliability and noise ceiling of group RDMs, with bootstrap CIs"
+    )
+    parser.add_argument("--db", help="database URI (default: the newest snapshot, see snapshots.py)")
+    parser.add_argument("--question", help="only this question (default: all)")
+    parser.add_argument("--iterations", type=int, default=1000, help="bootstrap resamples")
+    parser.add_argument("--splits", type=int, default=100,
+                        help="random splits averaged for the split-half estimate")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="worker processes (default: one per core)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--confidence", type=float, default=0.95)
+    parser.add_argument("--raw", action="store_true",
+                        help="use raw distances instead of scaling each participant to unit RMS")
+    parser.add_argument("--json", help="also write the results here")
+    args = parser.parse_args()
+
+    engine = create_engine(args.db or analysis_db())
+    questions = [args.question] if args.question else list_questions(engine)
+    if not questions:
+        print("No arrangements found")
+        sys.exit(1)
+
+    report = {}
+    for question in questions:
+        path = matrix_path(engine, question, normalize=not args.raw)
+        result = estimate_reliability(
+            path, args.iterations, args.splits, args.workers, args.seed,
+            confidence=args.confidence,
+        )
+        report[question] = result
+        print(f"{question!r}: {result['participants']} participants, {result['seconds']:.1f}s")
+        for name in ("split_half", "noise_ceiling_lower", "noise_ceiling_upper"):
+            low, high = result[name]["ci"]
+            print(f"  {name:>20}: {result[name]['estimate']:.3f} [{low:.3f}, {high:.3f}]")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
@@ -0,0 +1,318 @@
+import argparse
+import hashlib
+import operator
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import bindparam, create_engine, inspect, text
+
+from aggregates import reference_positions
+from counterbalance import load_locations as load_layout
+from rdm import CACHE_FOLDER, list_questions
+from snapshots import analysis_db
+from trajectories import decode_batch
+
+# Data-quality screening of participant arrangements. For each question,
+# every participant's final positions are compared with the admin layout
+# (the most recent admin_location per src, as in aggregates.py) and scored:
+#
+#   placed, missing     stimuli placed, and layout stimuli not placed
+#   repeated            extra rows for a src the participant already placed
+#   mean_displacement   mean distance moved from initial_x/initial_y, or from
+#                       the participant's counterbalanced layout if they had one
+#   unmoved_fraction    share of stimuli left within UNMOVED_PX of the start
+#   spread              RMS distance from the participant's own centroid
+#   stacked_fraction    share of stimuli sharing a STACK_CELL_PX grid cell
+#                       with another one
+#   task_seconds        page load to last drag, from the last trajectory
+#                       batch (NaN without trajectories)
+#
+# All participants are scored at once with NumPy group sums over factorized
+# participant codes. Scores are cached per question with the user_location
+# high-water mark, so a run only scores participants with new rows, unless
+# the admin layout changed. Flags are applied to the cached scores on every
+# run, so changing a threshold needs no rescoring.
+#
+#     python screening.py [--question Q] [--set clumped=40] [--csv scores.csv] [--all]
+
+UNMOVED_PX = 2.0
+STACK_CELL_PX = 10.0
+
+THRESHOLDS = {
+    # flag: (score, comparison, default); a NaN score never raises a flag
+    "unmoved": ("unmoved_fraction", operator.ge, 0.9),
+    "clumped": ("spread", operator.lt, 25.0),
+    "stacked": ("stacked_fraction", operator.ge, 0.5),
+    "incomplete": ("missing", operator.gt, 0),
+    "repeated": ("repeated", operator.gt, 0),
+    "fast": ("task_seconds", operator.lt, 20.0),
+}
+
+def load_locations(engine, question, after_id=None):
+    # Rows for the question, or with after_id, every row of the participants
+    # who have rows newer than it
+    columns = {c["name"] for c in inspect(engine).get_columns("demographics")}
+    # Databases from before counterbalancing have no layout_id
+    layout = "d.layout_id" if "layout_id" in columns else "NULL AS layout_id"
+    query = (
+        f"SELECT u.id, u.user_id, d.participant_id, {layout}, u.src, u.final_x, u.final_y "
+        "FROM user_location u LEFT JOIN demographics d ON d.id = u.user_id "
+    )
+    params = {"q": question}
+    if after_id is None:
+        # Scanned in id order; most rows match, so this beats the
+        # (question, src) index followed by a sort
+        query += "WHERE +u.question = :q AND u.user_id IS NOT NULL"
+    else:
+        # New rows by id range, then those participants' rows by user_id
+        query += (
+            "WHERE +u.question = :q AND u.user_id IN "
+            "(SELECT user_id FROM user_location WHERE id > :after_id AND +question = :q)"
+        )
+        params["after_id"] = after_id
+    return pd.read_sql(text(query + " ORDER BY u.id"), engine, params=params)
+
+
+def assigned_starts(engine, question, layout_ids):
+    # Starting positions of the question's stimuli in the given
+    # counterbalanced layouts, as a frame with layout_id, src, x and y columns
+    rows = []
+    with engine.connect() as conn:
+        for layout_id in layout_ids:
+            for loc in load_layout(conn, int(layout_id)) or ():
+                if loc["question"] == question:
+                    rows.append((layout_id, loc["src"], loc["initial_x"], loc["initial_y"]))
+    return pd.DataFrame(rows, columns=["layout_id", "src", "x", "y"])
+
+
+def score(frame, reference, assigned=None):
+    # frame: user_location rows for one question in id order; reference:
+    # src -> (initial_x, initial_y); assigned: assigned_starts() for the
+    # counterbalanced layouts in frame. Returns one row of scores per participant.
+    codes, users = pd.factorize(frame["user_id"])
+    src_codes, stimuli = pd.factorize(frame["src"])
+    n_users = len(users)
+    rows = np.bincount(codes, minlength=n_users)
+
+    # A stimulus placed twice by the same participant keeps its last position
+    pair = codes.astype(np.int64) * max(len(stimuli), 1) + src_codes
+    last = ~pd.Series(pair).duplicated(keep="last").to_numpy()
+    codes = codes[last]
+    src_codes = src_codes[last]
+    x = frame["final_x"].to_numpy(float)[last]
+    y = frame["final_y"].to_numpy(float)[last]
+    repeated = rows - np.bincount(codes, minlength=n_users)
+
+    placed = ~(np.isnan(x) | np.isnan(y))
+    x0 = np.where(placed, x, 0.0)
+    y0 = np.where(placed, y, 0.0)
+    n = np.bincount(codes, placed, n_users)
+
+    # Admin starting positions per stimulus code, NaN outside the layout
+    starts = pd.DataFrame.from_dict(
+        reference, orient="index", columns=["x", "y"], dtype=float
+    ).reindex(stimuli)
+    ix = starts["x"].to_numpy()[src_codes]
+    iy = starts["y"].to_numpy()[src_codes]
+    if assigned is not None and len(assigned):
+        # Participants dealt a counterbalanced layout started from that instead
+        own = frame[["layout_id", "src"]].merge(assigned, how="left", on=["layout_id", "src"])
+        has_layout = frame["layout_id"].notna().to_numpy()[last]
+        ix = np.where(has_layout, own["x"].to_numpy(float)[last], ix)
+        iy = np.where(has_layout, own["y"].to_numpy(float)[last], iy)
+    has_start = placed & ~np.isnan(ix)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        cx = np.bincount(codes, x0, n_users) / n
+        cy = np.bincount(codes, y0, n_users) / n
+        squares = np.where(placed, (x0 - cx[codes]) ** 2 + (y0 - cy[codes]) ** 2, 0.0)
+        spread = np.sqrt(np.bincount(codes, squares, n_users) / n)
+
+        moved = np.where(has_start, np.hypot(x0 - ix, y0 - iy), 0.0)
+        compared = np.bincount(codes, has_start, n_users)
+        mean_displacement = np.bincount(codes, moved, n_users) / compared
+        unmoved = np.bincount(codes, has_start & (moved < UNMOVED_PX), n_users) / compared
+
+        # Stimuli whose grid cell holds another of the same participant's
+        gx = np.floor(x0 / STACK_CELL_PX).astype(np.int64)
+        gy = np.floor(y0 / STACK_CELL_PX).astype(np.int64)
+        gx -= gx.min(initial=0)
+        gy -= gy.min(initial=0)
+        cell = (codes * (gx.max(initial=0) + 1) + gx) * (gy.max(initial=0) + 1) + gy
+        shared = pd.Series(np.where(placed, cell, -1 - np.arange(len(cell)))).duplicated(keep=False)
+        stacked = np.bincount(codes, shared.to_numpy(), n_users) / n
+
+    first = ~frame.duplicated("user_id").to_numpy()
+    return pd.DataFrame({
+        "user_id": np.asarray(users),
+        "participant_id": frame["participant_id"].to_numpy()[first],
+        "placed": n.astype(int),
+        "missing": len(reference) - np.bincount(codes, has_start, n_users).astype(int),
+        "repeated": repeated,
+        "mean_displacement": mean_displacement,
+        "unmoved_fraction": unmoved,
+        "spread": spread,
+        "stacked_fraction": stacked,
+    })
+
+
+def task_seconds(engine, user_ids, chunk_size=500):
+    # Time from the participant page loading to the last drag, from the last
+    # trajectory batch of each submission
+    seconds = {}
+    ids = list(user_ids)
+    if not inspect(engine).has_table("trajectory_batch"):
+        return pd.Series(seconds, dtype=float)
+    query = text(
+        "SELECT d.id, (SELECT t.data FROM trajectory_batch t "
+        "WHERE t.submission_id = d.submission_id ORDER BY t.id DESC LIMIT 1) "
+        "FROM demographics d WHERE d.id IN :ids"
+    ).bindparams(bindparam("ids", expanding=True))
+    with engine.connect() as conn:
+        for start in range(0, len(ids), chunk_size):
+            rows = conn.execute(query, {"ids": ids[start:start + chunk_size]})
+            for user_id, blob in rows:
+                t = decode_batch(blob)["t"] if blob is not None else ()
+                if len(t):
+                    seconds[user_id] = float(t[-1]) / 1000
+    return pd.Series(seconds, dtype=float)
+
+
+def _layout_key(reference):
+    body = repr(sorted(reference.items())).encode()
+    return hashlib.sha256(body).hexdigest()[:16]
+
+
+def _count_through(engine, question, max_id):
+    with engine.connect() as conn:
+        return conn.execute(
+            text("SELECT count(*) FROM user_location WHERE question = :q AND id <= :max_id"),
+            {"q": question, "max_id": max_id},
+        ).scalar()
+
+
+def _cache_path(cache_folder, question):
+    key = hashlib.sha256(question.encode()).hexdigest()[:16]
+    return os.path.join(cache_folder, f"screening_{key}.npz")
+
+
+def _read_cache(path):
+    with np.load(path, allow_pickle=True) as cached:
+        meta = cached["meta"].item()
+        scores = pd.DataFrame({key: cached[key] for key in cached.files if key != "meta"})
+    return meta, scores
+
+
+def screen(engine, question, cache_folder=CACHE_FOLDER):
+    # Scores for every participant who answered the question, rescoring only
+    # those with rows added since the cached run
+    with engine.connect() as conn:
+        reference = reference_positions(conn, question)
+        max_id = conn.execute(
+            text("SELECT coalesce(max(id), 0) FROM user_location WHERE question = :q"),
+            {"q": question},
+        ).scalar()
+    layout = _layout_key(reference)
+
+    cached = None
+    path = _cache_path(cache_folder, question) if cache_folder else None
+    if path and os.path.exists(path):
+        meta, scores = _read_cache(path)
+        # Rows deleted since, or a changed layout, mean scoring everything
+        if meta["layout"] == layout and meta["count"] == _count_through(
+            engine, question, meta["max_id"]
+        ):
+            cached = (meta, scores)
+
+    if cached is not None and cached[0]["max_id"] == max_id:
+        return cached[1]
+    after = cached[0]["max_id"] if cached is not None else None
+    frame = load_locations(engine, question, after)
+    assigned = assigned_starts(engine, question, frame["layout_id"].dropna().unique())
+    fresh = score(frame, reference, assigned)
+    seconds = task_seconds(engine, fresh["user_id"])
+    fresh["task_seconds"] = seconds.reindex(fresh["user_id"]).to_numpy()
+
+    if cached is not None:
+        old = cached[1]
+        scores = pd.concat([old[~old["user_id"].isin(fresh["user_id"])], fresh], ignore_index=True)
+    else:
+        scores = fresh
+
+    if path:
+        os.makedirs(cache_folder, exist_ok=True)
+        tmp_path = path + ".tmp.npz"
+        meta = {
+            "question": question,
+            "max_id": max_id,
+            "count": _count_through(engine, question, max_id),
+            "layout": layout,
+        }
+        np.savez(tmp_path, meta=np.array(meta, dtype=object),
+                 **{column: scores[column].to_numpy() for column in scores})
+        os.replace(tmp_path, path)
+    return scores
+
+
+def flag(scores, thresholds=None):
+    # Adds a comma-separated "flags" column; thresholds maps flag name to a
+    # value overriding the default in THRESHOLDS
+    thresholds = thresholds or {}
+    flags = pd.Series("", index=scores.index, dtype=object)
+    for name, (column, compare, default) in THRESHOLDS.items():
+        hit = compare(scores[column], thresholds.get(name, default))
+        separator = np.where(flags != "", ",", "")
+        flags = flags.mask(hit, flags + separator + name)
+    scores = scores.copy()
+    scores["flags"] = flags
+    return scores
+
+
+def _parse_thresholds(items):
+    thresholds = {}
+    for item in items:
+        name, _, value = item.partition("=")
+        if name not in THRESHOLDS or not value:
+            raise ValueError(f"Unknown threshold {item!r}; expected one of {', '.join(THRESHOLDS)}")
+        thresholds[name] = float(value)
+    return thresholds
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Flag low-quality participant arrangements")
+    parser.add_argument("--db", help="database URI (default: the newest snapshot, see snapshots.py)")
+    parser.add_argument("--question", help="only this question (default: all)")
+    parser.add_argument("--set", action="append", default=[], metavar="FLAG=VALUE",
+                        help="override a threshold, e.g. clumped=40 (repeatable)")
+    parser.add_argument("--csv", help="write the scores here")
+    parser.add_argument("--all", action="store_true", help="list every participant, not just flagged ones")
+    parser.add_argument("--no-cache", action="store_true")
+    args = parser.parse_args()
+
+    try:
+        thresholds = _parse_thresholds(args.set)
+    except ValueError as e:
+        print(e)
+        sys.exit(1)
+    engine = create_engine(args.db or analysis_db())
+    questions = [args.question] if args.question else list_questions(engine)
+    if not questions:
+        print("No arrangements found")
+        sys.exit(1)
+
+    frames = []
+    for question in questions:
+        scores = flag(screen(engine, question, None if args.no_cache else CACHE_FOLDER), thresholds)
+        scores.insert(0, "question", question)
+        frames.append(scores)
+        flagged = scores[scores["flags"] != ""]
+        print(f"{question!r}: {len(scores)} participants, {len(flagged)} flagged")
+        shown = scores if args.all else flagged
+        for row in shown.itertuples():
+            print(f"  {row.user_id:>6} {str(row.participant_id):<20} {row.flags or 'ok'}")
+
+    if args.csv:
+        pd.concat(frames, ignore_index=True).to_csv(args.csv, index=False)
+        print(f"Scores saved to {args.csv}")
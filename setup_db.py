@@ -1,12 +1,66 @@
-from app import app, db, Admin, generate_password_hash
+from app import (
+    app,
+    db,
+    Admin,
+    MediaFile,
+    add_media,
+    upload_root,
+    lookup_media,
+    read_manifest,
+    generate_password_hash,
+)
+from mp4tools import MP4_EXTENSIONS
+from migrations import run_migrations
+import counterbalance
+from compression import precompress
 import os
 
+
+def index_loose_uploads():
+    # Copies files put straight into uploads/ into the content-addressed
+    # store so they are deduplicated and served with immutable caching. The
+    # originals stay where they are: some are tracked in git, and the store
+    # under uploads/objects/ is not.
+    folder = upload_root()
+    indexed = 0
+    for filename in sorted(os.listdir(folder)):
+        path = os.path.join(folder, filename)
+        if not os.path.isfile(path) or MediaFile.query.filter_by(name=filename).first():
+            continue
+        with open(path, "rb") as f:
+            stored_name, _ = add_media(filename, f)
+        db.session.commit()
+        indexed += 1
+        print(f"Indexed upload {filename} as {stored_name}")
+    return indexed
+
+
+def backfill_manifests():
+    # Videos indexed before manifests were recorded
+    for media in MediaFile.query.filter(MediaFile.duration.is_(None)).all():
+        if os.path.splitext(media.name)[1].lower() not in MP4_EXTENSIONS:
+            continue
+        _, path = lookup_media(media.name)
+        manifest = read_manifest(path)
+        media.duration = manifest.get("duration")
+        media.width = manifest.get("width")
+        media.height = manifest.get("height")
+    db.session.commit()
+
+
 upload_folder = "uploads"
 if not os.path.exists(upload_folder):
     os.makedirs(upload_folder)
 
 with app.app_context():
+    # Bring an existing database up to date first, then create anything missing
+    for number, description in run_migrations(db.engine):
+        print(f"Applied migration {number}: {description}")
     db.create_all()
+    # A pool of participant layouts from the admin layout, if it has none yet
+    if counterbalance.refresh_pool(db.session):
+        print("Built a pool of counterbalanced layouts")
+    db.session.commit()
 
     if not Admin.query.filter_by(username="admin").first():
         admin_user = Admin(username="admin", password=generate_password_hash("admin"))
@@ -15,4 +69,10 @@ with app.app_context():
         # db.session.add(regular_user)
         db.session.commit()
 
+    index_loose_uploads()
+    backfill_manifests()
+
+    # .gz/.br copies of the static assets, served as-is by the static route
+    print(f"Precompressed {precompress(app.static_folder)} static files")
+
     print("Database setup complete.")
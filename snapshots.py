@@ -0,0 +1,154 @@
+import argparse
+import logging
+import os
+import sqlite3
+import sys
+import time
+from datetime import datetime, timezone
+
+# Point-in-time copies of the live database for exports, analysis and
+# backups, so long reads never run against instance/app.db while a session is
+# in progress.
+#
+# A snapshot is taken with SQLite's online backup API a batch of pages at a
+# time, pausing between batches. In WAL mode (the default, see
+# sqlite_profile.py) the source connection holds one read transaction for the
+# whole copy: writers carry on unblocked, and the copy is a consistent view
+# of the moment it started instead of restarting every time a participant
+# submits. Snapshots are written under a temporary name, switched out of WAL
+# mode so each is a single self-contained file, renamed into place, and the
+# oldest are deleted beyond the retention count.
+#
+#     python snapshots.py                  take one now
+#     python snapshots.py --every 30       keep taking one every 30 minutes
+#     python snapshots.py --list
+#
+# export.py, rdm.py, inverse_mds.py, reliability.py and trajectories.py read
+# the newest snapshot unless given --db, taking a fresh one first when the
+# newest is older than MAX_AGE.
+
+LIVE_DB = os.path.join("instance", "app.db")
+SNAPSHOT_FOLDER = os.path.join("instance", "snapshots")
+PREFIX = "app-"
+KEEP = int(os.getenv("SNAPSHOT_KEEP", "48"))
+MAX_AGE = int(os.getenv("SNAPSHOT_MAX_AGE", str(15 * 60)))
+# Pages copied per step (4 MiB at the default page size) and the pause after
+# each step
+PAGES = 1024
+PAUSE = 0.01
+# Without WAL the copy restarts whenever another connection writes; after
+# this many restarts it is finished in one step instead
+MAX_RESTARTS = 5
+
+logger = logging.getLogger("survey.snapshots")
+
+
+class _Restarted(Exception):
+    pass
+
+
+def list_snapshots(folder=SNAPSHOT_FOLDER):
+    # Newest first; the names sort by the UTC time they were taken
+    if not os.path.isdir(folder):
+        return []
+    names = [n for n in os.listdir(folder) if n.startswith(PREFIX) and n.endswith(".db")]
+    return [os.path.join(folder, n) for n in sorted(names, reverse=True)]
+
+
+def latest_snapshot(folder=SNAPSHOT_FOLDER):
+    snapshots = list_snapshots(folder)
+    return snapshots[0] if snapshots else None
+
+
+def prune(folder=SNAPSHOT_FOLDER, keep=KEEP):
+    removed = []
+    for path in list_snapshots(folder)[keep:]:
+        os.remove(path)
+        removed.append(path)
+    return removed
+
+
+def take_snapshot(source=LIVE_DB, folder=SNAPSHOT_FOLDER, keep=KEEP, pages=PAGES, pause=PAUSE):
+    if not os.path.exists(source):
+        raise FileNotFoundError(source)
+    os.makedirs(folder, exist_ok=True)
+    stamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S%fZ")
+    path = os.path.join(folder, f"{PREFIX}{stamp}.db")
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    start = time.perf_counter()
+    stats = {"steps": 0, "restarts": 0, "pages": 0}
+
+    src = sqlite3.connect(source, timeout=30, isolation_level=None)
+    dst = sqlite3.connect(tmp_path, isolation_level=None)
+    try:
+        wal = src.execute("PRAGMA journal_mode").fetchone()[0].lower() == "wal"
+        if wal:
+            src.execute("BEGIN")
+            src.execute("SELECT count(*) FROM sqlite_master").fetchone()
+        remaining = [None]
+
+        def progress(status, left, total):
+            stats["steps"] += 1
+            stats["pages"] = total
+            if remaining[0] is not None and left > remaining[0]:
+                stats["restarts"] += 1
+                if stats["restarts"] > MAX_RESTARTS:
+                    raise _Restarted()
+            remaining[0] = left
+
+        try:
+            src.backup(dst, pages=pages, progress=progress, sleep=pause)
+        except _Restarted:
+            logger.warning("snapshot of %s kept restarting; copying it in one step", source)
+            src.backup(dst)
+        if wal:
+            src.execute("COMMIT")
+        dst.execute("PRAGMA journal_mode=DELETE")
+    except BaseException:
+        dst.close()
+        os.remove(tmp_path)
+        raise
+    finally:
+        src.close()
+    dst.close()
+    os.replace(tmp_path, path)
+
+    stats["path"] = path
+    stats["seconds"] = time.perf_counter() - start
+    stats["removed"] = prune(folder, keep)
+    return stats
+
+
+def analysis_db(max_age=MAX_AGE, source=LIVE_DB, folder=SNAPSHOT_FOLDER):
+    # Database URI for read-only jobs: the newest snapshot, taken now if
+    # there is none from the last max_age seconds
+    path = latest_snapshot(folder)
+    if path is None or time.time() - os.path.getmtime(path) > max_age:
+        path = take_snapshot(source, folder)["path"]
+    return "sqlite:///" + path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Snapshot the live SQLite database")
+    parser.add_argument("--source", default=LIVE_DB)
+    parser.add_argument("--folder", default=SNAPSHOT_FOLDER)
+    parser.add_argument("--keep", type=int, default=KEEP, help="snapshots to keep (default %(default)s)")
+    parser.add_argument("--every", type=float, help="repeat every this many minutes")
+    parser.add_argument("--list", action="store_true", help="list snapshots, newest first")
+    args = parser.parse_args()
+
+    if args.list:
+        for path in list_snapshots(args.folder):
+            print(f"{path}  {os.path.getsize(path) / 1e6:.1f} MB")
+        sys.exit(0)
+
+    while True:
+        stats = take_snapshot(args.source, args.folder, args.keep)
+        print(
+            f"{stats['path']}: {stats['pages']} pages in {stats['steps']} steps, "
+            f"{stats['seconds']:.2f}s, {stats['restarts']} restarts; "
+            f"removed {len(stats['removed'])} old snapshots"
+        )
+        if not args.every:
+            break
+        time.sleep(args.every * 60)
@@ -0,0 +1,71 @@
+import os
+from sqlalchemy import event
+
+# SQLite settings for serving from several waitress threads at once. WAL lets
+# readers run alongside the single writer, busy_timeout makes writers wait for
+# the lock instead of failing with "database is locked", and
+# synchronous=NORMAL is durable across application crashes in WAL mode, only
+# losing the last transactions on power loss.
+#
+# Every value can be overridden with an environment variable of the same name,
+# e.g. SQLITE_BUSY_TIMEOUT_MS=10000. Set SQLITE_PROFILE=default to leave
+# SQLite's own defaults alone.
+
+PROFILES = {
+    "performance": {
+        "SQLITE_JOURNAL_MODE": "WAL",
+        "SQLITE_SYNCHRONOUS": "NORMAL",
+        "SQLITE_BUSY_TIMEOUT_MS": 15000,
+        # Negative cache_size is in KiB, so this is a 64 MiB page cache
+        "SQLITE_CACHE_SIZE": -65536,
+        "SQLITE_MMAP_SIZE": 256 * 1024 * 1024,
+        "SQLITE_TEMP_STORE": "MEMORY",
+    },
+    "default": {},
+}
+
+
+def load_profile(name=None):
+    name = name or os.getenv("SQLITE_PROFILE", "performance")
+    if name not in PROFILES:
+        raise ValueError(f"Unknown SQLite profile: {name}")
+    profile = dict(PROFILES[name])
+    for key, value in profile.items():
+        override = os.getenv(key)
+        if override is not None:
+            profile[key] = type(value)(override)
+    return profile
+
+
+def engine_options(database_uri, threads, profile):
+    # One pooled connection per waitress thread, plus a little headroom for
+    # scripts sharing the process; connections wait on the pool, not on SQLite
+    if not database_uri.startswith("sqlite:///") or ":memory:" in database_uri:
+        return {}
+    options = {"pool_size": threads, "max_overflow": 2, "pool_timeout": 30}
+    if "SQLITE_BUSY_TIMEOUT_MS" in profile:
+        options["connect_args"] = {"timeout": profile["SQLITE_BUSY_TIMEOUT_MS"] / 1000}
+    return options
+
+
+def apply_profile(engine, profile):
+    if engine.dialect.name != "sqlite" or not profile:
+        return
+    in_memory = engine.url.database in (None, "", ":memory:")
+
+    @event.listens_for(engine, "connect")
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        if "SQLITE_JOURNAL_MODE" in profile and not in_memory:
+            cursor.execute(f"PRAGMA journal_mode={profile['SQLITE_JOURNAL_MODE']}")
+        if "SQLITE_SYNCHRONOUS" in profile:
+            cursor.execute(f"PRAGMA synchronous={profile['SQLITE_SYNCHRONOUS']}")
+        if "SQLITE_BUSY_TIMEOUT_MS" in profile:
+            cursor.execute(f"PRAGMA busy_timeout={int(profile['SQLITE_BUSY_TIMEOUT_MS'])}")
+        if "SQLITE_CACHE_SIZE" in profile:
+            cursor.execute(f"PRAGMA cache_size={int(profile['SQLITE_CACHE_SIZE'])}")
+        if "SQLITE_MMAP_SIZE" in profile:
+            cursor.execute(f"PRAGMA mmap_size={int(profile['SQLITE_MMAP_SIZE'])}")
+        if "SQLITE_TEMP_STORE" in profile:
+            cursor.execute(f"PRAGMA temp_store={profile['SQLITE_TEMP_STORE']}")
+        cursor.close()
@@ -23,8 +23,11 @@ if(logoutButton != null) logoutButton.addEventListener('click', function () {
 });
 
 if(document.getElementById('saveFinalLocations') != null) document.getElementById('saveFinalLocations').addEventListener('click', function () {
-    // Save user locations
-    saveLocations('/save_user_locations', 'final_x', 'final_y');
+    // Send the rest of the drag path first so it's stored with the submission
+    flushTrajectory().finally(() => {
+        // Save user locations
+        saveLocations('/save_user_locations', 'final_x', 'final_y');
+    });
 });
 
 if(document.getElementById('saveButton') != null) document.getElementById('saveButton').addEventListener('click', function () {
@@ -35,6 +38,103 @@ if(document.getElementById('saveButton') != null) document.getElementById('saveB
 
 let selectedVideo = null;
 
+// Drag paths on the participant page. Samples go into preallocated typed
+// arrays and are posted in packed binary batches to /save_trajectory (the
+// format is described in trajectories.py), 10 bytes a sample.
+const TRAJECTORY_BATCH = 2048;
+const TRAJECTORY_FLUSH_MS = 5000;
+const recordTrajectory = document.getElementById('saveFinalLocations') != null;
+let trajectory = {
+    page: crypto.getRandomValues(new Uint32Array(1))[0],
+    seq: 0,
+    n: 0,
+    t: new Float32Array(TRAJECTORY_BATCH),
+    x: new Int16Array(TRAJECTORY_BATCH),
+    y: new Int16Array(TRAJECTORY_BATCH),
+    src: new Uint16Array(TRAJECTORY_BATCH),
+    srcs: [],
+    srcIndex: new Map(),
+    dragging: null,
+};
+
+function recordTrajectorySample(src, x, y) {
+    if (!recordTrajectory || !src) return;
+    let index = trajectory.srcIndex.get(src);
+    if (index === undefined) {
+        index = trajectory.srcs.length;
+        trajectory.srcs.push(src);
+        trajectory.srcIndex.set(src, index);
+    }
+    x = Math.round(x);
+    y = Math.round(y);
+    let last = trajectory.n - 1;
+    // dragover keeps firing while the pointer rests; keep one sample
+    if (last >= 0 && trajectory.src[last] === index && trajectory.x[last] === x && trajectory.y[last] === y) return;
+
+    let n = trajectory.n;
+    trajectory.t[n] = performance.now();
+    trajectory.x[n] = x;
+    trajectory.y[n] = y;
+    trajectory.src[n] = index;
+    trajectory.n = n + 1;
+    if (trajectory.n === TRAJECTORY_BATCH) flushTrajectory();
+}
+
+function packTrajectory() {
+    let encoder = new TextEncoder();
+    let names = trajectory.srcs.map(src => encoder.encode(src));
+    let header = new ArrayBuffer(18 + names.reduce((size, name) => size + 2 + name.length, 0));
+    let view = new DataView(header);
+    new Uint8Array(header).set(encoder.encode('TRJ1'));
+    view.setUint32(4, trajectory.page, true);
+    view.setUint32(8, trajectory.seq, true);
+    view.setUint32(12, trajectory.n, true);
+    view.setUint16(16, names.length, true);
+    let offset = 18;
+    names.forEach(name => {
+        view.setUint16(offset, name.length, true);
+        new Uint8Array(header, offset + 2).set(name);
+        offset += 2 + name.length;
+    });
+    // Typed arrays go into the Blob in the platform's byte order, which is
+    // little-endian on every browser platform
+    let n = trajectory.n;
+    return new Blob([
+        header,
+        trajectory.t.slice(0, n),
+        trajectory.x.slice(0, n),
+        trajectory.y.slice(0, n),
+        trajectory.src.slice(0, n),
+    ]);
+}
+
+function flushTrajectory(useBeacon) {
+    if (trajectory.n === 0) return Promise.resolve();
+    let body = packTrajectory();
+    trajectory.seq += 1;
+    trajectory.n = 0;
+    trajectory.srcs = [];
+    trajectory.srcIndex = new Map();
+
+    if (useBeacon && navigator.sendBeacon) {
+        navigator.sendBeacon('/save_trajectory', body);
+        return Promise.resolve();
+    }
+    return fetch('/save_trajectory', {
+        method: 'POST',
+        headers: {'Content-Type': 'application/octet-stream'},
+        body: body,
+        keepalive: true,
+    }).catch(error => console.error('Error saving trajectory:', error));
+}
+
+if (recordTrajectory) {
+    setInterval(flushTrajectory, TRAJECTORY_FLUSH_MS);
+    // The page may be closed without saving; a beacon still gets delivered
+    window.addEventListener('pagehide', () => flushTrajectory(true));
+    document.addEventListener('dragend', () => { trajectory.dragging = null; });
+}
+
 function saveLocations(endpoint, xLabel, yLabel) {
     let locations = [];
     d3.selectAll("foreignObject").each(function () {
@@ -122,6 +222,8 @@ function handleDragStart(event) {
     //     event.target.style.zIndex = '1'; // Reset z-index
     // } 
     event.dataTransfer.setData('text/plain', event.target.dataset.src);
+    // dataTransfer can't be read during dragover, so remember what moves
+    trajectory.dragging = event.target.src || event.target.dataset.src;
 }
 
 
@@ -151,10 +253,15 @@ function renderCircle() {
 
     svg.on("dragover", function (event) {
         event.preventDefault();
+        let rect = this.getBoundingClientRect();
+        recordTrajectorySample(trajectory.dragging, event.clientX - rect.left, event.clientY - rect.top);
     });
 
     svg.on("drop", function (event) {
         event.preventDefault();
+        let rect = this.getBoundingClientRect();
+        recordTrajectorySample(trajectory.dragging, event.clientX - rect.left, event.clientY - rect.top);
+        trajectory.dragging = null;
         let src = event.dataTransfer.getData('text/plain');
         let draggedVideo = document.querySelector(`video[data-src='${src}']`);
         let existingForeignObject = d3.select(`foreignObject video[data-src='${draggedVideo.dataset.src}']`).node()?.parentElement;
@@ -211,6 +318,7 @@ function renderCircle() {
                         d3.select(this)
                             .attr("x", event.x - 25)
                             .attr("y", event.y - 25);
+                        recordTrajectorySample(video.src, event.x, event.y);
                     })
                 ).node();
     
@@ -333,7 +441,16 @@ function placeSavedVideos(savedData) {
         let existingVideo = d3.select(`foreignObject video[src='${location.src}']`).node();
 
         if (!existingVideo) {
+            // Manifest from the server: size the player up front and start
+            // buffering before the first frame arrives
+            let media = (savedData.media || {})[location.src];
+            let playerHeight = 50;
+            if (media && media.width && media.height) {
+                playerHeight = Math.round(100 * media.height / media.width);
+            }
+
             let video = document.createElementNS("http://www.w3.org/1999/xhtml", "video");
+            video.preload = 'auto';
             video.src = location.src;
             // video.width = 50;
             video.autoplay = true; // Start playing automatically
@@ -353,7 +470,7 @@ function placeSavedVideos(savedData) {
                 .attr("x", location.initial_x - 25)  // Adjust the position based on video dimensions
                 .attr("y", location.initial_y - 25)  // Adjust the position based on video dimensions
                 .attr("width", 100)
-                .attr("height", 50)
+                .attr("height", playerHeight)
                 .on("drag", function (event) {
                     if (!foreignObject.classList.contains('scaled')) { // Only allow dragging if not scaled
                         d3.select(this)
@@ -500,7 +617,8 @@ function areClipsWithinCircle() {
 
 
 function loadSavedLocationsFromDatabase() {
-    fetch('/load_admin_locations', {method: 'POST'})
+    // GET so the browser can revalidate its cached copy with If-None-Match
+    fetch('/load_admin_locations', {cache: 'no-cache'})
         .then(response => response.json())
         .then(data => {
             placeSavedVideos(data);
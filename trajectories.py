@@ -0,0 +1,160 @@
+import argparse
+import os
+import struct
+import sys
+import zlib
+from array import array
+
+from sqlalchemy import create_engine, text
+
+from snapshots import analysis_db
+
+# Drag trajectories recorded on the participant page (see scripts.js). The
+# browser buffers samples in typed arrays and posts them in batches as one
+# packed little-endian payload:
+#
+#     b"TRJ1"
+#     uint32 page         random per page load, so a reload starts a new path
+#     uint32 seq          batch number within the page load, from 0
+#     uint32 n            samples in the batch
+#     uint16 n_srcs       then per src: uint16 byte length, UTF-8 bytes
+#     float32 t[n]        ms since the page loaded
+#     int16   x[n], y[n]  pointer position in arena (SVG) coordinates
+#     uint16  src[n]      index into the batch's src table
+#
+# That is 10 bytes a sample. Batches are stored zlib-compressed and decoded
+# back into NumPy arrays here.
+
+MAGIC = b"TRJ1"
+SAMPLE_BYTES = 4 + 2 + 2 + 2
+MAX_BATCH_BYTES = 1024 * 1024
+
+_HEADER = struct.Struct("<4sIIIH")
+_LENGTH = struct.Struct("<H")
+
+
+class TrajectoryError(ValueError):
+    pass
+
+
+def parse_batch(payload):
+    # Validates a payload from the browser; returns (page, seq, n_samples, srcs)
+    if len(payload) > MAX_BATCH_BYTES:
+        raise TrajectoryError("batch too large")
+    if len(payload) < _HEADER.size:
+        raise TrajectoryError("truncated header")
+    magic, page, seq, n_samples, n_srcs = _HEADER.unpack_from(payload)
+    if magic != MAGIC:
+        raise TrajectoryError("not a trajectory batch")
+
+    offset = _HEADER.size
+    srcs = []
+    for _ in range(n_srcs):
+        if offset + _LENGTH.size > len(payload):
+            raise TrajectoryError("truncated src table")
+        (length,) = _LENGTH.unpack_from(payload, offset)
+        offset += _LENGTH.size
+        try:
+            srcs.append(payload[offset:offset + length].decode("utf-8"))
+        except UnicodeDecodeError:
+            raise TrajectoryError("src is not UTF-8")
+        offset += length
+    if len(payload) - offset != n_samples * SAMPLE_BYTES:
+        raise TrajectoryError("sample data doesn't match the sample count")
+
+    indexes = array("H")
+    indexes.frombytes(payload[len(payload) - 2 * n_samples:])
+    if sys.byteorder == "big":
+        indexes.byteswap()
+    if n_samples and max(indexes) >= n_srcs:
+        raise TrajectoryError("src index out of range")
+    return page, seq, n_samples, srcs
+
+
+def compress_batch(payload):
+    return zlib.compress(payload, 6)
+
+
+def decode_batch(blob):
+    # Returns a dict of NumPy arrays: page (uint32), t (float32 ms), x and y
+    # (int16) and src (strings)
+    import numpy as np
+
+    payload = zlib.decompress(blob)
+    _, page, _, n_samples, n_srcs = _HEADER.unpack_from(payload)
+    offset = _HEADER.size
+    srcs = []
+    for _ in range(n_srcs):
+        (length,) = _LENGTH.unpack_from(payload, offset)
+        offset += _LENGTH.size
+        srcs.append(payload[offset:offset + length].decode("utf-8"))
+        offset += length
+
+    t = np.frombuffer(payload, "<f4", n_samples, offset)
+    offset += 4 * n_samples
+    x = np.frombuffer(payload, "<i2", n_samples, offset)
+    y = np.frombuffer(payload, "<i2", n_samples, offset + 2 * n_samples)
+    index = np.frombuffer(payload, "<u2", n_samples, offset + 4 * n_samples)
+    return {
+        "page": np.full(n_samples, page, dtype=np.uint32),
+        "t": t,
+        "x": x,
+        "y": y,
+        "src": np.array(srcs, dtype=str)[index],
+    }
+
+
+def iter_trajectories(engine, submission_id=None):
+    # Yields (submission_id, demographics_id, arrays) per submission. Retried
+    # or write-behind posts can arrive out of order, so batches are put back
+    # in seq order within each page load, and page loads in the order their
+    # first batch arrived (page itself is random).
+    import numpy as np
+
+    query = (
+        "SELECT t.submission_id, d.id, t.data, "
+        "min(t.id) OVER (PARTITION BY t.submission_id, t.page) AS page_order "
+        "FROM trajectory_batch t "
+        "LEFT JOIN demographics d ON d.submission_id = t.submission_id"
+    )
+    params = {}
+    if submission_id is not None:
+        query += " WHERE t.submission_id = :submission_id"
+        params["submission_id"] = submission_id
+    query += " ORDER BY t.submission_id, page_order, t.seq"
+
+    current = None
+    parts = []
+    with engine.connect() as conn:
+        for sub_id, demographics_id, blob, _ in conn.execute(text(query), params):
+            if current is not None and sub_id != current[0]:
+                yield current + (_concat(np, parts),)
+                parts = []
+            current = (sub_id, demographics_id)
+            parts.append(decode_batch(blob))
+    if current is not None:
+        yield current + (_concat(np, parts),)
+
+
+def _concat(np, parts):
+    return {key: np.concatenate([p[key] for p in parts]) for key in parts[0]}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Decode stored drag trajectories to .npz files")
+    parser.add_argument("--db", help="database URI (default: the newest snapshot, see snapshots.py)")
+    parser.add_argument("--submission", help="only this submission_id")
+    parser.add_argument("--output-dir", default=os.path.join("instance", "trajectories"))
+    args = parser.parse_args()
+
+    import numpy as np
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    count = 0
+    for sub_id, demographics_id, arrays in iter_trajectories(
+        create_engine(args.db or analysis_db()), args.submission
+    ):
+        np.savez(os.path.join(args.output_dir, f"{sub_id}.npz"), **arrays)
+        print(f"{sub_id} (demographics {demographics_id}): {len(arrays['t'])} samples")
+        count += 1
+    print(f"Wrote {count} trajectories to {args.output_dir}")
@@ -1,5 +1,51 @@
-from app import app
+import argparse
+import logging
+import os
+
 from waitress import serve
 
+
+def load_worker(worker):
+    # Runs in each prefork worker, after the fork
+    import app
+
+    app.after_fork(worker)
+    app.start_write_behind()
+    return app.app, app.app.config["WAITRESS_THREADS"]
+
+
+def worker_exit():
+    import app
+
+    app.stop_write_behind()
+
+
 if __name__ == '__main__':
-    serve(app, host='0.0.0.0', port=80)
+    parser = argparse.ArgumentParser(description="Serve the survey with waitress")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=80)
+    # More than one forks worker processes sharing the socket, see prefork.py
+    parser.add_argument("--workers", type=int, default=int(os.getenv("WAITRESS_WORKERS", "1")))
+    parser.add_argument("--preload", action="store_true",
+                        help="import the app before forking (a rolling restart then keeps the old code)")
+    args = parser.parse_args()
+
+    if args.workers > 1:
+        from prefork import Master
+
+        prefork_logger = logging.getLogger("survey.prefork")
+        prefork_logger.setLevel(logging.INFO)
+        prefork_logger.propagate = False
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s %(message)s"))
+        prefork_logger.addHandler(handler)
+        if args.preload:
+            import app
+        Master(load_worker, args.host, args.port, args.workers, worker_exit).run()
+    else:
+        from app import app, start_write_behind
+
+        # Replays any journaled submissions when WRITE_BEHIND=1
+        start_write_behind()
+        # The database pool is sized from the same setting, see app.py
+        serve(app, host=args.host, port=args.port, threads=app.config["WAITRESS_THREADS"])
@@ -0,0 +1,156 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+# Write-behind mode for participant submissions. The request handler appends
+# the validated submission to a small SQLite journal of its own (fsynced, so
+# it survives a crash) and returns straight away; a background thread drains
+# the journal into the main database in batched transactions. Entries are
+# only removed from the journal after their batch has committed, and are
+# replayed when the app starts again.
+#
+# A batch that fails max_attempts times in a row is retried one entry at a
+# time; an entry that still fails is appended to a dead-letter file (one JSON
+# object per line, with the error) and dropped from the journal, so a single
+# bad submission can't hold up the ones behind it. Errors transient() accepts,
+# such as a locked or unreachable database, never dead-letter an entry.
+
+logger = logging.getLogger("survey.write_behind")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS submission (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    payload TEXT NOT NULL,
+    created_at REAL NOT NULL
+)
+"""
+
+
+class SubmissionQueue:
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._connect().execute(SCHEMA)
+        self.wakeup = threading.Event()
+
+    def _connect(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            # FULL: the entry is on disk before the participant sees /end
+            conn.execute("PRAGMA synchronous=FULL")
+            self.local.conn = conn
+        return conn
+
+    def enqueue(self, payload):
+        conn = self._connect()
+        cursor = conn.execute(
+            "INSERT INTO submission (payload, created_at) VALUES (?, ?)",
+            (json.dumps(payload), time.time()),
+        )
+        self.wakeup.set()
+        return cursor.lastrowid
+
+    def fetch(self, limit):
+        rows = self._connect().execute(
+            "SELECT id, payload FROM submission ORDER BY id LIMIT ?", (limit,)
+        ).fetchall()
+        return [(entry_id, json.loads(payload)) for entry_id, payload in rows]
+
+    def dead_letter(self, path, entry_id, payload, error):
+        line = json.dumps({
+            "entry_id": entry_id,
+            "failed_at": time.time(),
+            "error": repr(error),
+            "payload": payload,
+        })
+        with open(path, "a", encoding="utf-8") as f:
+            f.write(line + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self.delete([entry_id])
+
+    def delete(self, ids):
+        conn = self._connect()
+        conn.executemany("DELETE FROM submission WHERE id = ?", [(i,) for i in ids])
+
+    def pending(self):
+        return self._connect().execute("SELECT count(*) FROM submission").fetchone()[0]
+
+
+class Writer(threading.Thread):
+    # Drains the queue through store_batch(payloads), which must write all of
+    # them in one transaction and skip any it has already stored, since a
+    # crash between the commit and the journal delete replays the batch.
+
+    def __init__(self, queue, store_batch, batch_size=200, interval=0.2,
+                 dead_letter_path=None, max_attempts=5, transient=None):
+        super().__init__(name="submission-writer", daemon=True)
+        self.queue = queue
+        self.store_batch = store_batch
+        self.batch_size = batch_size
+        self.interval = interval
+        self.dead_letter_path = dead_letter_path or queue.path + ".dead.ndjson"
+        self.max_attempts = max_attempts
+        self.transient = transient or (lambda error: False)
+        self.failures = 0
+        self.stopping = threading.Event()
+
+    def drain_once(self):
+        entries = self.queue.fetch(self.batch_size)
+        if not entries:
+            return 0
+        try:
+            self.store_batch([payload for _, payload in entries])
+        except Exception as e:
+            self.failures += 1
+            if self.transient(e) or self.failures < self.max_attempts:
+                raise
+            self.isolate(entries)
+        else:
+            self.queue.delete([entry_id for entry_id, _ in entries])
+        self.failures = 0
+        return len(entries)
+
+    def isolate(self, entries):
+        # Stores the batch entry by entry, dead-lettering those that fail
+        for entry_id, payload in entries:
+            try:
+                self.store_batch([payload])
+            except Exception as e:
+                if self.transient(e):
+                    raise
+                logger.error("dead-lettering journal entry %d to %s: %r",
+                             entry_id, self.dead_letter_path, e)
+                self.queue.dead_letter(self.dead_letter_path, entry_id, payload, e)
+            else:
+                self.queue.delete([entry_id])
+
+    def run(self):
+        backoff = self.interval
+        while not self.stopping.is_set():
+            # Cleared before draining so an enqueue during the drain isn't lost
+            self.queue.wakeup.clear()
+            try:
+                if self.drain_once() >= self.batch_size:
+                    continue
+                backoff = self.interval
+            except Exception:
+                logger.exception("submission writer failed, retrying in %.1fs", backoff)
+                self.stopping.wait(backoff)
+                backoff = min(backoff * 2, 30)
+                continue
+            self.queue.wakeup.wait(self.interval)
+
+    def stop(self, drain=True):
+        self.stopping.set()
+        self.queue.wakeup.set()
+        self.join()
+        if drain:
+            while self.drain_once():
+                pass